@@ -8,10 +8,18 @@ from utils_db import Database
 from loguru import logger
 from pyngrok import ngrok
 import os
+import json
 import pytz
+from concurrent.futures import ProcessPoolExecutor
 import nest_asyncio
 from dotenv import load_dotenv
-from utils_datawrapper import DataWrapper
+from utils_datawrapper import AsyncDataWrapper
+from utils_strava_client import StravaClient, StravaTokenCache, StravaRateLimiter
+from utils_jobs import JobQueue
+from utils_activity_cache import ActivityColumnCache
+from utils_analytics_store import FileAnalyticsStore, PostgresAnalyticsStore
+from utils_http_cache import CacheControlPolicy, ExpiringCache
+from utils_resilience import Upstream
 
 # Load environment variables
 load_dotenv()
@@ -27,6 +35,17 @@ gemini_model = os.getenv('GEMINI_MODEL')
 # Strava Credentials
 strava_client_id = int(os.getenv('STRAVA_CLIENT_ID'))
 strava_client_secret = os.getenv('STRAVA_CLIENT_SECRET')
+strava_base_url = os.getenv('STRAVA_BASE_URL', 'https://www.strava.com')
+strava_http_timeout = float(os.getenv('STRAVA_HTTP_TIMEOUT', 10))
+strava_max_connections = int(os.getenv('STRAVA_MAX_CONNECTIONS', 20))
+strava_max_concurrency = int(os.getenv('STRAVA_MAX_CONCURRENCY', 8))
+strava_token_refresh_margin = int(os.getenv('STRAVA_TOKEN_REFRESH_MARGIN', 600))
+strava_backfill_window = int(os.getenv('STRAVA_BACKFILL_WINDOW', 4))
+strava_sync_overlap_hours = float(os.getenv('STRAVA_SYNC_OVERLAP_HOURS', 24))
+strava_rate_limit_15min = int(os.getenv('STRAVA_RATE_LIMIT_15MIN', 200))
+strava_rate_limit_daily = int(os.getenv('STRAVA_RATE_LIMIT_DAILY', 2000))
+strava_bulk_reserve = float(os.getenv('STRAVA_BULK_RESERVE', 0.2))
+strava_endpoint_timeouts = json.loads(os.getenv('STRAVA_ENDPOINT_TIMEOUTS') or '{}')  # {"<path glob>": seconds}, first match wins
 
 # Telegram Credentials
 telegram_token = os.getenv('TELEGRAM_TOKEN')
@@ -35,11 +54,23 @@ kenny_chat_id = os.getenv('KENNY_CHAT_ID')
 
 # PostgreSQL Credentials
 DATABASE_URL = os.getenv('DATABASE_URL')
+bulk_upsert_executemany_min_records = int(os.getenv('BULK_UPSERT_EXECUTEMANY_MIN_RECORDS', 5))
+bulk_upsert_copy_min_records = int(os.getenv('BULK_UPSERT_COPY_MIN_RECORDS', 200))
 
 # DASH Credentials
 dash_api = os.getenv('DASH_API')
 dash_link_auth = os.getenv('DASH_LINK_AUTH')
 dash_link_charts = os.getenv('DASH_LINK_CHARTS')
+datawrapper_http_timeout = float(os.getenv('DATAWRAPPER_HTTP_TIMEOUT', 30))
+datawrapper_max_concurrency = int(os.getenv('DATAWRAPPER_MAX_CONCURRENCY', 5))  # Datawrapper calls in flight per worker
+datawrapper_endpoint_timeouts = json.loads(os.getenv('DATAWRAPPER_ENDPOINT_TIMEOUTS') or '{}')
+
+# Retries and circuit breaker of the Strava and Datawrapper calls (per upstream and worker)
+upstream_max_attempts = int(os.getenv('UPSTREAM_MAX_ATTEMPTS', 3))
+upstream_backoff_base = float(os.getenv('UPSTREAM_BACKOFF_BASE', 0.5))
+upstream_backoff_max = float(os.getenv('UPSTREAM_BACKOFF_MAX', 30))
+circuit_failure_threshold = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5))  # consecutive failures that open the circuit
+circuit_reset_seconds = float(os.getenv('CIRCUIT_RESET_SECONDS', 30))  # how long calls fail fast before a probe call
 
 # ngrok
 ngrok_token = os.getenv('NGROK_TOKEN')
@@ -47,13 +78,37 @@ ngrok_token = os.getenv('NGROK_TOKEN')
 # Directories
 data_directory = os.getenv('DATA_DIRECTORY', 'data/')
 
+# Analytics
+analytics_debounce_seconds = float(os.getenv('ANALYTICS_DEBOUNCE_SECONDS', 10))
+analytics_mode = os.getenv('ANALYTICS_MODE', 'pandas')  # pandas: aggregate in Python, sql: aggregate in Postgres
+analytics_processes = int(os.getenv('ANALYTICS_PROCESSES', 2))  # worker processes for the pandas work, 0 runs it on the event loop
+analytics_cache_size = int(os.getenv('ANALYTICS_CACHE_SIZE', 256))  # parsed dashboard documents kept in memory per worker
+analytics_store_backend = os.getenv('ANALYTICS_STORE', 'file')  # file: local data/activity_data files, postgres: main.strava_analytics
+analytics_store_revalidate_seconds = float(os.getenv('ANALYTICS_STORE_REVALIDATE_SECONDS', 2))  # postgres: seconds a cached document is served before a version check
+activity_cache_directory = os.getenv('ACTIVITY_CACHE_DIRECTORY', os.path.join(data_directory, 'activity_cache'))  # empty disables the cache
+cache_control_policies = json.loads(os.getenv('CACHE_CONTROL_POLICIES') or '{}')  # {"<path glob>": "<Cache-Control>"}, first match wins
+chart_cache_ttl = float(os.getenv('CHART_CACHE_TTL', 60))  # seconds a worker serves (and revalidates) chart embeds without a query
+
+# Job queue
+job_workers = int(os.getenv('JOB_WORKERS', 2))
+job_poll_interval = float(os.getenv('JOB_POLL_INTERVAL', 1))
+job_max_attempts = int(os.getenv('JOB_MAX_ATTEMPTS', 5))
+job_retry_base_seconds = float(os.getenv('JOB_RETRY_BASE_SECONDS', 5))
+job_visibility_timeout = float(os.getenv('JOB_VISIBILITY_TIMEOUT', 1800))
+
 sg_timezone = pytz.timezone('Asia/Singapore')
 
-dw = DataWrapper(api_token=dash_api)
+def upstream_policy(name, timeouts):
+    return Upstream(name, max_attempts=upstream_max_attempts, backoff_base=upstream_backoff_base, backoff_max=upstream_backoff_max,
+                    failure_threshold=circuit_failure_threshold, reset_timeout=circuit_reset_seconds, timeouts=timeouts)
 
-weekday_mapping_dic = {0: 'Monday', 1: 'Tuesday', 2: 'Wednesday', 3: 'Thursday', 4: 'Friday', 5: 'Saturday', 6: 'Sunday'}
-month_mapping_dic = {1:'Jan', 2:'Feb', 3:'Mar', 4:'Apr', 5:'May', 6:'Jun', 
-               7:'Jul', 8:'Aug', 9:'Sep', 10:'Oct', 11:'Nov', 12:'Dec'}
+dw = AsyncDataWrapper(api_token=dash_api, timeout=datawrapper_http_timeout, max_concurrency=datawrapper_max_concurrency,
+                      upstream=upstream_policy('datawrapper', datawrapper_endpoint_timeouts))
+strava = StravaClient(client_id=strava_client_id, client_secret=strava_client_secret, base_url=strava_base_url,
+                      timeout=strava_http_timeout, max_connections=strava_max_connections, max_concurrency_per_host=strava_max_concurrency,
+                      rate_limiter=StravaRateLimiter(short_limit=strava_rate_limit_15min, daily_limit=strava_rate_limit_daily,
+                                                     bulk_reserve=strava_bulk_reserve),
+                      upstream=upstream_policy('strava', strava_endpoint_timeouts))
 
 ngrok.set_auth_token(ngrok_token)
 nest_asyncio.apply()
@@ -61,7 +116,19 @@ logger.add("logs/strava_bot.log", rotation="500 MB", compression="zip", retentio
 
 bot_app = Application.builder().token(telegram_token).build()
 logger_bot_app = Application.builder().token(logger_telegram_token).build()
-db = Database(DATABASE_URL)
+db = Database(DATABASE_URL, executemany_min_records=bulk_upsert_executemany_min_records, copy_min_records=bulk_upsert_copy_min_records)
+strava_tokens = StravaTokenCache(client=strava, db=db, refresh_margin=strava_token_refresh_margin)
+job_queue = JobQueue(db, concurrency=job_workers, poll_interval=job_poll_interval, max_attempts=job_max_attempts,
+                     backoff_base=job_retry_base_seconds, visibility_timeout=job_visibility_timeout)
+# Worker processes are only started on the first recompute
+analytics_executor = ProcessPoolExecutor(max_workers=analytics_processes) if analytics_processes > 0 else None
+activity_cache = ActivityColumnCache(activity_cache_directory) if activity_cache_directory else None
+if analytics_store_backend == 'postgres':
+    analytics_store = PostgresAnalyticsStore(db, max_entries=analytics_cache_size, revalidate_seconds=analytics_store_revalidate_seconds)
+else:
+    analytics_store = FileAnalyticsStore(os.path.join(data_directory, 'activity_data'), max_entries=analytics_cache_size)
+cache_control = CacheControlPolicy(cache_control_policies)
+chart_cache = ExpiringCache(ttl=chart_cache_ttl)
 
 
 @asynccontextmanager
@@ -81,11 +148,17 @@ async def lifespan(_: FastAPI):
 
         async with bot_app:
             await bot_app.start()
+            await job_queue.start()
             yield # when application is running
+            await job_queue.stop()
             await bot_app.stop() # cleanup when shutting down
     except Exception as e:
         logger.exception(f"Startup error: {e}")
         raise
     finally:
+        if analytics_executor is not None:
+            analytics_executor.shutdown(wait=True, cancel_futures=True)
+        await strava.aclose()
+        await dw.aclose()
         await db.disconnect()
         logger.info("All connections closed")
\ No newline at end of file
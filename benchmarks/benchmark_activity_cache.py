@@ -0,0 +1,109 @@
+"""
+Loading an athlete's activities for a recompute from Postgres (asyncpg rows to dicts to a DataFrame) vs from the columnar
+activity cache (utils_activity_cache.py), in a local Postgres. Also checks that webhook style patches keep the cache identical
+to the database: after each patch the cache must still be hit, and give the same aggregates as the rows.
+
+BENCHMARK_DATABASE_URL=postgresql://postgres@localhost/bench python -m benchmarks.benchmark_activity_cache --sizes 1000 10000 50000
+"""
+
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from benchmarks.local_postgres import benchmark_dsn, reset_schema
+from benchmarks.synthetic_strava import generate_activities
+from utils_activity_cache import ActivityColumnCache, compute_cached_analytics, load_activity_frame
+from utils_analytics import aggregate_activities, compute_analytics_and_aggregates
+from utils_analytics_sql import ANALYTICS_COLUMNS, fetch_analytics_rows
+from utils_db import Database
+from utils_strava_mapper import map_activities
+
+
+async def best_of(func, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+async def patch_round_trip(db: Database, cache: ActivityColumnCache, strava_id: str, record=None, delete_id=None) -> bool:
+    """A webhook create / update (record) or delete (delete_id) followed by its cache patch, True when the cache still matches the DB"""
+    activity_id = record.activity_id if record else delete_id
+    fingerprint_before = await cache.fingerprint(db, strava_id)
+    if record:
+        await db.bulk_upsert(table="main.strava_activities", data=[record], constraint_columns=["strava_id", "activity_id"])
+    else:
+        await db.execute("UPDATE main.strava_activities SET is_deleted = TRUE WHERE strava_id = $1 AND activity_id = $2", strava_id, activity_id)
+    row = await db.fetch_one(f"SELECT {ANALYTICS_COLUMNS} FROM main.strava_activities WHERE strava_id = $1 AND activity_id = $2", strava_id, activity_id)
+    await cache.patch_activity(db, strava_id, row, activity_id, fingerprint_before)
+
+    misses = cache.counters["misses"]
+    path = await cache.ensure(db, strava_id)
+    now = datetime(2025, 6, 30)
+    same = aggregate_activities(load_activity_frame(path), now=now) == aggregate_activities(await fetch_analytics_rows(db, strava_id), now=now)
+    return same and cache.counters["misses"] == misses
+
+
+async def main(dsn: str, sizes: list, repeat: int) -> int:
+    db = Database(dsn)
+    await db.connect()
+    async with db._pool.acquire() as conn:
+        await reset_schema(conn)
+    cache = ActivityColumnCache(tempfile.mkdtemp(prefix="activity_cache_"))
+
+    failures = 0
+    for athlete_id, size in enumerate(sizes, start=1):
+        strava_id = str(athlete_id)
+        # The first activity is held back, it plays the webhook create
+        records = map_activities(generate_activities(athlete_id, size + 1, seed=athlete_id), updated_at=datetime.now(timezone.utc))
+        await db.bulk_upsert(table="main.strava_activities", data=records[1:], constraint_columns=["strava_id", "activity_id"])
+
+        async def from_database():
+            compute_analytics_and_aggregates(await fetch_analytics_rows(db, strava_id), "Athlete")
+
+        async def from_cache():
+            compute_cached_analytics(await cache.ensure(db, strava_id), "Athlete")
+
+        async def load_database():
+            await fetch_analytics_rows(db, strava_id)
+
+        async def load_cache():
+            load_activity_frame(await cache.ensure(db, strava_id))
+
+        await cache.ensure(db, strava_id)
+        patches_ok = all(
+            [
+                await patch_round_trip(db, cache, strava_id, record=records[0]),
+                await patch_round_trip(db, cache, strava_id, record=records[5]._replace(distance=42195.0, kudos_count=99)),
+                await patch_round_trip(db, cache, strava_id, delete_id=records[10].activity_id),
+            ]
+        )
+        failures += not patches_ok
+        db_load_s, cache_load_s = await best_of(load_database, repeat), await best_of(load_cache, repeat)
+        db_total_s, cache_total_s = await best_of(from_database, repeat), await best_of(from_cache, repeat)
+        print(
+            {
+                "activities": size,
+                "db_load_ms": round(db_load_s * 1000, 1),
+                "cache_load_ms": round(cache_load_s * 1000, 1),
+                "db_recompute_ms": round(db_total_s * 1000, 1),
+                "cache_recompute_ms": round(cache_total_s * 1000, 1),
+                "patches": "ok" if patches_ok else "MISMATCH",
+            }
+        )
+    print({"cache": cache.counters})
+    await db.disconnect()
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dsn", default=None)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10_000, 50_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    sys.exit(1 if asyncio.run(main(benchmark_dsn(args.dsn), args.sizes, args.repeat)) else 0)
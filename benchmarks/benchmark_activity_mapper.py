@@ -0,0 +1,92 @@
+"""
+Rows/sec of the activity-to-row mapper on a synthetic payload, compared with the previous per-activity dict construction.
+
+python -m benchmarks.benchmark_activity_mapper --activities 10000
+"""
+
+import argparse
+import json
+import time
+from datetime import datetime, timezone
+from benchmarks.synthetic_strava import generate_activities
+from utils import custom_hash
+from utils_strava_mapper import map_activities
+
+
+def legacy_map_activities(activities):
+    """The per-activity dict construction that used to be copy-pasted in utils_strava (kept here as the baseline)"""
+    db_activities = []
+    for activity in activities:
+        db_activity = {
+            "strava_id": str(activity["athlete"]["id"]),
+            "hashed_strava_id": custom_hash(str(activity["athlete"]["id"])),
+            "activity_id": str(activity["id"]),
+            "name": activity["name"],
+            "distance": activity["distance"],
+            "moving_time": activity["moving_time"],
+            "elapsed_time": activity["elapsed_time"],
+            "total_elevation_gain": activity["total_elevation_gain"],
+            "type": activity["type"],
+            "sport_type": activity.get("sport_type"),
+            "workout_type": activity.get("workout_type"),
+            "start_date": datetime.strptime(activity["start_date"], "%Y-%m-%dT%H:%M:%SZ"),
+            "start_date_local": datetime.strptime(activity["start_date_local"], "%Y-%m-%dT%H:%M:%SZ"),
+            "timezone": activity.get("timezone"),
+            "utc_offset": activity.get("utc_offset"),
+            "start_latlng": json.dumps(activity.get("start_latlng")),
+            "end_latlng": json.dumps(activity.get("end_latlng")),
+            "location_country": activity.get("location_country"),
+            "achievement_count": activity.get("achievement_count", 0),
+            "kudos_count": activity.get("kudos_count", 0),
+            "comment_count": activity.get("comment_count", 0),
+            "athlete_count": activity.get("athlete_count", 0),
+            "photo_count": activity.get("photo_count", 0),
+            "trainer": activity.get("trainer", False),
+            "commute": activity.get("commute", False),
+            "manual": activity.get("manual", False),
+            "private": activity.get("private", False),
+            "flagged": activity.get("flagged", False),
+            "gear_id": activity.get("gear_id"),
+            "average_speed": activity.get("average_speed"),
+            "max_speed": activity.get("max_speed"),
+            "average_cadence": activity.get("average_cadence"),
+            "average_watts": activity.get("average_watts"),
+            "weighted_average_watts": activity.get("weighted_average_watts"),
+            "kilojoules": activity.get("kilojoules"),
+            "device_watts": activity.get("device_watts", False),
+            "has_heartrate": activity.get("has_heartrate", False),
+            "average_heartrate": activity.get("average_heartrate"),
+            "max_heartrate": activity.get("max_heartrate"),
+            "max_watts": activity.get("max_watts"),
+            "pr_count": activity.get("pr_count", 0),
+            "total_photo_count": activity.get("total_photo_count", 0),
+            "has_kudoed": activity.get("has_kudoed", False),
+            "updated_at": datetime.now(timezone.utc),
+        }
+        db_activities.append(db_activity)
+    return db_activities
+
+
+def rows_per_second(mapper, activities, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        mapper(activities)
+        best = min(best, time.perf_counter() - started)
+    return len(activities) / best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--activities", type=int, default=10_000)
+    parser.add_argument("--page-size", type=int, default=200, help="the mapper is called once per Strava page")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    activities = generate_activities(athlete_id=1, count=args.activities)
+    pages = [activities[i : i + args.page_size] for i in range(0, len(activities), args.page_size)]
+    updated_at = datetime.now(timezone.utc)
+
+    legacy = rows_per_second(legacy_map_activities, activities, args.repeat)
+    mapper = rows_per_second(lambda _: [map_activities(page, updated_at) for page in pages], activities, args.repeat)
+    print({"activities": args.activities, "legacy_rows_per_s": int(legacy), "map_activities_rows_per_s": int(mapper), "speedup": round(mapper / legacy, 2)})
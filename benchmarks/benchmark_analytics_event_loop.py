@@ -0,0 +1,63 @@
+"""
+Event loop lag during a burst of analytics recomputes (what baseline_analytics does per athlete), with the pandas work on the
+event loop (ANALYTICS_PROCESSES=0) vs in a process pool (ANALYTICS_PROCESSES=N). The lag is how late other coroutines
+(webhooks, /stravajson, /text2sql) get to run.
+
+python -m benchmarks.benchmark_analytics_event_loop --athletes 8 --activities 10000 --processes 2
+"""
+
+import argparse
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from benchmarks.benchmark_event_loop_blocking import monitor_event_loop_lag, percentile
+from benchmarks.synthetic_strava import generate_activity_rows
+from utils_analytics import compute_analytics_and_aggregates
+
+
+async def recompute(activities: list, executor) -> None:
+    # Same dispatch as utils_strava.run_analytics
+    if executor is None:
+        compute_analytics_and_aggregates(activities, "Athlete")
+    else:
+        await asyncio.get_running_loop().run_in_executor(executor, compute_analytics_and_aggregates, activities, "Athlete")
+
+
+async def run_scenario(name: str, athletes: list, executor) -> dict:
+    samples, stop = [], asyncio.Event()
+    monitor = asyncio.create_task(monitor_event_loop_lag(samples, stop))
+    await asyncio.sleep(0.05)
+    started = time.perf_counter()
+    await asyncio.gather(*(recompute(activities, executor) for activities in athletes))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await monitor
+    result = {
+        "scenario": name,
+        "athletes": len(athletes),
+        "wall_s": round(elapsed, 2),
+        "lag_p50_ms": round(percentile(samples, 50) * 1000, 2),
+        "lag_p99_ms": round(percentile(samples, 99) * 1000, 2),
+        "lag_max_ms": round(max(samples, default=0.0) * 1000, 2),
+    }
+    print(result)
+    return result
+
+
+async def main(athlete_count: int, activity_count: int, processes: int) -> None:
+    athletes = [generate_activity_rows(athlete_id, activity_count, end_date=datetime.now()) for athlete_id in range(1, athlete_count + 1)]
+    await run_scenario("event loop (ANALYTICS_PROCESSES=0)", athletes, None)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        # Warm up the workers (process start and the pandas import) outside the measurement
+        await asyncio.gather(*(recompute(athletes[0][:10], executor) for _ in range(processes)))
+        await run_scenario(f"process pool (ANALYTICS_PROCESSES={processes})", athletes, executor)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--athletes", type=int, default=8, help="recomputes in the burst")
+    parser.add_argument("--activities", type=int, default=10_000, help="activities per athlete")
+    parser.add_argument("--processes", type=int, default=2)
+    args = parser.parse_args()
+    asyncio.run(main(args.athletes, args.activities, args.processes))
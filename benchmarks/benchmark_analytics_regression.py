@@ -0,0 +1,79 @@
+"""
+Regression check of the per-athlete analytics compute time (compute_analytics_and_aggregates, as run by baseline_analytics),
+against the times recorded in benchmarks/baselines/analytics_compute.json. Exits non-zero when an athlete size is slower than
+its baseline by more than --tolerance.
+
+Baselines are machine specific, record them on the machine that runs the check (and after an intended speedup):
+python -m benchmarks.benchmark_analytics_regression --update-baseline
+python -m benchmarks.benchmark_analytics_regression --tolerance 0.3
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from benchmarks.synthetic_strava import generate_activity_rows
+from utils_analytics import compute_analytics_and_aggregates
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "analytics_compute.json")
+
+
+def best_of(func, repeat: int) -> float:
+    # Garbage collection off while timing (as timeit does), it adds most of the run to run noise
+    best = float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            started = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - started)
+        finally:
+            gc.enable()
+    return best
+
+
+def measure(sizes: list, repeat: int) -> dict:
+    timings = {}
+    for size in sizes:
+        # Fixed end date and seed, so the athletes are the same on every run
+        rows = generate_activity_rows(athlete_id=1, count=size, end_date=datetime(2025, 6, 30), seed=13)
+        timings[str(size)] = round(best_of(lambda: compute_analytics_and_aggregates(rows, "Athlete"), repeat) * 1000, 1)
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10_000, 50_000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed slowdown over the baseline, 0.5 = 50%%")
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    timings = measure(args.sizes, args.repeat)
+    if args.update_baseline:
+        os.makedirs(os.path.dirname(BASELINE_FILE), exist_ok=True)
+        with open(BASELINE_FILE, "w") as f:
+            json.dump({"compute_ms": timings}, f, indent=2)
+        print({"baseline_updated": timings})
+        sys.exit(0)
+
+    with open(BASELINE_FILE) as f:
+        baseline = json.load(f)["compute_ms"]
+    regressions = 0
+    for size, compute_ms in timings.items():
+        budget_ms = baseline.get(size, float("inf")) * (1 + args.tolerance)
+        regressions += compute_ms > budget_ms
+        print(
+            {
+                "activities": int(size),
+                "compute_ms": compute_ms,
+                "baseline_ms": baseline.get(size),
+                "budget_ms": round(budget_ms, 1),
+                "status": "ok" if compute_ms <= budget_ms else "REGRESSION",
+            }
+        )
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,85 @@
+"""
+ANALYTICS_MODE=pandas vs ANALYTICS_MODE=sql on synthetic athletes in a local Postgres: fetching every activity and aggregating in pandas,
+against Postgres returning the aggregates. Doubles as the parity test, the rendered dashboards (and the aggregates) must be identical.
+
+BENCHMARK_DATABASE_URL=postgresql://postgres@localhost/bench python -m benchmarks.benchmark_analytics_sql --sizes 100 1000 10000 50000
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+from datetime import datetime, timezone
+from benchmarks.local_postgres import benchmark_dsn, reset_schema
+from benchmarks.synthetic_strava import generate_activities
+from utils_analytics import compute_analytics_and_aggregates, render_analytics
+from utils_analytics_sql import fetch_analytics_aggregates, fetch_analytics_rows
+from utils_db import Database
+from utils_strava_mapper import map_activities
+
+
+async def pandas_mode(db: Database, strava_id: str):
+    activities = await fetch_analytics_rows(db, strava_id)
+    return compute_analytics_and_aggregates(activities, "Athlete")
+
+
+async def sql_mode(db: Database, strava_id: str):
+    aggregates = await fetch_analytics_aggregates(db, strava_id)
+    return render_analytics(aggregates, "Athlete"), aggregates
+
+
+async def best_of(func, repeat: int):
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = await func()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def mismatches(expected: dict, actual: dict, path: str = "") -> list:
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        return [diff for key in expected.keys() | actual.keys() for diff in mismatches(expected.get(key), actual.get(key), f"{path}.{key}")]
+    return [] if expected == actual else [path]
+
+
+async def main(dsn: str, sizes: list, repeat: int) -> int:
+    db = Database(dsn)
+    await db.connect()
+    async with db._pool.acquire() as conn:
+        await reset_schema(conn)
+
+    failures = 0
+    for athlete_id, size in enumerate(sizes, start=1):
+        # Up to today so that the current year heatmap is populated, with deleted activities that both modes must skip
+        records = map_activities(generate_activities(athlete_id, size, end_date=datetime.now(), seed=athlete_id), updated_at=datetime.now(timezone.utc))
+        await db.bulk_upsert(table="main.strava_activities", data=records, constraint_columns=["strava_id", "activity_id"])
+        await db.execute("UPDATE main.strava_activities SET is_deleted = TRUE WHERE strava_id = $1 AND id % 50 = 0", str(athlete_id))
+        await db.execute("ANALYZE main.strava_activities")
+
+        pandas_s, (pandas_results, pandas_aggregates) = await best_of(lambda: pandas_mode(db, str(athlete_id)), repeat)
+        sql_s, (sql_results, sql_aggregates) = await best_of(lambda: sql_mode(db, str(athlete_id)), repeat)
+        sql_aggregates.pop("streaks")
+        diffs = mismatches({**pandas_results, "last_updated": None}, {**sql_results, "last_updated": None})
+        diffs += mismatches(pandas_aggregates, sql_aggregates, "aggregates")
+        failures += bool(diffs)
+        print(
+            {
+                "activities": size,
+                "pandas_ms": round(pandas_s * 1000, 1),
+                "sql_ms": round(sql_s * 1000, 1),
+                "speedup": round(pandas_s / sql_s, 1),
+                "parity": "ok" if not diffs else diffs,
+            }
+        )
+    await db.disconnect()
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dsn", default=None)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10_000, 50_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    sys.exit(1 if asyncio.run(main(benchmark_dsn(args.dsn), args.sizes, args.repeat)) else 0)
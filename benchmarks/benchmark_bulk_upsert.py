@@ -0,0 +1,67 @@
+"""
+Compares the Database.bulk_upsert strategies (values, executemany, copy) on main.strava_activities in a local Postgres,
+for a fresh insert and for a second pass where every record conflicts (the /reload-full-data case).
+
+BENCHMARK_DATABASE_URL=postgresql://postgres@localhost/bench python -m benchmarks.benchmark_bulk_upsert --sizes 100 10000 100000
+"""
+
+import argparse
+import asyncio
+import time
+from datetime import datetime, timezone
+from benchmarks.local_postgres import benchmark_dsn, reset_schema
+from benchmarks.synthetic_strava import generate_activities
+from utils_db import Database
+from utils_strava_mapper import map_activities
+
+STRATEGIES = ["values", "executemany", "copy"]
+
+
+def synthetic_records(count: int, activities_per_athlete: int = 5000) -> list:
+    records, athlete_id = [], 1
+    while len(records) < count:
+        activities = generate_activities(athlete_id=athlete_id, count=min(activities_per_athlete, count - len(records)))
+        records.extend(map_activities(activities, updated_at=datetime.now(timezone.utc)))
+        athlete_id += 1
+    return records
+
+
+async def time_upsert(db: Database, records: list, strategy: str) -> float:
+    started = time.perf_counter()
+    await db.bulk_upsert(table="main.strava_activities", data=records, constraint_columns=["strava_id", "activity_id"], strategy=strategy)
+    return time.perf_counter() - started
+
+
+async def main(dsn: str, sizes: list) -> None:
+    db = Database(dsn)
+    await db.connect()
+    async with db._pool.acquire() as conn:
+        await reset_schema(conn)
+
+    results = []
+    for size in sizes:
+        records = synthetic_records(size)
+        for strategy in STRATEGIES:
+            await db.execute("TRUNCATE main.strava_activities")
+            insert_s = await time_upsert(db, records, strategy)
+            update_s = await time_upsert(db, records, strategy)
+            result = {
+                "records": size,
+                "strategy": strategy,
+                "insert_s": round(insert_s, 3),
+                "update_s": round(update_s, 3),
+                "insert_records_per_s": int(size / insert_s),
+                "update_records_per_s": int(size / update_s),
+            }
+            results.append(result)
+            print(result)
+        print({"records": size, "auto_picks": db.choose_upsert_strategy(size)})
+    await db.disconnect()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dsn", default=None)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 10_000, 100_000])
+    args = parser.parse_args()
+    asyncio.run(main(benchmark_dsn(args.dsn), args.sizes))
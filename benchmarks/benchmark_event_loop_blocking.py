@@ -0,0 +1,67 @@
+"""
+Measures how long the event loop is blocked while fetching from Strava, before (blocking `requests` inside async def)
+and after (pooled StravaClient). Runs entirely against the local fake Strava server.
+
+python -m benchmarks.benchmark_event_loop_blocking --requests 50 --latency 0.1
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+import requests
+from benchmarks.fake_strava_server import FakeStravaServer
+from utils_strava_client import StravaClient
+
+
+async def monitor_event_loop_lag(samples: list, stop: asyncio.Event, interval: float = 0.005) -> None:
+    """Records how late each `interval` sleep wakes up; a blocked loop shows up as large lag"""
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+
+def percentile(samples: list, q: float) -> float:
+    return statistics.quantiles(samples, n=100, method="inclusive")[int(q) - 1] if len(samples) > 1 else (samples[0] if samples else 0.0)
+
+
+async def blocking_fetch(base_url: str, page: int) -> None:
+    requests.get(f"{base_url}/api/v3/athlete/activities", headers={"Authorization": "Bearer fake"}, params={"per_page": 200, "page": page})
+
+
+async def run_scenario(name: str, fetch, request_count: int) -> dict:
+    samples, stop = [], asyncio.Event()
+    monitor = asyncio.create_task(monitor_event_loop_lag(samples, stop))
+    started = time.perf_counter()
+    await asyncio.gather(*(fetch(page) for page in range(1, request_count + 1)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await monitor
+    result = {
+        "scenario": name,
+        "requests": request_count,
+        "wall_s": round(elapsed, 3),
+        "lag_p50_ms": round(percentile(samples, 50) * 1000, 2),
+        "lag_p99_ms": round(percentile(samples, 99) * 1000, 2),
+        "lag_max_ms": round(max(samples, default=0.0) * 1000, 2),
+    }
+    print(result)
+    return result
+
+
+async def main(request_count: int, latency: float) -> None:
+    with FakeStravaServer(latency=latency, activity_count=5000) as server:
+        await run_scenario("requests (before)", lambda page: blocking_fetch(server.base_url, page), request_count)
+
+        client = StravaClient(client_id=1, client_secret="fake", base_url=server.base_url)
+        await run_scenario("StravaClient (after)", lambda page: client.get_athlete_activities("fake", page=page), request_count)
+        await client.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.1, help="simulated Strava latency in seconds")
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.latency))
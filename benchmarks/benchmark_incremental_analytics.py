@@ -0,0 +1,55 @@
+"""
+Webhook-to-dashboard compute time: a full recompute over every activity vs applying one new activity to the stored aggregates.
+
+python -m benchmarks.benchmark_incremental_analytics --sizes 100 1000 10000 50000
+"""
+
+import argparse
+import json
+import time
+from datetime import datetime
+from benchmarks.synthetic_strava import generate_activity_rows
+from utils_analytics import apply_activity_delta, compute_analytics_and_aggregates, render_analytics
+
+
+def best_of(func, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10_000, 50_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        # Latest activity first, it plays the webhook's new activity
+        rows = generate_activity_rows(athlete_id=1, count=size + 1, end_date=datetime.now(), sport_mix={"Run": 1.0})
+        _, aggregates = compute_analytics_and_aggregates(rows[1:], "Athlete")
+        stored = json.dumps(aggregates)
+
+        def incremental():
+            # What update_analytics_for_activity does between the DB round trips
+            current = json.loads(stored)
+            apply_activity_delta(current, None, rows[0])
+            render_analytics(current, "Athlete")
+
+        full = best_of(lambda: compute_analytics_and_aggregates(rows, "Athlete"), args.repeat)
+        copies = [json.loads(stored) for _ in range(args.repeat)]
+        delta = best_of(lambda: apply_activity_delta(copies.pop(), None, rows[0]), args.repeat)
+        total = best_of(incremental, args.repeat)
+        print(
+            {
+                "activities": size,
+                "full_ms": round(full * 1000, 1),
+                "delta_ms": round(delta * 1000, 2),
+                "incremental_total_ms": round(total * 1000, 1),
+                "aggregates_kb": round(len(stored) / 1024, 1),
+                "speedup": round(full / total, 1),
+            }
+        )
@@ -0,0 +1,86 @@
+"""
+Parity test of the incremental analytics: random creates, updates and deletes applied with apply_activity_delta (as the webhooks do,
+with a JSON round trip like main.strava_analytics_state) must render exactly the dashboard of a full recompute after every step.
+Guards against the aggregates drifting from a fresh sum (e.g. float sums flipping a rounded figure after a few hundred deltas).
+
+python -m benchmarks.benchmark_incremental_analytics_parity --seeds 6 --steps 300
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from datetime import datetime
+from benchmarks.benchmark_analytics_sql import mismatches
+from benchmarks.synthetic_strava import generate_activity_rows
+from utils_analytics import AnalyticsRebuildRequired, apply_activity_delta, compute_analytics_and_aggregates, render_analytics
+
+
+def stored(aggregates: dict) -> dict:
+    # What update_analytics_for_activity reads back from the JSONB column
+    return json.loads(json.dumps(aggregates))
+
+
+def random_change(rng: random.Random, live: dict, spare: list):
+    """(activity_id, old_row, new_row) of a create, an update (distance, moving time and elevation) or a delete"""
+    choice = rng.random()
+    if choice < 0.4 and spare:
+        new = spare.pop()
+        return new["activity_id"], None, new
+    activity_id = rng.choice(list(live))
+    old = live[activity_id]
+    if choice < 0.8:
+        new = dict(
+            old,
+            distance=(old["distance"] or 0) * rng.uniform(0.8, 1.2) + rng.random(),
+            moving_time=int((old["moving_time"] or 0) + rng.randint(-100, 100)),
+            total_elevation_gain=(old["total_elevation_gain"] or 0) + rng.random(),
+        )
+        return activity_id, old, new
+    return activity_id, old, None
+
+
+def run(seed: int, steps: int, initial: int) -> dict:
+    rng = random.Random(seed)
+    rows = generate_activity_rows(athlete_id=1, count=initial + steps, end_date=datetime.now(), sport_mix={"Run": 0.8, "Ride": 0.2}, seed=seed)
+    live, spare = {row["activity_id"]: row for row in rows[:initial]}, rows[initial:]
+    aggregates = stored(compute_analytics_and_aggregates(list(live.values()), "Athlete")[1])
+
+    rebuilds = 0
+    for step in range(steps):
+        activity_id, old, new = random_change(rng, live, spare)
+        if new is None:
+            live.pop(activity_id)
+        else:
+            live[activity_id] = new
+        try:
+            apply_activity_delta(aggregates, old, new)
+        except AnalyticsRebuildRequired:
+            # What the webhook does too, a full recompute becomes the new starting point
+            rebuilds += 1
+            aggregates = stored(compute_analytics_and_aggregates(list(live.values()), "Athlete")[1])
+            continue
+        aggregates = stored(aggregates)
+
+        full, _ = compute_analytics_and_aggregates(list(live.values()), "Athlete")
+        diffs = mismatches({**full, "last_updated": None}, {**render_analytics(aggregates, "Athlete"), "last_updated": None})
+        if diffs:
+            return {"seed": seed, "parity": diffs, "step": step, "rebuilds": rebuilds}
+    return {"seed": seed, "parity": "ok", "steps": steps, "rebuilds": rebuilds}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seeds", type=int, default=6)
+    parser.add_argument("--steps", type=int, default=300)
+    parser.add_argument("--initial", type=int, default=100, help="activities before the first change")
+    args = parser.parse_args()
+
+    failures = 0
+    for seed in range(args.seeds):
+        started = time.perf_counter()
+        result = run(seed, args.steps, args.initial)
+        failures += result["parity"] != "ok"
+        print({**result, "elapsed_s": round(time.perf_counter() - started, 1)})
+    sys.exit(1 if failures else 0)
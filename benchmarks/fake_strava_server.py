@@ -0,0 +1,100 @@
+"""
+Local fake Strava API for benchmarks, so we never hit (or get rate limited by) the real Strava.
+
+Serves /oauth/token, /api/v3/athlete/activities and /api/v3/activities/{id} from synthetic payloads with a configurable latency,
+and reports X-RateLimit-Limit / X-RateLimit-Usage like Strava (answering 429 past the limit) so the rate limiter can be exercised.
+Point the app at it with STRAVA_BASE_URL=http://127.0.0.1:8765, or use it as a fixture:
+
+with FakeStravaServer(latency=0.2, activity_count=1000) as server:
+    client = StravaClient(client_id=1, client_secret="fake", base_url=server.base_url)
+"""
+
+import asyncio
+import calendar
+import threading
+import time
+import uvicorn
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse
+from benchmarks.synthetic_strava import generate_activities
+
+
+def create_fake_strava_app(latency: float = 0.0, activity_count: int = 1000, athlete_id: int = 1, rate_limits=(100000, 1000000)) -> FastAPI:
+    activities = generate_activities(athlete_id=athlete_id, count=activity_count)
+    activities_by_id = {activity["id"]: activity for activity in activities}
+    start_epochs = [calendar.timegm(time.strptime(activity["start_date"], "%Y-%m-%dT%H:%M:%SZ")) for activity in activities]
+    app = FastAPI()
+    app.state.request_count = 0
+
+    @app.middleware("http")
+    async def simulate_latency(request, call_next):
+        app.state.request_count += 1
+        usage = app.state.request_count
+        await asyncio.sleep(latency)
+        if usage > rate_limits[0]:
+            response = JSONResponse(status_code=429, content={"message": "Rate Limit Exceeded"})
+        else:
+            response = await call_next(request)
+        response.headers["X-RateLimit-Limit"] = ",".join(map(str, rate_limits))
+        response.headers["X-RateLimit-Usage"] = f"{usage},{usage}"
+        return response
+
+    @app.post("/oauth/token")
+    async def oauth_token():
+        return {
+            "token_type": "Bearer",
+            "access_token": f"fake-access-{int(time.time())}",
+            "refresh_token": "fake-refresh",
+            "expires_at": int(time.time()) + 21600,
+            "expires_in": 21600,
+            "athlete": {"id": athlete_id, "firstname": "Fake", "lastname": "Athlete"},
+        }
+
+    @app.get("/api/v3/athlete/activities")
+    async def athlete_activities(page: int = 1, per_page: int = 30, after: int = None, before: int = None):
+        selected = activities
+        if after is not None or before is not None:
+            selected = [
+                activity
+                for activity, epoch in zip(activities, start_epochs)
+                if (after is None or epoch > after) and (before is None or epoch < before)
+            ]
+        return selected[(page - 1) * per_page : page * per_page]
+
+    @app.get("/api/v3/activities/{activity_id}")
+    async def activity(activity_id: int):
+        if activity_id not in activities_by_id:
+            raise HTTPException(status_code=404, detail="Record Not Found")
+        return activities_by_id[activity_id]
+
+    return app
+
+
+class FakeStravaServer:
+    """Runs the fake Strava app with uvicorn in a background thread for the duration of a `with` block"""
+
+    def __init__(
+        self, latency: float = 0.0, activity_count: int = 1000, athlete_id: int = 1, host: str = "127.0.0.1", port: int = 8765, rate_limits=(100000, 1000000)
+    ):
+        self.app = create_fake_strava_app(latency=latency, activity_count=activity_count, athlete_id=athlete_id, rate_limits=rate_limits)
+        self.base_url = f"http://{host}:{port}"
+        self._server = uvicorn.Server(uvicorn.Config(self.app, host=host, port=port, log_level="warning"))
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+
+    @property
+    def request_count(self) -> int:
+        return self.app.state.request_count
+
+    def __enter__(self) -> "FakeStravaServer":
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._server.should_exit = True
+        self._thread.join()
+
+
+if __name__ == "__main__":
+    uvicorn.run(create_fake_strava_app(latency=0.2), host="127.0.0.1", port=8765)
@@ -0,0 +1,49 @@
+"""
+Helpers for benchmarks that need a throwaway local Postgres, loaded with the schema from sql_postgres_strava_init.sql.
+
+The benchmark database is passed explicitly (--dsn or BENCHMARK_DATABASE_URL) and its `main` schema is DROPPED and recreated,
+so never point it at the application database.
+"""
+
+import os
+import asyncpg
+from loguru import logger
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sql_postgres_strava_init.sql")
+
+
+def benchmark_dsn(dsn: str = None) -> str:
+    dsn = dsn or os.getenv("BENCHMARK_DATABASE_URL")
+    if not dsn:
+        raise SystemExit("Set BENCHMARK_DATABASE_URL (or pass --dsn) to a throwaway local Postgres database")
+    if dsn == os.getenv("DATABASE_URL"):
+        raise SystemExit("BENCHMARK_DATABASE_URL must not be the application DATABASE_URL, its main schema gets dropped")
+    return dsn
+
+
+def split_sql_statements(sql: str) -> list:
+    """Split a SQL script on semicolons, ignoring comments and semicolons inside $$ function bodies"""
+    statements, current, in_dollar_quote = [], [], False
+    for line in sql.splitlines():
+        if not in_dollar_quote and line.strip().startswith("--"):
+            continue
+        current.append(line)
+        if line.count("$$") % 2:
+            in_dollar_quote = not in_dollar_quote
+        if not in_dollar_quote and line.rstrip().endswith(";"):
+            statements.append("\n".join(current).strip())
+            current = []
+    return [statement for statement in statements if statement]
+
+
+async def reset_schema(conn: asyncpg.Connection) -> None:
+    """Drop and recreate the main schema from sql_postgres_strava_init.sql (tables needing missing extensions are skipped)"""
+    await conn.execute("DROP SCHEMA IF EXISTS main CASCADE")
+    await conn.execute("CREATE SCHEMA main")
+    with open(SCHEMA_FILE) as f:
+        statements = split_sql_statements(f.read())
+    for statement in statements:
+        try:
+            await conn.execute(statement)
+        except asyncpg.PostgresError as e:
+            logger.warning(f"Skipping schema statement ({e.__class__.__name__}: {e}): {statement.splitlines()[0]}")
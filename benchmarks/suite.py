@@ -0,0 +1,278 @@
+"""
+Stage by stage benchmark of the analytics pipeline as athlete history grows, on synthetic athletes in a local Postgres
+(its `main` schema is recreated from sql_postgres_strava_init.sql):
+
+    map        Strava payloads to main.strava_activities records (map_activities)
+    ingest     Database.bulk_upsert, page by page as retrieve_full_data_from_strava does
+    analytics  baseline_analytics computations: pandas over DB rows, ANALYTICS_MODE=sql, and the activity cache (cold and warm)
+    serve      the /stravajson work: the analytics store (first request a miss) and rendering the response, whole and by path
+               (by path from the precompressed leaf artifacts), with the file store and with ANALYTICS_STORE=postgres
+
+Each stage records wall time, per-athlete mean / p95 and the peak RSS reached during the stage. Results are written as JSON
+(named after the git commit) so that two commits can be compared:
+
+BENCHMARK_DATABASE_URL=postgresql://postgres@localhost/bench python -m benchmarks.suite --athletes 5 --histories 100 1000 10000
+python -m benchmarks.suite --dsn ... --compare benchmarks/results/<older commit>.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from fastapi.responses import HTMLResponse, JSONResponse
+from benchmarks.benchmark_event_loop_blocking import percentile
+from benchmarks.local_postgres import benchmark_dsn, reset_schema
+from benchmarks.synthetic_strava import generate_activities, generate_activity_rows
+from utils import get_nested_value
+from utils_activity_cache import ActivityColumnCache, compute_cached_analytics
+from utils_analytics import compute_analytics_and_aggregates, render_analytics
+from utils_analytics_sql import fetch_analytics_aggregates, fetch_analytics_rows
+from utils_analytics_store import FileAnalyticsStore, PostgresAnalyticsStore
+from utils_db import Database
+from utils_strava_mapper import map_activities
+
+RESULTS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+SERVE_PATHS = ["summary-total_activities", "latest_activity-distance", "aggregations-weekly_stats"]
+
+
+def reset_peak_rss() -> None:
+    # Linux only, resets VmHWM so that each stage reports its own peak
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            return next(int(line.split()[1]) for line in f if line.startswith("VmHWM")) / 1024
+    except (OSError, StopIteration):
+        # Whole process high water mark, in kB on Linux and bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+class Stage:
+    """Times one stage, with per-athlete laps"""
+
+    def __init__(self, name: str, history: int):
+        self.name, self.history, self.laps = name, history, []
+
+    @contextmanager
+    def lap(self):
+        started = time.perf_counter()
+        yield
+        self.laps.append(time.perf_counter() - started)
+
+    def result(self, wall_s: float, peak_rss: float, **extra) -> dict:
+        return {
+            "history": self.history,
+            "stage": self.name,
+            "wall_s": round(wall_s, 4),
+            "per_athlete_mean_ms": round(sum(self.laps) / len(self.laps) * 1000, 2) if self.laps else None,
+            "per_athlete_p95_ms": round(percentile(self.laps, 95) * 1000, 2) if self.laps else None,
+            "peak_rss_mb": round(peak_rss, 1),
+            **extra,
+        }
+
+
+async def run_stage(results: list, name: str, history: int, func, **extra) -> None:
+    stage = Stage(name, history)
+    reset_peak_rss()
+    started = time.perf_counter()
+    await func(stage)
+    result = stage.result(time.perf_counter() - started, peak_rss_mb(), **extra)
+    results.append(result)
+    print(result)
+
+
+async def serve_dashboard(store: FileAnalyticsStore, hashed_strava_id: str, path: str = None):
+    """What /stravajson (and /stravajson/{path}) does per request, reading the artifact file stands in for FileResponse"""
+    if path is not None:
+        artifact = await store.get_artifact(hashed_strava_id, path, "gzip, br")
+        if artifact is not None and artifact.path is None:
+            return artifact.body
+        if artifact is not None:
+            with open(artifact.path, "rb") as f:
+                return f.read()
+    data = await store.get(hashed_strava_id)
+    if path is None:
+        return JSONResponse(content=data)
+    return HTMLResponse(content=get_nested_value(data, path))
+
+
+async def run_history(db: Database, results: list, history: int, athlete_ids: list, args, cache: ActivityColumnCache, store: FileAnalyticsStore,
+                      pg_store: PostgresAnalyticsStore):
+    payloads = {
+        athlete_id: generate_activities(int(athlete_id), history, activities_per_week=args.activities_per_week, sport_mix=args.sport_mix, seed=args.seed)
+        for athlete_id in athlete_ids
+    }
+    records = {}
+
+    async def map_stage(stage):
+        for athlete_id in athlete_ids:
+            with stage.lap():
+                records[athlete_id] = map_activities(payloads[athlete_id], updated_at=datetime.now(timezone.utc))
+
+    async def ingest_stage(stage):
+        for athlete_id in athlete_ids:
+            with stage.lap():
+                for start in range(0, history, args.page_size):
+                    await db.bulk_upsert("main.strava_activities", records[athlete_id][start : start + args.page_size], ["strava_id", "activity_id"])
+
+    async def pandas_stage(stage):
+        for athlete_id in athlete_ids:
+            with stage.lap():
+                compute_analytics_and_aggregates(await fetch_analytics_rows(db, athlete_id), "Athlete")
+
+    async def sql_stage(stage):
+        for athlete_id in athlete_ids:
+            with stage.lap():
+                render_analytics(await fetch_analytics_aggregates(db, athlete_id), "Athlete")
+
+    async def cache_stage(stage):
+        for athlete_id in athlete_ids:
+            with stage.lap():
+                analytics_results, _ = compute_cached_analytics(await cache.ensure(db, athlete_id), "Athlete")
+            # Written as by another worker (document and leaf artifacts), so that the first request below is a cache miss
+            await asyncio.to_thread(store._write, athlete_id, analytics_results)
+            await PostgresAnalyticsStore(db).write(athlete_id, analytics_results)
+
+    def serve_stage(serving_store):
+        async def stage_func(stage):
+            for athlete_id in athlete_ids:
+                with stage.lap():
+                    for _ in range(args.requests):
+                        await serve_dashboard(serving_store, athlete_id)
+        return stage_func
+
+    def serve_path_stage(serving_store):
+        async def stage_func(stage):
+            for athlete_id in athlete_ids:
+                with stage.lap():
+                    for i in range(args.requests):
+                        await serve_dashboard(serving_store, athlete_id, SERVE_PATHS[i % len(SERVE_PATHS)])
+        return stage_func
+
+    await run_stage(results, "map", history, map_stage, records_per_athlete=history)
+    await run_stage(results, "ingest", history, ingest_stage, records_per_athlete=history, page_size=args.page_size)
+    for athlete_id in athlete_ids:
+        cache.invalidate(athlete_id)
+    await run_stage(results, "analytics_pandas", history, pandas_stage)
+    await run_stage(results, "analytics_sql", history, sql_stage)
+    await run_stage(results, "analytics_cache_cold", history, cache_stage)
+    await run_stage(results, "analytics_cache_warm", history, cache_stage)
+    await run_stage(results, "serve_stravajson", history, serve_stage(store), requests_per_athlete=args.requests)
+    await run_stage(results, "serve_stravajson_path", history, serve_path_stage(store), requests_per_athlete=args.requests)
+    await run_stage(results, "serve_stravajson_postgres", history, serve_stage(pg_store), requests_per_athlete=args.requests)
+    await run_stage(results, "serve_stravajson_path_postgres", history, serve_path_stage(pg_store), requests_per_athlete=args.requests)
+
+
+def git_commit() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = "unknown", None
+    return {"commit": commit, "dirty": dirty}
+
+
+def compare(results: list, baseline_path: str, tolerance: float) -> int:
+    """Prints wall time ratios against an earlier results file, returns the number of stages slower than the tolerance"""
+    with open(baseline_path) as f:
+        baseline = {(result["history"], result["stage"]): result for result in json.load(f)["results"]}
+    regressions = 0
+    for result in results:
+        before = baseline.get((result["history"], result["stage"]))
+        if not before or not before["wall_s"]:
+            continue
+        ratio = result["wall_s"] / before["wall_s"]
+        regressions += ratio > 1 + tolerance
+        print(
+            {
+                "history": result["history"],
+                "stage": result["stage"],
+                "wall_ratio": round(ratio, 2),
+                "peak_rss_ratio": round(result["peak_rss_mb"] / before["peak_rss_mb"], 2) if before["peak_rss_mb"] else None,
+                "status": "REGRESSION" if ratio > 1 + tolerance else "ok",
+            }
+        )
+    return regressions
+
+
+async def main(args) -> int:
+    db = Database(benchmark_dsn(args.dsn))
+    await db.connect()
+    async with db._pool.acquire() as conn:
+        await reset_schema(conn)
+    working_directory = tempfile.mkdtemp(prefix="benchmark_suite_")
+    cache = ActivityColumnCache(os.path.join(working_directory, "activity_cache"))
+    store = FileAnalyticsStore(os.path.join(working_directory, "activity_data"))
+    pg_store = PostgresAnalyticsStore(db)
+
+    # Keeps the one-off warm up of pandas out of the first timed stage
+    compute_analytics_and_aggregates(generate_activity_rows(0, 50), "Athlete")
+    results = []
+    try:
+        for index, history in enumerate(args.histories):
+            athlete_ids = [str(index * 100_000 + athlete) for athlete in range(1, args.athletes + 1)]
+            await run_history(db, results, history, athlete_ids, args, cache, store, pg_store)
+    finally:
+        await db.disconnect()
+
+    report = {
+        "suite": "analytics_pipeline",
+        **git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {
+            "athletes": args.athletes,
+            "histories": args.histories,
+            "sport_mix": args.sport_mix,
+            "activities_per_week": args.activities_per_week,
+            "page_size": args.page_size,
+            "requests": args.requests,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    output = args.output or os.path.join(RESULTS_DIRECTORY, f"{report['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print({"results": output})
+    return compare(results, args.compare, args.tolerance) if args.compare else 0
+
+
+def sport_mix(values: list) -> dict:
+    """Run=0.7 Ride=0.3 -> {"Run": 0.7, "Ride": 0.3}"""
+    return {sport: float(weight) for sport, weight in (value.split("=") for value in values)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dsn", default=None)
+    parser.add_argument("--athletes", type=int, default=5, help="athletes per history length")
+    parser.add_argument("--histories", type=int, nargs="+", default=[100, 1000, 10_000], help="activities per athlete")
+    parser.add_argument("--sport-mix", nargs="+", default=["Run=0.7", "Ride=0.15", "Walk=0.1", "WeightTraining=0.05"])
+    parser.add_argument("--activities-per-week", type=float, default=5.0)
+    parser.add_argument("--page-size", type=int, default=200, help="records per bulk_upsert, as Strava pages")
+    parser.add_argument("--requests", type=int, default=20, help="/stravajson requests per athlete")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="defaults to benchmarks/results/<commit>.json")
+    parser.add_argument("--compare", default=None, help="earlier results file, exits non-zero on a wall time regression")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+    args.sport_mix = sport_mix(args.sport_mix)
+    sys.exit(1 if asyncio.run(main(args)) else 0)
@@ -0,0 +1,105 @@
+"""
+Synthetic Strava payloads for benchmarks and the fake Strava server.
+
+The activities mirror the shape of GET /athlete/activities (SummaryActivity), latest activity first.
+
+activities = generate_activities(athlete_id=1, count=10_000)
+"""
+
+import random
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+DEFAULT_SPORT_MIX = {"Run": 0.7, "Ride": 0.15, "Walk": 0.1, "WeightTraining": 0.05}
+
+# (mean km, spread km, mean pace in minutes per km) per sport
+SPORT_PROFILES = {
+    "Run": (8.0, 5.0, 5.5),
+    "VirtualRun": (6.0, 3.0, 5.5),
+    "Ride": (35.0, 20.0, 2.0),
+    "Walk": (4.0, 2.0, 11.0),
+    "Hike": (10.0, 5.0, 13.0),
+    "Swim": (1.5, 0.8, 20.0),
+    "WeightTraining": (0.0, 0.0, 0.0),
+}
+
+
+def generate_activity(athlete_id: int, activity_id: int, start_date_local: datetime, sport: str, rng: random.Random) -> Dict[str, Any]:
+    mean_km, spread_km, pace = SPORT_PROFILES.get(sport, (5.0, 2.0, 8.0))
+    distance = max(0.0, rng.gauss(mean_km, spread_km)) * 1000 if mean_km else 0.0
+    moving_time = max(1, int(distance / 1000 * pace * 60)) if distance else rng.randint(1800, 5400)
+    start_date = start_date_local - timedelta(hours=8)
+    latlng = [round(1.3 + rng.uniform(-0.1, 0.1), 6), round(103.8 + rng.uniform(-0.1, 0.1), 6)] if distance else []
+    return {
+        "resource_state": 2,
+        "athlete": {"id": athlete_id, "resource_state": 1},
+        "name": f"{sport} #{activity_id}",
+        "distance": round(distance, 1),
+        "moving_time": moving_time,
+        "elapsed_time": moving_time + rng.randint(0, 600),
+        "total_elevation_gain": round(rng.uniform(0, 150), 1),
+        "type": sport,
+        "sport_type": sport,
+        "workout_type": rng.choice([None, 0, 1, 2, 3]),
+        "id": activity_id,
+        "start_date": start_date.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "start_date_local": start_date_local.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "timezone": "(GMT+08:00) Asia/Singapore",
+        "utc_offset": 28800.0,
+        "location_country": "Singapore",
+        "achievement_count": rng.randint(0, 5),
+        "kudos_count": rng.randint(0, 30),
+        "comment_count": rng.randint(0, 3),
+        "athlete_count": rng.randint(1, 4),
+        "photo_count": 0,
+        "trainer": False,
+        "commute": rng.random() < 0.05,
+        "manual": False,
+        "private": False,
+        "flagged": False,
+        "gear_id": f"g{athlete_id}",
+        "start_latlng": latlng,
+        "end_latlng": latlng,
+        "average_speed": round(distance / moving_time, 3) if distance else 0.0,
+        "max_speed": round(distance / moving_time * 1.6, 3) if distance else 0.0,
+        "average_cadence": round(rng.uniform(75, 90), 1),
+        "has_heartrate": True,
+        "average_heartrate": round(rng.uniform(130, 165), 1),
+        "max_heartrate": float(rng.randint(165, 195)),
+        "device_watts": False,
+        "pr_count": rng.randint(0, 3),
+        "total_photo_count": rng.randint(0, 2),
+        "has_kudoed": False,
+    }
+
+
+def generate_activities(
+    athlete_id: int,
+    count: int,
+    end_date: Optional[datetime] = None,
+    activities_per_week: float = 5.0,
+    sport_mix: Optional[Dict[str, float]] = None,
+    seed: int = 0,
+) -> List[Dict[str, Any]]:
+    """Generate `count` activities for one athlete, latest first, spaced to roughly `activities_per_week`"""
+    rng = random.Random(seed * 1_000_003 + athlete_id)
+    sport_mix = sport_mix or DEFAULT_SPORT_MIX
+    sports, weights = list(sport_mix), list(sport_mix.values())
+    current = (end_date or datetime(2025, 6, 30)).replace(hour=6, minute=30, second=0, microsecond=0)
+    mean_gap_hours = 24 * 7 / activities_per_week
+
+    activities = []
+    for i in range(count):
+        activities.append(generate_activity(athlete_id, athlete_id * 10_000_000 + count - i, current, rng.choices(sports, weights)[0], rng))
+        current -= timedelta(hours=max(1.0, rng.expovariate(1 / mean_gap_hours)))
+    return activities
+
+
+def generate_activity_rows(athlete_id: int, count: int, **kwargs) -> List[Dict[str, Any]]:
+    """The same activities as main.strava_activities rows (as returned by db.fetch_all), for the analytics benchmarks"""
+    from utils_strava_mapper import map_activities
+
+    rows = [record._asdict() for record in map_activities(generate_activities(athlete_id, count, **kwargs), updated_at=datetime.now())]
+    for row in rows:
+        row["is_deleted"] = False
+    return rows
@@ -0,0 +1,42 @@
+"""
+Fleet-wide incremental sync and analytics recompute, e.g. after a change to baseline_analytics.
+
+python fleet_refresh.py --concurrency 8 --processes 4
+python fleet_refresh.py --no-sync     # only recompute the analytics from the stored activities
+An interrupted run resumes from the checkpoint, pass --restart to start over.
+"""
+import argparse
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+from loguru import logger
+from app_instance import db, strava, data_directory
+from utils_strava import refresh_fleet
+
+
+async def main(args):
+    checkpoint_path = os.path.join(data_directory, "fleet_refresh_checkpoint.json")
+    if args.restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    await db.connect()
+    try:
+        with ProcessPoolExecutor(max_workers=args.processes) as executor:
+            summary = await refresh_fleet(concurrency=args.concurrency, executor=executor, checkpoint_path=checkpoint_path, sync=args.sync)
+    finally:
+        await strava.aclose()
+        await db.disconnect()
+
+    # No checkpoint is written when there was nothing to refresh
+    if summary["failed"] == 0 and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    logger.info(f"{summary['refreshed']} athletes refreshed at {summary['athletes_per_minute']} athletes/min, {summary['failed']} failed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=4, help="athletes synced and recomputed at once")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="worker processes for the pandas work")
+    parser.add_argument("--no-sync", dest="sync", action="store_false", help="skip the Strava sync")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint of a previous run")
+    asyncio.run(main(parser.parse_args()))
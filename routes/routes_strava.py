@@ -1,19 +1,20 @@
-from fastapi import APIRouter, Query, HTTPException, Request, BackgroundTasks
-from app_instance import bot_app, logger_bot_app
+from fastapi import APIRouter, Query, HTTPException, Request
+from app_instance import bot_app, logger_bot_app, dw
 from utils_db import Database
-from app_instance import (kenny_chat_id, strava_client_id, strava_client_secret, db, sg_timezone)
-from utils_strava import (retrieve_refresh_token, delete_activity_from_strava, create_update_data_from_strava, retrieve_full_data_from_strava,
-                         baseline_analytics, datawrapper_initiate_charts)
+from app_instance import (kenny_chat_id, strava_client_id, strava_client_secret, db, sg_timezone, strava, strava_tokens, job_queue,
+                          activity_cache, analytics_store, cache_control, chart_cache)
+from utils_strava import retrieve_refresh_token, analytics_debouncer, SYNC_FUNCTIONS
 from datetime import datetime, timezone
-from fastapi.responses import RedirectResponse, JSONResponse, Response, HTMLResponse
+from fastapi.responses import RedirectResponse, JSONResponse, Response, HTMLResponse, FileResponse
 from http import HTTPStatus
-from typing import Optional
+from typing import List, Optional
 import requests
 from loguru import logger
 from pydantic import BaseModel
 import json
-import os
-from utils import get_nested_value, custom_hash
+from utils import get_nested_value, select_nested_values, custom_hash
+from utils_http_cache import strong_etag, is_not_modified, validator_headers
+import hashlib
 from chains.workflow_text2sql import app
 import asyncio
 from langchain_core.messages import HumanMessage
@@ -24,7 +25,7 @@ strava_router = APIRouter()
 
 
 @strava_router.get("/strava-auth/{chat_string_id}")
-async def strava_auth(chat_string_id: str, code: Optional[str] = None, error: Optional[str] = None, background_tasks: BackgroundTasks = BackgroundTasks()):
+async def strava_auth(chat_string_id: str, code: Optional[str] = None, error: Optional[str] = None):
     """
     Strava oauth2 endpoint
     """
@@ -36,19 +37,21 @@ async def strava_auth(chat_string_id: str, code: Optional[str] = None, error: Op
         await bot_app.bot.send_message(chat_id=int(chat_string_id), text=f"You have denied access to my bot.")
         return JSONResponse(status_code=403, content={"status": "error", "message": "Strava access was denied", "error_type": "permission_denied"})
     
-    credentials_dic = retrieve_refresh_token(code)
+    credentials_dic = await retrieve_refresh_token(code)
     athlete = credentials_dic['athlete']
     await db.upsert(table='main.botdata_v2', data={'telegram_id': chat_string_id,'strava_id': str(athlete['id']),'strava_firstname': athlete['firstname'],
                                                     'strava_lastname': athlete['lastname'],'refresh_token': credentials_dic['refresh_token'],   
+                                                    'access_token': credentials_dic['access_token'],
+                                                    'expires_at': datetime.fromtimestamp(credentials_dic['expires_at'], timezone.utc),
                                                     'strava_approval': True, 'last_active_at': datetime.now(timezone.utc).astimezone(sg_timezone)},
                                                     constraint_columns=['telegram_id'])
+    strava_tokens.store(athlete['id'], credentials_dic)
 
     hashed_strava_id = custom_hash(str(athlete['id']))
     weblink = bot_app.bot_data['weblink']
-    background_tasks.add_task(retrieve_full_data_from_strava, credentials_dic['refresh_token'])
-    background_tasks.add_task(baseline_analytics, athlete['id'], upload_to_file = True)
-    background_tasks.add_task(datawrapper_initiate_charts, weblink, athlete['id'])
-    background_tasks.add_task(bot_app.bot.send_message, chat_id=int(chat_string_id), text=f"Thank you for connecting! Your dashboard is ready at https://kennyvectors.com/running-strava-v2-dashboard?analytics={hashed_strava_id}")
+    await job_queue.enqueue("sync_athlete", {"strava_id": str(athlete['id']), "mode": "incremental", "weblink": weblink,
+                                             "notifications": [{"bot": "bot", "chat_id": chat_string_id, "text": f"Thank you for connecting! Your dashboard is ready at https://kennyvectors.com/running-strava-v2-dashboard?analytics={hashed_strava_id}"}]},
+                            dedupe_key=f"sync:incremental:{athlete['id']}")
 
     if credentials_dic['refresh_token'] != -1:
         await logger_bot_app.bot.send_message(chat_id=kenny_chat_id, text=f"Strava account has been connected to telegram {chat_string_id}")
@@ -103,35 +106,28 @@ async def strava_webhook_verify(hub_mode: str = Query(None, alias="hub.mode"),
         raise HTTPException(status_code=403, detail="Invalid verification token")
 
 @strava_router.post('/strava-response')
-async def strava_webhook_event(request: Request, background_tasks: BackgroundTasks):
+async def strava_webhook_event(request: Request):
     """
-    Handle incoming Strava webhook events
+    Handle incoming Strava webhook events, the event is only enqueued (see handle_strava_webhook_job) to answer within Strava's 2 second deadline
     webhook_json = {"aspect_type": "create", "event_time": 1734361680, "object_id": 13127941701, "object_type": "activity", "owner_id": 28923822, "subscription_id": 143570, "updates": {}}
     webhook_json = {'aspect_type': 'create', 'event_time': 1735816641, 'object_id': 13244961091, 'object_type': 'activity', 'owner_id': 29260159, 'subscription_id': 270785, 'updates': {}}
     """
     try:
         webhook_json = await request.json()
         logger.info(f"Received Strava webhook event: {webhook_json}")
-        await logger_bot_app.bot.send_message(chat_id=kenny_chat_id, text=webhook_json)
-
-        if webhook_json['aspect_type'] in ('create', 'update'):
-            status = await create_update_data_from_strava(webhook_json)
-            if status:
-                background_tasks.add_task(baseline_analytics, webhook_json['owner_id'], upload_to_file = True)
-        elif webhook_json['aspect_type'] == 'delete':
-            await delete_activity_from_strava(webhook_json)
-            background_tasks.add_task(baseline_analytics, webhook_json['owner_id'], upload_to_file = True)
-        else:
-            logger.warning(f"Unknown aspect type: {webhook_json['aspect_type']}")
+        await job_queue.enqueue("strava_webhook", webhook_json)
         return {"status": "success"}
     except Exception as e:
         logger.exception("Error processing webhook event")
         raise HTTPException(status_code=500, detail="Failed to process webhook event")
 
 @strava_router.post('/reload-full-data')
-async def strava_reload_full_data(request: Request, background_tasks: BackgroundTasks):
+async def strava_reload_full_data(request: Request):
     """
-    Reload full data from Strava
+    Reload data from Strava, request body {"telegram_id": ..., "mode": "incremental" | "full" | "reconcile"}
+    - incremental (default): only activities after the latest stored one
+    - full: re-download the entire history
+    - reconcile: full history plus soft deleting activities no longer on Strava
     
     json_output = asyncio.run(db.fetch_one(f"SELECT refresh_token, strava_id FROM main.botdata_v2 WHERE telegram_id = $1", str(telegram_id)))
 
@@ -144,19 +140,20 @@ async def strava_reload_full_data(request: Request, background_tasks: Background
         json_output  = await request.json()
         weblink = bot_app.bot_data['weblink']
         telegram_id = json_output['telegram_id']
+        mode = json_output.get('mode', 'incremental')
         logger.info(f"Received request to reload full data for {telegram_id} [{json_output}]")
-        json_output = await db.fetch_one(f"SELECT refresh_token, strava_id FROM main.botdata_v2 WHERE telegram_id = $1", str(telegram_id))
+        json_output = await db.fetch_one(f"SELECT strava_id FROM main.botdata_v2 WHERE telegram_id = $1", str(telegram_id))
         if json_output is None:
             logger.info(f"telegram_id {telegram_id} not found in DB")
             return {"status": "failed", "message": f"telegram_id {telegram_id} not found in DB"}    
-        special_refresh_token = json_output['refresh_token']
         strava_id = json_output['strava_id']
-        background_tasks.add_task(retrieve_full_data_from_strava, special_refresh_token)
-        background_tasks.add_task(baseline_analytics, strava_id, upload_to_file = True)
-        background_tasks.add_task(datawrapper_initiate_charts, weblink, strava_id)
-        background_tasks.add_task(logger_bot_app.bot.send_message, chat_id=int(kenny_chat_id), text=f"Strava data for {telegram_id} has been reloaded (reload-full-data)")
+        if mode not in SYNC_FUNCTIONS:
+            return {"status": "failed", "message": f"Unknown mode {mode}, expected one of {list(SYNC_FUNCTIONS)}"}
+        queued = await job_queue.enqueue("sync_athlete", {"strava_id": strava_id, "mode": mode, "weblink": weblink,
+                                                          "notifications": [{"bot": "logger", "chat_id": kenny_chat_id, "text": f"Strava data for {telegram_id} has been reloaded (reload-full-data, {mode})"}]},
+                                         priority=1, dedupe_key=f"sync:{mode}:{strava_id}")
 
-        return {"status": "processing", "message": "Data reload started in background"}
+        return {"status": "processing", "message": "Data reload queued" if queued else "Data reload already queued"}
     except Exception as e:
         logger.exception(f"Error processing Strava reload request: {str(e)}")
         raise HTTPException(
@@ -165,23 +162,28 @@ async def strava_reload_full_data(request: Request, background_tasks: Background
         )
 
 @strava_router.get('/stravajson')
-async def strava_json(id: str):
+async def strava_json(id: str, request: Request):
     """
     Get Strava JSON data for a given Strava ID
     """
     try:
-        file_path = f"data/activity_data/{id}.json"
-        if not os.path.exists(file_path):
-            return {"status": "failed", "message": f"File {file_path} does not exist"}
-
-         # Read and return JSON data
+        # Parsed documents are cached per worker (see utils_analytics_store.py)
         try:
-            with open(file_path, 'r') as f:
-                data = json.load(f)
-                return JSONResponse(content=data)
-                
+            # Validators come from the cached manifest, a revalidation never reads the document
+            validators = await analytics_store.get_validators(id)
+            if validators is None:
+                return {"status": "failed", "message": f"File {analytics_store.path(id)} does not exist"}
+            headers = validator_headers(strong_etag(validators.content_hash), validators.last_modified, cache_control.for_path(request.url.path))
+            if is_not_modified(request.headers, headers["ETag"], validators.last_modified):
+                return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+
+            data = await analytics_store.get(id)
+            if data is None:
+                return {"status": "failed", "message": f"File {analytics_store.path(id)} does not exist"}
+            return JSONResponse(content=data, headers=headers)
+
         except json.JSONDecodeError:
-            logger.error(f"Invalid JSON in file: {file_path}")
+            logger.error(f"Invalid JSON in file: {analytics_store.path(id)}")
             raise HTTPException(
                 status_code=500,
                 detail="Error reading activity data"
@@ -194,7 +196,7 @@ async def strava_json(id: str):
         )
 
 @strava_router.get("/stravajson/{path}")
-async def get_strava_data(id: str, path: str):
+async def get_strava_data(id: str, path: str, request: Request):
     """
     Get Strava analytics data. Use hyphen-separated paths to access nested values.
     
@@ -204,21 +206,40 @@ async def get_strava_data(id: str, path: str):
     - /stravajson/streaks-current_streak  >> dic['streaks']['current_streak']
     """
     try:
-        file_path = f"data/activity_data/{id}.json"
-        if not os.path.exists(file_path):
-            return {"status": "failed", "message": f"File {file_path} does not exist"}
+        # Leaves are pre-serialized (and precompressed) at recompute time, streamed from disk as they are (from memory with ANALYTICS_STORE=postgres)
+        artifact = await analytics_store.get_artifact(id, path, request.headers.get("accept-encoding", ""))
+        if artifact is not None:
+            headers = validator_headers(strong_etag(artifact.content_hash, artifact.encoding), artifact.last_modified,
+                                        cache_control.for_path(request.url.path), vary="Accept-Encoding")
+            if is_not_modified(request.headers, headers["ETag"], artifact.last_modified):
+                return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+            if artifact.encoding:
+                headers["Content-Encoding"] = artifact.encoding
+            if artifact.path is None:
+                return Response(content=artifact.body, media_type="text/html; charset=utf-8", headers=headers)
+            return FileResponse(artifact.path, media_type="text/html; charset=utf-8", headers=headers)
 
         try:
-            with open(file_path, 'r') as f:
-                data = json.load(f)
+            # Documents written before the leaf artifacts existed, validated as a whole document
+            validators = await analytics_store.get_validators(id)
+            if validators is None:
+                return {"status": "failed", "message": f"File {analytics_store.path(id)} does not exist"}
+            etag = strong_etag(hashlib.sha256(f"{validators.content_hash}:{path}".encode()).hexdigest())
+            headers = validator_headers(etag, validators.last_modified, cache_control.for_path(request.url.path))
+            if is_not_modified(request.headers, etag, validators.last_modified):
+                return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
 
-                nested_data = get_nested_value(data, path)
-                if nested_data is None:
-                    raise HTTPException(status_code=404, detail=f"Path '{path}' not found")
-                return HTMLResponse(content=nested_data)
+            data = await analytics_store.get(id)
+            if data is None:
+                return {"status": "failed", "message": f"File {analytics_store.path(id)} does not exist"}
+
+            nested_data = get_nested_value(data, path)
+            if nested_data is None:
+                raise HTTPException(status_code=404, detail=f"Path '{path}' not found")
+            return HTMLResponse(content=nested_data, headers=headers)
 
         except json.JSONDecodeError:
-            logger.error(f"Invalid JSON in file: {file_path}")
+            logger.error(f"Invalid JSON in file: {analytics_store.path(id)}")
             raise HTTPException(
                 status_code=500,
                 detail="Error reading activity data"
@@ -232,29 +253,115 @@ async def get_strava_data(id: str, path: str):
             detail=f"Internal server error"
         )
 
-@strava_router.get('/strava-charts')
-async def strava_charts(id: str):
+async def load_chart_embeds(id: str):
     """
-    Get Strava charts for a given Strava ID
+    Chart embeds of a hashed Strava ID as (dic, body, etag, last_modified), kept per worker for CHART_CACHE_TTL seconds
 
     import asyncio
     asyncio.run(db.connect())
     id = "4ik41YnN0F"
     json_output = asyncio.run(db.fetch_all(f"SELECT strava_id, chart_identifier_id, chart_id, chart_title, web_link, embed_code_responsive, embed_code_web_component FROM main.strava_charts WHERE strava_hashed_id = $1", str(id)))
     """
-    try:
-        json_output = await db.fetch_all(f"SELECT strava_id, chart_identifier_id, chart_id, chart_title, web_link, embed_code_responsive, embed_code_web_component FROM main.strava_charts WHERE strava_hashed_id = $1", str(id))
+    cached = chart_cache.get(id)
+    if cached is None:
+        json_output = await db.fetch_all(f"SELECT strava_id, chart_identifier_id, chart_id, chart_title, web_link, embed_code_responsive, embed_code_web_component, updated_at FROM main.strava_charts WHERE strava_hashed_id = $1 AND embed_code_responsive <> ''", str(id))
         dic = {}
         for row in json_output: 
             dic[row['chart_identifier_id']] = {'embed_code_responsive': row['embed_code_responsive'], 'embed_code_web_component': row['embed_code_web_component']}
-        return JSONResponse(content=dic)
+        body = JSONResponse(content=dic).body
+        last_modified = max((row['updated_at'].timestamp() for row in json_output if row['updated_at']), default=None)
+        cached = (dic, body, strong_etag(hashlib.sha256(body).hexdigest()), last_modified)
+        chart_cache.set(id, cached)
+    return cached
+
+@strava_router.get('/strava-charts')
+async def strava_charts(id: str, request: Request):
+    """
+    Get Strava charts for a given Strava ID
+    """
+    try:
+        _, body, etag, last_modified = await load_chart_embeds(id)
+        headers = validator_headers(etag, last_modified, cache_control.for_path(request.url.path))
+        if is_not_modified(request.headers, etag, last_modified):
+            return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
     except Exception as e:
         logger.exception(f"Error processing Strava charts request: {str(e)}")
         raise HTTPException(
             status_code=500,
             detail=f"Internal server error"
         )
+
+MAX_DASHBOARD_PATHS = 50
+
+@strava_router.get('/strava-dashboard')
+async def strava_dashboard(request: Request, id: str, paths: Optional[List[str]] = Query(None), charts: bool = False,
+                           chart_fields: Optional[List[str]] = Query(None)):
+    """
+    Everything a dashboard page needs in one response, from the per-worker caches of /stravajson and /strava-charts.
+    paths (repeated or comma separated, hyphen-separated like /stravajson/{path}) selects parts of the analytics document,
+    the whole document when omitted. charts=true adds the chart embeds, chart_fields keeps only some of their fields.
+
+    Examples:
+    - /strava-dashboard?id=4ik41YnN0F&paths=summary  >> {"data": {"summary": {...}}, "missing": []}
+    - /strava-dashboard?id=4ik41YnN0F&paths=first_name,latest_activity-date&charts=true&chart_fields=embed_code_responsive
+      >> {"data": {"first_name": ..., "latest_activity": {"date": ...}}, "missing": [], "charts": {"chart1": {"embed_code_responsive": ...}}}
+    """
+    try:
+        paths = [path for value in paths or [] for path in value.split(",") if path]
+        chart_fields = [field for value in chart_fields or [] for field in value.split(",") if field]
+        if len(paths) > MAX_DASHBOARD_PATHS:
+            raise HTTPException(status_code=400, detail=f"At most {MAX_DASHBOARD_PATHS} paths per request")
+
+        try:
+            validators = await analytics_store.get_validators(id)
+            if validators is None:
+                return {"status": "failed", "message": f"File {analytics_store.path(id)} does not exist"}
+            chart_embeds = await load_chart_embeds(id) if charts else None
+
+            # One representation per document version, chart embeds version and selection
+            etag_source = json.dumps([validators.content_hash, chart_embeds[2] if chart_embeds else None, paths, chart_fields])
+            last_modified = max(filter(None, [validators.last_modified, chart_embeds[3] if chart_embeds else None]))
+            etag = strong_etag(hashlib.sha256(etag_source.encode()).hexdigest())
+            headers = validator_headers(etag, last_modified, cache_control.for_path(request.url.path))
+            if is_not_modified(request.headers, etag, last_modified):
+                return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+
+            data = await analytics_store.get(id)
+            if data is None:
+                return {"status": "failed", "message": f"File {analytics_store.path(id)} does not exist"}
+            selected, missing = select_nested_values(data, paths) if paths else (data, [])
+            content = {"data": selected, "missing": missing}
+            if chart_embeds is not None:
+                content["charts"] = {chart: {field: value for field, value in embed.items() if not chart_fields or field in chart_fields}
+                                     for chart, embed in chart_embeds[0].items()}
+            return JSONResponse(content=content, headers=headers)
+
+        except json.JSONDecodeError:
+            logger.error(f"Invalid JSON in file: {analytics_store.path(id)}")
+            raise HTTPException(
+                status_code=500,
+                detail="Error reading activity data"
+            )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"Error processing Strava dashboard request: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail="Internal server error"
+        )
     
+@strava_router.get('/strava-metrics')
+async def strava_metrics():
+    """
+    Counters of this worker's in-process caches and schedulers (each uvicorn worker reports its own), job queue depth/latency is shared
+    """
+    return {"analytics_debouncer": analytics_debouncer.stats(), "strava_tokens": strava_tokens.counters, "strava_rate_limit": strava.rate_limiter.stats(),
+            "job_queue": await job_queue.stats(), "activity_cache": activity_cache.counters if activity_cache is not None else None,
+            "analytics_store": analytics_store.stats(), "chart_cache": chart_cache.counters,
+            "upstreams": {"strava": strava.upstream.stats(), "datawrapper": dw.upstream.stats()}}
+
 @strava_router.post('/text2sql')
 async def text2sql(request: Request):
     """
@@ -8,6 +8,8 @@ CREATE TABLE IF NOT EXISTS main.botdata_v2 (
     strava_firstname TEXT,
     strava_lastname TEXT,
     refresh_token VARCHAR(255),
+    access_token VARCHAR(255),
+    expires_at TIMESTAMP WITH TIME ZONE,
     -- Approval flags (using boolean instead of SMALLINT for clarity)
     strava_approval BOOLEAN DEFAULT FALSE,
     -- Timestamps
@@ -16,6 +18,10 @@ CREATE TABLE IF NOT EXISTS main.botdata_v2 (
     last_active_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Access token cache columns for tables created before they were added
+ALTER TABLE main.botdata_v2 ADD COLUMN IF NOT EXISTS access_token VARCHAR(255);
+ALTER TABLE main.botdata_v2 ADD COLUMN IF NOT EXISTS expires_at TIMESTAMP WITH TIME ZONE;
+
 CREATE INDEX IF NOT EXISTS idx_strava_id ON main.botdata_v2(strava_id);
 CREATE INDEX IF NOT EXISTS idx_created_at ON main.botdata_v2(created_at);
 
@@ -111,16 +117,31 @@ CREATE TABLE main.strava_charts (
     web_link TEXT NOT NULL,
     embed_code_responsive TEXT NOT NULL,
     embed_code_web_component TEXT NOT NULL,
+    spec_hash VARCHAR(64),
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP WITH TIME ZONE,
     CONSTRAINT strava_charts_pkey PRIMARY KEY (strava_id, chart_identifier_id)
 );
+-- Hash of the chart's title, type, data link and settings, provisioning only calls Datawrapper when it changes. NULL (with empty
+-- embed codes) while a created chart is not published yet, the next provisioning reconfigures it instead of creating another one
+ALTER TABLE main.strava_charts ADD COLUMN IF NOT EXISTS spec_hash VARCHAR(64);
 
 -- Index for faster lookups
 CREATE INDEX idx_strava_charts_hashed_id ON main.strava_charts(strava_hashed_id);
 -- DROP TABLE IF EXISTS main.strava_charts CASCADE;
 -- DROP INDEX IF EXISTS idx_strava_charts_hashed_id;
 
+-- Per athlete analytics aggregates (see utils_analytics.aggregate_activities), webhook events are applied to them as deltas
+CREATE TABLE IF NOT EXISTS main.strava_analytics_state (
+    strava_id VARCHAR(255) PRIMARY KEY,
+    aggregates JSONB NOT NULL,
+    version BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+-- Bumped by every write, baseline_analytics drops a snapshot when a delta landed while it was computing it
+ALTER TABLE main.strava_analytics_state ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
+-- DROP TABLE IF EXISTS main.strava_analytics_state CASCADE;
+
 CREATE TABLE main.known_good_queries (
     id SERIAL PRIMARY KEY,
     user_question TEXT NOT NULL UNIQUE,
@@ -133,3 +154,46 @@ CREATE TABLE main.known_good_queries (
 
 -- DROP TABLE IF EXISTS main.known_good_queries CASCADE;
 -- DROP INDEX IF EXISTS idx_query_embedding;
+
+-- Durable background jobs (see utils_jobs.JobQueue), status: queued | running | done | failed
+CREATE TABLE IF NOT EXISTS main.job_queue (
+    id BIGSERIAL PRIMARY KEY,
+    job_type VARCHAR(100) NOT NULL,
+    payload JSONB NOT NULL DEFAULT '{}',
+    dedupe_key VARCHAR(255),
+    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+    priority SMALLINT NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 5,
+    run_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    locked_by VARCHAR(255),
+    last_error TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP WITH TIME ZONE,
+    finished_at TIMESTAMP WITH TIME ZONE
+);
+
+-- Claim order for pending jobs, and at most one queued job per dedupe_key
+CREATE INDEX IF NOT EXISTS idx_job_queue_pending ON main.job_queue(priority, run_at) WHERE status = 'queued';
+CREATE UNIQUE INDEX IF NOT EXISTS idx_job_queue_dedupe ON main.job_queue(dedupe_key) WHERE status = 'queued';
+CREATE INDEX IF NOT EXISTS idx_job_queue_running ON main.job_queue(dedupe_key) WHERE status = 'running';
+-- DROP TABLE IF EXISTS main.job_queue CASCADE;
+
+-- Dashboard JSON per athlete when ANALYTICS_STORE=postgres (see utils_analytics_store.PostgresAnalyticsStore), the aggregations sections
+-- are also kept pre-serialized in their own columns, version is bumped on every write so that workers can revalidate their cached copy
+CREATE TABLE IF NOT EXISTS main.strava_analytics (
+    strava_hashed_id VARCHAR(50) PRIMARY KEY,
+    document JSONB NOT NULL,
+    content_hash VARCHAR(64) NOT NULL,
+    weekly_stats TEXT,
+    monthly_stats TEXT,
+    weekday_stats TEXT,
+    distance_distribution TEXT,
+    yearly_stats TEXT,
+    workout_composition_count TEXT,
+    workout_composition_percentage TEXT,
+    heatmap_json TEXT,
+    version BIGINT NOT NULL DEFAULT 1,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+-- DROP TABLE IF EXISTS main.strava_analytics CASCADE;
@@ -26,18 +26,15 @@ def custom_hash(id: str) -> str:
     
     return result[:10]
 
-def format_week_year_to_readable_dates(row):
+def format_week_years_to_readable_dates(iso_years, weeks):
     """
-    Format the start and end dates of a week given a year and week number
+    Format the start and end dates of each week given columns of ISO years and week numbers, e.g. 2024, 1 >> "01 Jan - 07 Jan 24"
+    format_week_years_to_readable_dates(weekly_stats['IsoYear'], weekly_stats['Week'])
     """
-    # Create a date from year and week number
-    year = int(row['IsoYear'])
-    week = int(row['Week'])
-    start_date = pd.to_datetime(f"{year}-W{week:02d}-1", format='%G-W%V-%u')
-    end_date = start_date + pd.Timedelta(days=6)
-    
-    # Format the dates
-    return f"{start_date.strftime('%d %b')} - {end_date.strftime('%d %b %y')}"
+    iso_years, weeks = pd.Series(iso_years).astype("int64"), pd.Series(weeks).astype("int64")
+    start_dates = pd.to_datetime(iso_years.astype(str) + "-W" + weeks.astype(str).str.zfill(2) + "-1", format='%G-W%V-%u')
+    end_dates = start_dates + pd.Timedelta(days=6)
+    return start_dates.dt.strftime('%d %b') + " - " + end_dates.dt.strftime('%d %b %y')
 
 
 def get_nested_value(data_dict, path):
@@ -56,4 +53,27 @@ def get_nested_value(data_dict, path):
        
        return result
    except (KeyError, TypeError):
-       return None
\ No newline at end of file
+       return None
+
+def select_nested_values(data_dict, paths):
+    """
+    Subset of a nested dictionary for a list of path strings, keeping its shape, and the paths that do not exist
+    select_nested_values(data, ['summary', 'latest_activity-date'])  >> ({'summary': {...}, 'latest_activity': {'date': ...}}, [])
+    """
+    selected, missing, taken = {}, [], set()
+    # Shortest first, a path inside an already selected subtree is skipped, so no value of data_dict is ever modified
+    for path in sorted(dict.fromkeys(paths), key=lambda path: path.count('-')):
+        keys = path.split('-')
+        if any('-'.join(keys[:i]) in taken for i in range(1, len(keys))):
+            continue
+        value = get_nested_value(data_dict, path)
+        if value is None:
+            missing.append(path)
+            continue
+        taken.add(path)
+        *parents, leaf = keys
+        node = selected
+        for key in parents:
+            node = node.setdefault(key, {})
+        node[leaf] = value
+    return selected, missing
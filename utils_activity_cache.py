@@ -0,0 +1,165 @@
+"""
+Per-athlete columnar cache of the activity columns the analytics use, so a recompute loads a memory-mapped NumPy file
+instead of round tripping every activity row through asyncpg and Python dicts.
+
+Each athlete has one structured .npy file named after a fingerprint of their stored activities (row count, latest updated_at
+and the set of activity ids). Any change to the rows changes the fingerprint, so a stale file is never read, it is simply not
+found and rebuilt. Webhook upserts and soft deletes patch the file instead (patch_activity), bulk syncs drop it (invalidate).
+No app_instance import, load_activity_frame runs in the analytics worker processes.
+
+activity_cache = ActivityColumnCache("data/activity_cache")
+path = asyncio.run(activity_cache.ensure(db, 28923822))
+analytics_results, aggregates = compute_cached_analytics(path, first_name="Kenny")
+"""
+import asyncio
+import glob
+import hashlib
+import os
+import tempfile
+from datetime import timezone
+from typing import Any, Dict, Optional
+import numpy as np
+import pandas as pd
+from loguru import logger
+from utils import custom_hash
+from utils_analytics import compute_analytics_and_aggregates
+
+# Bump when the columns or dtypes change, files of an older version are never matched
+CACHE_VERSION = 1
+CACHE_DTYPE = np.dtype(
+    [
+        ("activity_id", "U32"),
+        ("type", "U32"),  # "" for NULL
+        ("distance", "f8"),  # NaN for NULL
+        ("moving_time", "f8"),
+        ("total_elevation_gain", "f8"),
+        ("kudos_count", "f8"),
+        ("start_date", "M8[us]"),  # NaT for NULL
+        ("start_date_local", "M8[us]"),
+    ]
+)
+CACHE_COLUMNS = list(CACHE_DTYPE.names)
+
+FINGERPRINT_QUERY = (
+    "SELECT COUNT(*) AS rows, MAX(updated_at) AS updated_at, COALESCE(SUM(hashtext(activity_id)::bigint), 0) AS ids "
+    "FROM main.strava_activities WHERE strava_id = $1 AND is_deleted = FALSE"
+)
+
+
+def rows_to_array(rows) -> np.ndarray:
+    """main.strava_activities rows (dicts with at least CACHE_COLUMNS) to a CACHE_DTYPE array"""
+    array = np.empty(len(rows), dtype=CACHE_DTYPE)
+    for column in CACHE_COLUMNS:
+        values = [row[column] for row in rows]
+        if column == "type":
+            values = ["" if value is None else value for value in values]
+        elif column == "activity_id":
+            values = [str(value) for value in values]
+        elif CACHE_DTYPE[column].kind == "f":
+            values = [np.nan if value is None else value for value in values]
+        else:
+            values = [np.datetime64("NaT") if value is None else np.datetime64(value.replace(tzinfo=None), "us") for value in values]
+        array[column] = values
+    return array
+
+
+def load_activity_frame(path: str) -> pd.DataFrame:
+    """The cached activities as the DataFrame aggregate_activities expects, read through a memory map"""
+    array = np.load(path, mmap_mode="r")
+    frame = pd.DataFrame({column: array[column] for column in CACHE_COLUMNS})
+    frame["type"] = frame["type"].where(frame["type"] != "", None)
+    return frame
+
+
+def compute_cached_analytics(path: str, first_name: str, tz=timezone.utc):
+    """compute_analytics_and_aggregates over a cache file, in the analytics worker process only the path crosses the process boundary"""
+    return compute_analytics_and_aggregates(load_activity_frame(path), first_name, tz)
+
+
+def _fingerprint(row) -> str:
+    updated_at = row["updated_at"].isoformat() if row["updated_at"] else ""
+    return hashlib.sha1(f"{CACHE_VERSION}:{row['rows']}:{updated_at}:{row['ids']}".encode()).hexdigest()[:16]
+
+
+def _save(path: str, array: np.ndarray) -> None:
+    # Written next to the target then renamed, readers never see a partial file. Unique per write, like _atomic_write of the analytics store
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class ActivityColumnCache:
+    """On disk .npy cache of each athlete's non deleted activities (only the columns the analytics use)"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.counters = {"hits": 0, "misses": 0, "patches": 0, "invalidations": 0}
+
+    async def fingerprint(self, db, strava_id) -> str:
+        return _fingerprint(await db.fetch_one(FINGERPRINT_QUERY, str(strava_id)))
+
+    def path(self, strava_id, fingerprint: str) -> str:
+        return os.path.join(self.directory, f"{custom_hash(str(strava_id))}-{fingerprint}.npy")
+
+    def _remove_stale(self, strava_id, keep: Optional[str] = None) -> None:
+        for path in glob.glob(os.path.join(self.directory, f"{custom_hash(str(strava_id))}-*.npy")):
+            if path != keep:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    async def ensure(self, db, strava_id) -> str:
+        """Path of an up to date cache file for the athlete, built from the database when missing"""
+        async with db.transaction() as conn:
+            # One snapshot for the fingerprint and the rows, so the file matches the name it is saved under
+            await conn.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            path = self.path(strava_id, _fingerprint(await conn.fetchrow(FINGERPRINT_QUERY, str(strava_id))))
+            if os.path.exists(path):
+                self.counters["hits"] += 1
+                return path
+            self.counters["misses"] += 1
+            rows = await conn.fetch(
+                f"SELECT {', '.join(CACHE_COLUMNS)} FROM main.strava_activities WHERE strava_id = $1 AND is_deleted = FALSE", str(strava_id)
+            )
+        array = await asyncio.to_thread(rows_to_array, rows)
+        await asyncio.to_thread(_save, path, array)
+        self._remove_stale(strava_id, keep=path)
+        logger.info(f"Activity cache rebuilt for {strava_id} ({len(array)} activities)")
+        return path
+
+    async def patch_activity(self, db, strava_id, row: Optional[Dict[str, Any]], activity_id, fingerprint_before: str) -> bool:
+        """
+        Applies one activity upsert or soft delete (row is its fetch_activity_for_analytics row after the change, None or is_deleted for
+        a delete) to the athlete's cache file. fingerprint_before is the fingerprint taken before the change was written: when the file
+        does not match it, another change got in between and the file is dropped instead (the next ensure rebuilds it).
+        """
+        path_before = self.path(strava_id, fingerprint_before)
+        async with db.transaction() as conn:
+            # Patches of the same athlete (from any worker process) take turns, so two of them never write the same file
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext($1))", f"activity_cache:{strava_id}")
+            fingerprint_after = _fingerprint(await conn.fetchrow(FINGERPRINT_QUERY, str(strava_id)))
+            try:
+                array = await asyncio.to_thread(np.load, path_before)
+            except FileNotFoundError:
+                self.invalidate(strava_id)
+                return False
+            array = array[array["activity_id"] != str(activity_id)]
+            if row is not None and not row.get("is_deleted"):
+                array = np.concatenate([array, rows_to_array([row])])
+            path_after = self.path(strava_id, fingerprint_after)
+            await asyncio.to_thread(_save, path_after, array)
+            self._remove_stale(strava_id, keep=path_after)
+        self.counters["patches"] += 1
+        return True
+
+    def invalidate(self, strava_id) -> None:
+        """Drops the athlete's cache file, after bulk writes to their activities"""
+        self.counters["invalidations"] += 1
+        self._remove_stale(strava_id)
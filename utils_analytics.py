@@ -0,0 +1,409 @@
+"""
+Pure analytics computations, no app_instance import so they can run in a worker process (see baseline_analytics)
+
+The dashboard JSON is computed in two steps: aggregate_activities reduces an athlete's activities to small JSON serializable aggregates
+(per year, month, ISO week, weekday, hour, distance bucket and day, plus records), and render_analytics turns those into the JSON.
+The aggregates are kept in main.strava_analytics_state, so a single created / updated / deleted activity is applied as a delta
+(apply_activity_delta) instead of recomputing from every activity.
+"""
+import math
+from bisect import bisect_right
+from datetime import date, datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+import pandas as pd
+from utils import format_week_years_to_readable_dates
+
+weekday_mapping_dic = {0: 'Monday', 1: 'Tuesday', 2: 'Wednesday', 3: 'Thursday', 4: 'Friday', 5: 'Saturday', 6: 'Sunday'}
+month_mapping_dic = {1:'Jan', 2:'Feb', 3:'Mar', 4:'Apr', 5:'May', 6:'Jun',
+               7:'Jul', 8:'Aug', 9:'Sep', 10:'Oct', 11:'Nov', 12:'Dec'}
+
+RUNNING_TYPES = ["Run", "VirtualRun"]
+distance_bins = [0, 2.5, 5, 8, 10, 15, 21.0975, 25, 30, 42.195, 50, float("inf")]
+distance_labels = ["Under 2.5km", "2.5km", "5km", "8km", "10km", "15km", "Half Marathon", "25km", "30km", "Marathon", "50km+"]
+
+# Bump when the aggregates layout changes, stored aggregates of an older version are rebuilt
+AGGREGATES_VERSION = 2
+
+# Summed tables: key parts and the summed values (the first value is always the row count, a key is dropped when it reaches 0).
+# Every sum is an integer (distances and elevations in millimetres, times in seconds), so adding and removing activities gives exactly
+# a fresh sum, float sums would drift and eventually flip a rounded figure
+AGGREGATE_TABLES = {
+    "type_year": (["Year", "type"], ["n"]),
+    "run_year": (["Year"], ["n", "distance_mm", "moving_time", "kudos_count", "elevation_mm"]),
+    "run_month": (["Year", "Month"], ["n", "distance_mm"]),
+    "run_week": (["IsoYear", "Week"], ["n", "distance_mm", "moving_time"]),
+    "run_weekday": (["Weekday"], ["n", "distance_mm", "moving_time", "elevation_mm"]),
+    "run_hour": (["Hour"], ["n"]),
+    "run_bucket": (["Year", "distance_type"], ["n"]),
+    "run_dates": (["date"], ["n"]),
+}
+# Columns render_analytics works with, converted from the integer sums: column -> (summed value, divisor)
+RENDERED_SUMS = {"distance_km": ("distance_mm", 1_000_000), "moving_time_hours": ("moving_time", 3600), "total_elevation_gain": ("elevation_mm", 1000)}
+KEY_TYPES = {"Year": int, "Month": int, "IsoYear": int, "Week": int, "Hour": int}
+RECORDS = {"longest_run": "distance_km", "fastest_pace": "pace", "highest_elevation": "total_elevation_gain"}
+
+
+class AnalyticsRebuildRequired(Exception):
+    """The delta cannot be applied to the aggregates (e.g. the activity held a record, or the year rolled over), recompute from all activities"""
+
+
+def _key(*parts) -> str:
+    return "|".join(str(part) for part in parts)
+
+
+def _finite(value) -> Optional[float]:
+    return float(value) if value is not None and math.isfinite(value) else None
+
+
+def _millimetres(metres) -> int:
+    """Metres as whole millimetres, half up (same as FLOOR(x * 1000 + 0.5) in utils_analytics_sql)"""
+    return math.floor(metres * 1000 + 0.5) if metres else 0
+
+
+def aggregate_activities(activities: List[Dict[str, Any]], now: Optional[datetime] = None) -> Dict[str, Any]:
+    """
+    Reduce the athlete's non deleted main.strava_activities rows (dicts, or a DataFrame from the activity cache) to the aggregates
+    rendered by render_analytics.
+
+    activities = asyncio.run(db.fetch_all("SELECT * FROM main.strava_activities WHERE strava_id = $1 and is_deleted = false", str(strava_id)))
+    aggregates = aggregate_activities(activities)
+    """
+    current_year = (now or datetime.now()).year
+    full_df = pd.DataFrame(activities)
+
+    # temp
+    full_df = full_df.sort_values(by="start_date_local", ascending=False)
+
+    # Basic Transformation
+    start_date_local = pd.to_datetime(full_df["start_date_local"])
+    iso_calendar = start_date_local.dt.isocalendar()
+    full_df = (
+        full_df.assign(
+            start_date_local=start_date_local,
+            Weekday=start_date_local.dt.dayofweek.map(weekday_mapping_dic),
+            Year=start_date_local.dt.year,
+            IsoYear=iso_calendar["year"],
+            Month=start_date_local.dt.month,
+            Week=iso_calendar["week"],
+            Hour=start_date_local.dt.hour,
+            distance_km=lambda df: df["distance"] / 1000,
+            # Whole millimetres like _millimetres, the other summed columns are whole numbers already
+            distance_mm=lambda df: ((df["distance"].astype("float64").fillna(0) * 1000 + 0.5) // 1).astype("int64"),
+            elevation_mm=lambda df: ((df["total_elevation_gain"].astype("float64").fillna(0) * 1000 + 0.5) // 1).astype("int64"),
+        )
+        .query("Year >= 2000")
+    )
+
+    # Running-specific analytics
+    running_df = full_df[full_df["type"].isin(RUNNING_TYPES)].assign(
+        distance_type=lambda df: pd.cut(df["distance_km"], bins=distance_bins, labels=distance_labels, right=False).astype(str),
+        date=lambda df: df["start_date_local"].dt.date.astype(str),
+        pace=lambda df: (df["moving_time"] / 60) / df["distance_km"],
+    )
+
+    aggregates = {"version": AGGREGATES_VERSION, "current_year": current_year, "total_activities": int(len(full_df))}
+    for table, (keys, values) in AGGREGATE_TABLES.items():
+        source_df = full_df if table == "type_year" else running_df
+        grouped = source_df.groupby(keys).agg(n=(keys[0], "size"), **{value: (value, "sum") for value in values[1:]})
+        aggregates[table] = {
+            _key(*(key if isinstance(key, tuple) else (key,))): [int(value) for value in row]
+            for key, row in zip(grouped.index, grouped.itertuples(index=False))
+        }
+
+    # Heatmap of the current year's runs
+    current_year_running_df = running_df[running_df["Year"] == current_year]
+    # start_date is stored as UTC without a timezone, whole seconds since the epoch
+    epoch_times = ((pd.to_datetime(current_year_running_df["start_date"]) - pd.Timestamp(0)) // pd.Timedelta(seconds=1)).astype(str)
+    aggregates["heatmap"] = {
+        activity_id: [start_date_local, epoch_time, distance_km]
+        for activity_id, start_date_local, epoch_time, distance_km in zip(
+            current_year_running_df["activity_id"].astype(str).tolist(),
+            current_year_running_df["start_date_local"].dt.strftime("%Y-%m-%dT%H:%M:%S").tolist(),
+            epoch_times.tolist(),
+            current_year_running_df["distance_km"].astype(float).tolist(),
+        )
+    }
+
+    # Records and latest run, with the activity holding them (deleting it needs a rebuild)
+    latest_run = running_df.iloc[0] if len(running_df) else None
+    aggregates["latest_run"] = (
+        [latest_run["start_date_local"].isoformat(), float(latest_run["distance_km"]), latest_run["type"], str(latest_run["activity_id"])]
+        if latest_run is not None
+        else None
+    )
+    for record, column in RECORDS.items():
+        values = running_df[column].replace([float("inf"), float("-inf")], float("nan")).dropna()
+        if len(values) == 0:
+            aggregates[record] = None
+            continue
+        index = values.idxmin() if record == "fastest_pace" else values.idxmax()
+        aggregates[record] = [float(values[index]), str(running_df.loc[index, "activity_id"])]
+    return aggregates
+
+
+def _activity_facts(row: Optional[Dict[str, Any]], current_year: int) -> Optional[Dict[str, Any]]:
+    """Everything one activity row contributes to the aggregates, None for missing, deleted or pre 2000 activities"""
+    if row is None or row.get("is_deleted") or row.get("start_date_local") is None or row["start_date_local"].year < 2000:
+        return None
+    start_date_local = row["start_date_local"]
+    iso_year, week, _ = start_date_local.isocalendar()
+    distance_km = (row["distance"] or 0.0) / 1000
+    distance_mm = _millimetres(row["distance"])
+    moving_time = int(row["moving_time"] or 0)
+    elevation = row["total_elevation_gain"] or 0.0
+    elevation_mm = _millimetres(elevation)
+    contributions = [("type_year", _key(start_date_local.year, row["type"]), [1])]
+    facts = {"activity_id": str(row["activity_id"]), "is_run": row["type"] in RUNNING_TYPES, "contributions": contributions}
+    if not facts["is_run"]:
+        return facts
+
+    weekday = weekday_mapping_dic[start_date_local.weekday()]
+    distance_type = distance_labels[bisect_right(distance_bins, distance_km) - 1]
+    contributions += [
+        ("run_year", _key(start_date_local.year), [1, distance_mm, moving_time, int(row["kudos_count"] or 0), elevation_mm]),
+        ("run_month", _key(start_date_local.year, start_date_local.month), [1, distance_mm]),
+        ("run_week", _key(iso_year, week), [1, distance_mm, moving_time]),
+        ("run_weekday", _key(weekday), [1, distance_mm, moving_time, elevation_mm]),
+        ("run_hour", _key(start_date_local.hour), [1]),
+        ("run_bucket", _key(start_date_local.year, distance_type), [1]),
+        ("run_dates", _key(start_date_local.date().isoformat()), [1]),
+    ]
+    facts.update(
+        start_date_local=start_date_local.isoformat(),
+        type=row["type"],
+        distance_km=distance_km,
+        pace=_finite((moving_time / 60) / distance_km) if distance_km else None,
+        total_elevation_gain=elevation,
+        heatmap=None,
+    )
+    if start_date_local.year == current_year:
+        # start_date is stored as UTC without a timezone
+        epoch_time = str(int(row["start_date"].replace(tzinfo=timezone.utc).timestamp()))
+        facts["heatmap"] = [start_date_local.isoformat(), epoch_time, distance_km]
+    return facts
+
+
+def apply_activity_delta(
+    aggregates: Dict[str, Any], old_row: Optional[Dict[str, Any]], new_row: Optional[Dict[str, Any]], now: Optional[datetime] = None
+) -> bool:
+    """
+    Apply one activity change to the aggregates in place: a create (old_row None), an update, or a delete (new_row None or is_deleted).
+    Rows are main.strava_activities rows, before and after the change. Returns False when nothing the analytics use has changed.
+
+    Raises AnalyticsRebuildRequired when the aggregates cannot be updated on their own: the removed activity held a record or was the
+    latest run, the current year rolled over (heatmap), or the aggregates are of an older layout.
+    """
+    current_year = (now or datetime.now()).year
+    if aggregates.get("version") != AGGREGATES_VERSION or aggregates["current_year"] != current_year:
+        raise AnalyticsRebuildRequired("aggregates are outdated")
+    old, new = _activity_facts(old_row, current_year), _activity_facts(new_row, current_year)
+    if old == new:
+        return False
+
+    if old is not None and old["is_run"]:
+        holders = [aggregates[record][1] for record in RECORDS if aggregates[record]] + [(aggregates["latest_run"] or [None] * 4)[3]]
+        if old["activity_id"] in holders:
+            raise AnalyticsRebuildRequired(f"activity {old['activity_id']} holds a record")
+
+    # Streaks computed by Postgres (ANALYTICS_MODE=sql) are not maintained here, render_analytics recomputes them from run_dates
+    aggregates.pop("streaks", None)
+    for facts, sign in ((old, -1), (new, 1)):
+        if facts is None:
+            continue
+        aggregates["total_activities"] += sign
+        for table, key, values in facts["contributions"]:
+            entry = aggregates[table].setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                entry[i] += sign * value
+            if entry[0] == 0:
+                del aggregates[table][key]
+        if not facts["is_run"]:
+            continue
+
+        if sign < 0:
+            aggregates["heatmap"].pop(facts["activity_id"], None)
+            continue
+        if facts["heatmap"]:
+            aggregates["heatmap"][facts["activity_id"]] = facts["heatmap"]
+        latest_run = aggregates["latest_run"]
+        if latest_run is None or facts["start_date_local"] > latest_run[0]:
+            aggregates["latest_run"] = [facts["start_date_local"], facts["distance_km"], facts["type"], facts["activity_id"]]
+        for record, column in RECORDS.items():
+            value, held = facts[column], aggregates[record]
+            if value is not None and (held is None or (value < held[0] if record == "fastest_pace" else value > held[0])):
+                aggregates[record] = [value, facts["activity_id"]]
+    return True
+
+
+def _frame(aggregates: Dict[str, Any], table: str) -> pd.DataFrame:
+    keys, values = AGGREGATE_TABLES[table]
+    table = sorted(
+        ([KEY_TYPES.get(name, str)(part) for name, part in zip(keys, key.split("|", len(keys) - 1))], entry)
+        for key, entry in aggregates[table].items()
+    )
+    key_columns, value_columns = list(zip(*(key for key, _ in table))) or [()] * len(keys), list(zip(*(entry for _, entry in table))) or [()] * len(values)
+    frame = pd.DataFrame({**dict(zip(keys, key_columns)), **dict(zip(values, value_columns))}, columns=keys + values)
+    return frame.assign(**{column: frame[value] / divisor for column, (value, divisor) in RENDERED_SUMS.items() if value in values})
+
+
+def render_analytics(aggregates: Dict[str, Any], first_name: str, tz=timezone.utc) -> Dict[str, Any]:
+    """Build the dashboard JSON (served by /stravajson) from aggregate_activities / apply_activity_delta aggregates"""
+    # Workout Type Breakdown
+    workout_breakdown = _frame(aggregates, "type_year").pivot(index="Year", columns="type", values="n").fillna(0)
+    workout_percentages = (workout_breakdown.div(workout_breakdown.sum(axis=1), axis=0) * 100).round(1)
+    workout_activity_lst = workout_breakdown.columns.tolist()
+    run_year = _frame(aggregates, "run_year").set_index("Year")
+
+    # Heatmap json
+    heatmap = sorted(aggregates["heatmap"].values(), reverse=True)
+    heatmap_epochs, heatmap_distances = zip(*((epoch_time, distance_km) for _, epoch_time, distance_km in heatmap)) if heatmap else ((), ())
+    heatmap_series = pd.Series(heatmap_distances, index=list(heatmap_epochs), dtype="float64").astype("int64")
+
+    # Calculate running streaks
+    dates = sorted(date.fromisoformat(run_date) for run_date in aggregates["run_dates"])
+    gaps = [(later - earlier).days for earlier, later in zip(dates, dates[1:])]
+    streak_lengths = [1]
+    for gap in gaps:
+        if gap == 1:
+            streak_lengths[-1] += 1
+        else:
+            streak_lengths.append(1)
+
+    # Distance categorization
+    distance_distribution = (
+        _frame(aggregates, "run_bucket")
+        .pivot(index="Year", columns="distance_type", values="n")
+        .reindex(index=run_year.index, columns=pd.CategoricalIndex(distance_labels, categories=distance_labels, name="distance_type"))
+        .fillna(0)
+        .astype("int64")
+        .transpose()
+    )
+
+    # Weekly and monthly aggregations
+    # Get the latest date and create a range of the last 20 weeks
+    run_week = _frame(aggregates, "run_week")
+    max_year = run_week["IsoYear"].max()
+    max_week = run_week[run_week["IsoYear"] == max_year]["Week"].max()
+    latest_date = pd.to_datetime(f"{max_year}-{max_week:02d}-0", format="%Y-%U-%w")
+    date_range = pd.date_range(end=latest_date, periods=20, freq="W-SUN")
+    complete_weeks = pd.DataFrame({"IsoYear": date_range.year, "Week": date_range.isocalendar().week})
+
+    weekly_stats = (
+        run_week.astype({"IsoYear": "UInt32", "Week": "UInt32"})
+        .set_index(["IsoYear", "Week"])[["distance_km", "moving_time_hours"]]
+        .round(2)
+        .rename(columns={"distance_km": "Distance (km)", "moving_time_hours": "Time (h)"})
+        .reset_index()
+        .merge(complete_weeks, on=["IsoYear", "Week"], how="right")
+        .fillna(0)
+        .sort_values(["IsoYear", "Week"])
+    )
+    weekly_stats["WeekFormat"] = format_week_years_to_readable_dates(weekly_stats["IsoYear"], weekly_stats["Week"]).to_numpy()
+
+    # Monthly Stats
+    monthly_stats = _frame(aggregates, "run_month")[["Year", "Month", "distance_km"]].rename(columns={"distance_km": "Distance (km)"})
+    pivoted_monthly_stats = (
+        monthly_stats.pivot(index="Month", columns="Year", values="Distance (km)")
+        .reindex(range(1, 13))  # ensure all months are present
+        .fillna(0.0)  # Fill NaN with 0
+        .round(1)
+    )  # Round to 1 decimal place
+    pivoted_monthly_stats.index = pivoted_monthly_stats.index.map(month_mapping_dic)
+
+    # Time of day / weekday analysis, the mode is the smallest of the most common values
+    run_hour = {int(hour): entry[0] for hour, entry in aggregates["run_hour"].items()}
+    most_common_hour = min(hour for hour, count in run_hour.items() if count == max(run_hour.values()))
+    run_weekday = _frame(aggregates, "run_weekday").set_index("Weekday")
+    favorite_day = run_weekday.index[run_weekday["n"] == run_weekday["n"].max()].min()
+
+    weekday_stats = pd.DataFrame(
+        {
+            ("distance_km", "count"): run_weekday["n"].astype("int64"),
+            ("distance_km", "mean"): run_weekday["distance_km"] / run_weekday["n"],
+            ("distance_km", "sum"): run_weekday["distance_km"],
+            ("moving_time", "sum"): run_weekday["moving_time"].round().astype("int64"),
+            ("total_elevation_gain", "sum"): run_weekday["total_elevation_gain"],
+        }
+    ).round(2)
+
+    # Year-over-year comparisons
+    monthly_stats_pivot = monthly_stats.pivot(index="Year", columns="Month", values="Distance (km)").fillna(0)
+    yoy_comparison = (
+        run_year[["distance_km", "moving_time_hours", "kudos_count", "total_elevation_gain"]]
+        .astype({"kudos_count": "int64"})
+        .rename(
+            columns={
+                "distance_km": "RunningDistance (km)",
+                "moving_time_hours": "Time (h) spent running",
+                "kudos_count": "Kudos",
+                "total_elevation_gain": "Elevation (m)",
+            }
+        )
+        .merge(monthly_stats_pivot, on=["Year"], how="left")
+        .round(2)
+    )
+
+    latest_run, records = aggregates["latest_run"], {record: (aggregates[record] or [float("inf")])[0] for record in RECORDS}
+
+    # Compile results
+    analytics_results = {
+        "last_updated": datetime.now(timezone.utc).astimezone(tz).strftime("%d %B %Y, at %H:%M"),
+        "first_name": first_name,
+        "summary": {
+            "total_activities": str(int(aggregates["total_activities"])),
+            "total_distance": f"{float(run_year['distance_km'].sum()):.2f}",
+            "total_elevation": f"{float(run_year['total_elevation_gain'].sum()):.2f}",
+            "total_time": str(int(round(run_year["moving_time"].sum()))),
+            "total_kudos": str(int(round(run_year["kudos_count"].sum()))),
+            "total_distance_current_year": f"{float(sum(distance_km for _, _, distance_km in heatmap)):.2f}",
+        },
+        "streaks": aggregates.get("streaks")
+        or {
+            "running_max": max(streak_lengths),
+            "notrunning_max": max(gaps, default=1) - 1,
+            "current_streak": streak_lengths[-1],
+        },
+        "latest_activity": {
+            "date": datetime.fromisoformat(latest_run[0]).strftime("%d %B %Y, at %H:%M"),  # "13 December 2024, at 16:06"
+            "distance": f"{float(latest_run[1]):.2f}",
+            "type": latest_run[2],
+        },
+        "patterns": {
+            "most_common_hour": str(int(most_common_hour)),
+            "favorite_day": favorite_day,
+            "workout_types": workout_activity_lst,
+        },
+        "records": {
+            "longest_run": f"{float(records['longest_run']):.2f}",
+            "fastest_pace": f"{float(records['fastest_pace']):.2f}",
+            "highest_elevation": f"{float(records['highest_elevation']):.2f}",
+        },
+        "aggregations": {
+            "weekly_stats": weekly_stats[["WeekFormat", "Distance (km)", "Time (h)"]].to_csv(index=False),  # DONE
+            "monthly_stats": pivoted_monthly_stats.to_csv(),  # DONE
+            "weekday_stats": weekday_stats.to_csv(index=False),  # havent decided on visualization
+            "distance_distribution": distance_distribution.to_csv(),
+            "yearly_stats": yoy_comparison.to_csv(),  # DONE
+            "workout_composition_count": workout_breakdown.to_csv(index=False),  # NOT USED
+            "workout_composition_percentage": workout_percentages.to_csv(),  # DONE,
+            "heatmap_json": heatmap_series.to_json(orient="index"),
+        },
+    }
+    return analytics_results
+
+
+def compute_analytics_and_aggregates(activities: List[Dict[str, Any]], first_name: str, tz=timezone.utc) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """The dashboard JSON plus the aggregates it was rendered from (stored for apply_activity_delta)"""
+    aggregates = aggregate_activities(activities)
+    return render_analytics(aggregates, first_name, tz), aggregates
+
+
+def compute_baseline_analytics(activities: List[Dict[str, Any]], first_name: str, tz=timezone.utc) -> Dict[str, Any]:
+    """
+    All the pandas work of baseline_analytics, activities are the athlete's non deleted main.strava_activities rows.
+    tz is only used for the last_updated timestamp.
+
+    activities = asyncio.run(db.fetch_all("SELECT * FROM main.strava_activities WHERE strava_id = $1 and is_deleted = false", str(strava_id)))
+    compute_baseline_analytics(activities, first_name="Kenny", tz=sg_timezone)
+    """
+    return compute_analytics_and_aggregates(activities, first_name, tz)[0]
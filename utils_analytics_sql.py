@@ -0,0 +1,106 @@
+"""
+Analytics aggregates straight from Postgres (ANALYTICS_MODE=sql), the same aggregates as utils_analytics.aggregate_activities
+but grouped, summed and ranked by Postgres, so only a few kilobytes come back instead of every activity row.
+
+aggregates = asyncio.run(fetch_analytics_aggregates(db, 28923822))
+render_analytics(aggregates, first_name="Kenny")
+"""
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from utils_analytics import AGGREGATE_TABLES, AGGREGATES_VERSION, RUNNING_TYPES, distance_bins, distance_labels
+
+# The columns the analytics depend on (pandas mode and incremental deltas), instead of SELECT * joined with main.botdata_v2
+ANALYTICS_COLUMNS = "activity_id, type, distance, moving_time, total_elevation_gain, kudos_count, start_date, start_date_local, is_deleted"
+
+_ISO_TIMESTAMP = "'YYYY-MM-DD\"T\"HH24:MI:SS'"
+
+# $1 strava_id, $2 current year (heatmap), $3 running types, $4 distance bucket lower bounds, $5 distance bucket labels
+AGGREGATES_QUERY = f"""
+WITH activities AS (
+    SELECT activity_id, type, distance / 1000 AS distance_km, moving_time, total_elevation_gain, kudos_count, start_date, start_date_local,
+           EXTRACT(YEAR FROM start_date_local)::int AS year,
+           -- Whole millimetres, like utils_analytics._millimetres
+           FLOOR(COALESCE(distance, 0) * 1000 + 0.5)::bigint AS distance_mm, FLOOR(COALESCE(total_elevation_gain, 0) * 1000 + 0.5)::bigint AS elevation_mm
+    FROM main.strava_activities
+    WHERE strava_id = $1 AND is_deleted = FALSE AND EXTRACT(YEAR FROM start_date_local) >= 2000
+),
+runs AS (
+    SELECT *, ($5::text[])[width_bucket(distance_km, $4::float8[])] AS distance_type, start_date_local::date AS day
+    FROM activities WHERE type = ANY($3::text[])
+),
+days AS (SELECT day, COUNT(*) AS n FROM runs GROUP BY day),
+-- Gaps and islands: consecutive days share the same day - row_number
+islands AS (SELECT day, day - (ROW_NUMBER() OVER (ORDER BY day))::int AS island FROM days),
+streaks AS (SELECT MIN(day) AS first_day, MAX(day) AS last_day, COUNT(*) AS length FROM islands GROUP BY island),
+gaps AS (SELECT first_day, length, first_day - LAG(last_day) OVER (ORDER BY first_day) - 1 AS gap FROM streaks)
+SELECT jsonb_build_object(
+    'total_activities', (SELECT COUNT(*) FROM activities),
+    'type_year', (SELECT jsonb_object_agg(year || '|' || type, jsonb_build_array(n))
+                  FROM (SELECT year, type, COUNT(*) AS n FROM activities WHERE type IS NOT NULL GROUP BY year, type) t),
+    'run_year', (SELECT jsonb_object_agg(year, jsonb_build_array(n, distance_mm, moving_time, kudos_count, elevation_mm))
+                 FROM (SELECT year, COUNT(*) AS n, SUM(distance_mm) AS distance_mm, COALESCE(SUM(moving_time), 0) AS moving_time,
+                              COALESCE(SUM(kudos_count), 0) AS kudos_count, SUM(elevation_mm) AS elevation_mm
+                       FROM runs GROUP BY year) t),
+    'run_month', (SELECT jsonb_object_agg(year || '|' || month, jsonb_build_array(n, distance_mm))
+                  FROM (SELECT year, EXTRACT(MONTH FROM start_date_local)::int AS month, COUNT(*) AS n, SUM(distance_mm) AS distance_mm
+                        FROM runs GROUP BY 1, 2) t),
+    'run_week', (SELECT jsonb_object_agg(iso_year || '|' || week, jsonb_build_array(n, distance_mm, moving_time))
+                 FROM (SELECT EXTRACT(ISOYEAR FROM start_date_local)::int AS iso_year, EXTRACT(WEEK FROM start_date_local)::int AS week, COUNT(*) AS n,
+                              SUM(distance_mm) AS distance_mm, COALESCE(SUM(moving_time), 0) AS moving_time
+                       FROM runs GROUP BY 1, 2) t),
+    'run_weekday', (SELECT jsonb_object_agg(weekday, jsonb_build_array(n, distance_mm, moving_time, elevation_mm))
+                    FROM (SELECT to_char(start_date_local, 'FMDay') AS weekday, COUNT(*) AS n, SUM(distance_mm) AS distance_mm,
+                                 COALESCE(SUM(moving_time), 0) AS moving_time, SUM(elevation_mm) AS elevation_mm
+                          FROM runs GROUP BY 1) t),
+    'run_hour', (SELECT jsonb_object_agg(hour, jsonb_build_array(n))
+                 FROM (SELECT EXTRACT(HOUR FROM start_date_local)::int AS hour, COUNT(*) AS n FROM runs GROUP BY 1) t),
+    'run_bucket', (SELECT jsonb_object_agg(year || '|' || distance_type, jsonb_build_array(n))
+                   FROM (SELECT year, distance_type, COUNT(*) AS n FROM runs WHERE distance_type IS NOT NULL GROUP BY 1, 2) t),
+    'run_dates', (SELECT jsonb_object_agg(day::text, jsonb_build_array(n)) FROM days),
+    'heatmap', (SELECT jsonb_object_agg(activity_id, jsonb_build_array(to_char(start_date_local, {_ISO_TIMESTAMP}),
+                                                                        FLOOR(EXTRACT(EPOCH FROM start_date))::bigint::text, distance_km))
+                FROM runs WHERE year = $2),
+    'latest_run', (SELECT jsonb_build_array(to_char(start_date_local, {_ISO_TIMESTAMP}), distance_km, type, activity_id)
+                   FROM runs ORDER BY start_date_local DESC LIMIT 1),
+    'longest_run', (SELECT jsonb_build_array(distance_km, activity_id)
+                    FROM runs WHERE distance_km IS NOT NULL ORDER BY distance_km DESC, start_date_local DESC LIMIT 1),
+    'fastest_pace', (SELECT jsonb_build_array((moving_time::float8 / 60) / distance_km, activity_id)
+                     FROM runs WHERE distance_km > 0 AND moving_time IS NOT NULL
+                     ORDER BY (moving_time::float8 / 60) / distance_km, start_date_local DESC LIMIT 1),
+    'highest_elevation', (SELECT jsonb_build_array(total_elevation_gain, activity_id)
+                          FROM runs WHERE total_elevation_gain IS NOT NULL ORDER BY total_elevation_gain DESC, start_date_local DESC LIMIT 1),
+    'streaks', (SELECT jsonb_build_object('running_max', MAX(length), 'notrunning_max', COALESCE(MAX(gap), 0),
+                                          'current_streak', (SELECT length FROM gaps ORDER BY first_day DESC LIMIT 1))
+                FROM gaps)
+) AS aggregates
+"""
+
+
+async def fetch_analytics_rows(db, strava_id) -> List[Dict[str, Any]]:
+    """The athlete's non deleted activities, only the columns the analytics use (ANALYTICS_MODE=pandas)"""
+    return await db.fetch_all(
+        f"SELECT {ANALYTICS_COLUMNS} FROM main.strava_activities WHERE strava_id = $1 AND is_deleted = FALSE", str(strava_id)
+    )
+
+
+async def fetch_first_name(db, strava_id) -> Optional[str]:
+    row = await db.fetch_one("SELECT strava_firstname FROM main.botdata_v2 WHERE strava_id = $1 LIMIT 1", str(strava_id))
+    return row["strava_firstname"] if row else None
+
+
+async def fetch_analytics_aggregates(db, strava_id, now: Optional[datetime] = None) -> Dict[str, Any]:
+    """The aggregates of utils_analytics.aggregate_activities computed in one statement, plus the streaks (computed with window functions)"""
+    current_year = (now or datetime.now()).year
+    row = await db.fetch_one(AGGREGATES_QUERY, str(strava_id), current_year, RUNNING_TYPES, distance_bins[:-1], distance_labels)
+    aggregates = row["aggregates"]
+    aggregates.update(version=AGGREGATES_VERSION, current_year=current_year)
+    for table in AGGREGATE_TABLES:
+        # Integer sums like aggregate_activities, so deltas applied later behave identically in both modes
+        aggregates[table] = {str(key): [int(value) for value in entry] for key, entry in (aggregates[table] or {}).items()}
+    aggregates["heatmap"] = {key: [start, epoch_time, float(distance_km)] for key, (start, epoch_time, distance_km) in (aggregates["heatmap"] or {}).items()}
+    for record in ("longest_run", "fastest_pace", "highest_elevation"):
+        if aggregates[record] is not None:
+            aggregates[record][0] = float(aggregates[record][0])
+    if aggregates["latest_run"] is not None:
+        aggregates["latest_run"][1] = float(aggregates["latest_run"][1])
+    return aggregates
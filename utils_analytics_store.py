@@ -0,0 +1,402 @@
+"""
+Where the dashboard JSON of each athlete lives (written by baseline_analytics, served by /stravajson), with a bounded LRU cache of
+the parsed documents so that a page view (dashboard, heatmap, every Datawrapper external-data fetch) does not re-read and re-parse
+the file each time.
+
+Every leaf of the document (e.g. aggregations-monthly_stats, the paths of /stravajson/{path}) is also written as a ready to serve
+artifact at recompute time, with gzip and brotli variants (gzip only if the `brotli` dependency is missing), so the route streams
+bytes from disk without parsing anything.
+
+Two backends with the same interface, picked with ANALYTICS_STORE: FileAnalyticsStore (local files, one host) and
+PostgresAnalyticsStore (main.strava_analytics, shared by every worker and node).
+
+analytics_store = FileAnalyticsStore("data/activity_data", max_entries=256)
+analytics_store = PostgresAnalyticsStore(db, max_entries=256, revalidate_seconds=2)
+asyncio.run(analytics_store.write("Ab3dE5gH7j", analytics_results))
+document = asyncio.run(analytics_store.get("Ab3dE5gH7j"))
+artifact = asyncio.run(analytics_store.get_artifact("Ab3dE5gH7j", "aggregations-monthly_stats", accept_encoding="gzip, br"))
+"""
+import asyncio
+import glob
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:  # optional, gzip only without it
+    brotli = None
+
+# Leaves smaller than this are served as they are, compression would not pay for the extra header
+MIN_COMPRESS_SIZE = 512
+ENCODINGS = {"gzip": ".gz", "br": ".br"}
+
+
+class Artifact(NamedTuple):
+    path: Optional[str]  # file to stream, None when the bytes are in body
+    encoding: Optional[str]  # Content-Encoding, None for identity
+    content_hash: str  # sha256 of the uncompressed bytes
+    last_modified: float  # Unix time of the recompute that wrote it
+    body: Optional[bytes] = None
+
+
+class Validators(NamedTuple):
+    content_hash: str  # of the whole document
+    last_modified: float
+
+
+def flatten_leaves(document: Dict[str, Any], prefix: str = "") -> Dict[str, str]:
+    """{"summary": {"total_activities": "12"}} -> {"summary-total_activities": "12"}, the paths get_nested_value understands"""
+    leaves = {}
+    for key, value in document.items():
+        path = f"{prefix}-{key}" if prefix else str(key)
+        if isinstance(value, dict):
+            leaves.update(flatten_leaves(value, path))
+        elif value is not None:
+            leaves[path] = value if isinstance(value, str) else json.dumps(value)
+    return leaves
+
+
+def leaf_value(document: Dict[str, Any], path: str) -> Optional[str]:
+    """The leaf at a hyphen-joined path, serialized as flatten_leaves does, None for a missing path or a subtree"""
+    value = document
+    for key in path.split("-"):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    if value is None or isinstance(value, dict):
+        return None
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+def encode_variants(data: bytes) -> Dict[Optional[str], bytes]:
+    """data (under None) and its compressed variants by Content-Encoding, a variant is only kept when it is actually smaller"""
+    variants = {None: data}
+    if len(data) >= MIN_COMPRESS_SIZE:
+        variants["gzip"] = gzip.compress(data, compresslevel=9, mtime=0)
+        if brotli is not None:
+            variants["br"] = brotli.compress(data, quality=9)
+    return {encoding: variant for encoding, variant in variants.items() if encoding is None or len(variant) < len(data)}
+
+
+def accepted_encodings(accept_encoding: str) -> set:
+    """Codings of an Accept-Encoding header, without the ones refused with q=0"""
+    codings = set()
+    for part in accept_encoding.lower().split(","):
+        coding, _, params = part.strip().partition(";")
+        if coding and params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            codings.add(coding)
+    return codings
+
+
+def choose_encoding(available, accept_encoding: str) -> Optional[str]:
+    """br over gzip, among the encodings available that the client accepts, None for identity"""
+    encodings = accepted_encodings(accept_encoding)
+    return next((encoding for encoding in ("br", "gzip") if encoding in available and encoding in encodings), None)
+
+
+def _atomic_write(path: str, data: bytes) -> None:
+    # Written next to the target then renamed, readers never see a partial file. The temp file is unique per write, two writes of
+    # the same file (e.g. from two threads of one process) never share it
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class FileAnalyticsStore:
+    """
+    One data/activity_data/{hashed_strava_id}.json file per athlete, and a {hashed_strava_id}/ directory of content addressed leaf
+    artifacts ({sha256}, {sha256}.gz, {sha256}.br) listed by its manifest.json.
+    Parsed documents and manifests are cached per hashed id and revalidated against the file's mtime and size on every get,
+    so a recompute by another worker process is picked up on the next request.
+    """
+
+    def __init__(self, directory: str, max_entries: int = 256):
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+        self._documents: "OrderedDict[str, Tuple[Tuple[int, int], Dict[str, Any]]]" = OrderedDict()  # key -> (mtime_ns, size), parsed JSON
+        self.counters = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0, "artifacts_served": 0, "artifacts_missing": 0}
+        self._write_locks: Dict[str, asyncio.Lock] = {}
+
+    def path(self, hashed_strava_id: str) -> str:
+        return os.path.join(self.directory, f"{hashed_strava_id}.json")
+
+    def artifact_directory(self, hashed_strava_id: str) -> str:
+        return os.path.join(self.directory, hashed_strava_id)
+
+    def _remember(self, key: str, version: Tuple[int, int], document: Dict[str, Any]) -> None:
+        self._documents[key] = (version, document)
+        self._documents.move_to_end(key)
+        while len(self._documents) > self.max_entries:
+            self._documents.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    @staticmethod
+    def _read(path: str) -> Tuple[Tuple[int, int], Dict[str, Any]]:
+        with open(path, "r") as f:
+            stat = os.fstat(f.fileno())
+            return (stat.st_mtime_ns, stat.st_size), json.load(f)
+
+    async def _get_json(self, key: str, path: str) -> Optional[Tuple[Tuple[int, int], Dict[str, Any]]]:
+        """(mtime_ns, size), parsed JSON of path, cached under key"""
+        try:
+            # A stat is cheap enough for the event loop, only the read and parse go to a thread
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self._documents.pop(key, None)
+            return None
+
+        cached = self._documents.get(key)
+        if cached is not None and cached[0] == (stat.st_mtime_ns, stat.st_size):
+            self.counters["hits"] += 1
+            self._documents.move_to_end(key)
+            return cached
+        self.counters["stale" if cached is not None else "misses"] += 1
+
+        try:
+            version, document = await asyncio.to_thread(self._read, path)
+        except FileNotFoundError:
+            return None
+        self._remember(key, version, document)
+        return version, document
+
+    async def _get_manifest(self, hashed_strava_id: str) -> Optional[Tuple[Tuple[int, int], Dict[str, Any]]]:
+        return await self._get_json(f"{hashed_strava_id}/manifest", os.path.join(self.artifact_directory(hashed_strava_id), "manifest.json"))
+
+    async def get(self, hashed_strava_id: str) -> Optional[Dict[str, Any]]:
+        """The athlete's dashboard JSON, None when it has not been computed. Raises json.JSONDecodeError for a corrupt file"""
+        if not hashed_strava_id.isalnum():
+            return None
+        cached = await self._get_json(hashed_strava_id, self.path(hashed_strava_id))
+        return cached[1] if cached is not None else None
+
+    async def get_validators(self, hashed_strava_id: str) -> Optional[Validators]:
+        """
+        Content hash and time of the athlete's last recompute, from the (cached) manifest, without reading the document.
+        Documents written before artifacts existed fall back to the file's mtime and size.
+        """
+        if not hashed_strava_id.isalnum():
+            return None
+        manifest = await self._get_manifest(hashed_strava_id)
+        if manifest is not None:
+            return Validators(content_hash=manifest[1]["sha256"], last_modified=manifest[0][0] / 1e9)
+        try:
+            stat = os.stat(self.path(hashed_strava_id))
+        except FileNotFoundError:
+            return None
+        return Validators(content_hash=f"{stat.st_mtime_ns:x}{stat.st_size:x}", last_modified=stat.st_mtime)
+
+    async def get_artifact(self, hashed_strava_id: str, path: str, accept_encoding: str = "") -> Optional[Artifact]:
+        """
+        The pre-serialized leaf at path (e.g. aggregations-monthly_stats) in the best encoding the client accepts,
+        None when there is none (not a leaf, or written before artifacts existed), the caller then falls back to get.
+        """
+        if not hashed_strava_id.isalnum():
+            return None
+        manifest = await self._get_manifest(hashed_strava_id)
+        entry = manifest[1]["paths"].get(path) if manifest is not None else None
+        if entry is None:
+            self.counters["artifacts_missing"] += 1
+            return None
+
+        content_hash, encoding = entry["sha256"], choose_encoding(entry["encodings"], accept_encoding)
+        artifact_path = os.path.join(self.artifact_directory(hashed_strava_id), content_hash + ENCODINGS.get(encoding, ""))
+        self.counters["artifacts_served"] += 1
+        return Artifact(path=artifact_path, encoding=encoding, content_hash=content_hash, last_modified=manifest[0][0] / 1e9)
+
+    def _write(self, hashed_strava_id: str, document: Dict[str, Any]) -> Tuple[int, int]:
+        directory = self.artifact_directory(hashed_strava_id)
+        os.makedirs(directory, exist_ok=True)
+        manifest_path = os.path.join(directory, "manifest.json")
+        try:
+            with open(manifest_path) as f:
+                previous_hashes = {entry["sha256"] for entry in json.load(f)["paths"].values()}
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            previous_hashes = set()
+
+        # Content addressed, a leaf that did not change since the last recompute is not written again
+        paths = {}
+        for path, value in flatten_leaves(document).items():
+            data = value.encode("utf-8")
+            content_hash = hashlib.sha256(data).hexdigest()
+            variants = encode_variants(data)
+            for encoding, variant in variants.items():
+                artifact_path = os.path.join(directory, content_hash + ENCODINGS.get(encoding, ""))
+                if not os.path.exists(artifact_path):
+                    _atomic_write(artifact_path, variant)
+            encodings = [encoding for encoding in variants if encoding is not None]
+            paths[path] = {"sha256": content_hash, "size": len(data), "encodings": encodings}
+
+        document_bytes = json.dumps(document).encode("utf-8")
+        _atomic_write(self.path(hashed_strava_id), document_bytes)
+        _atomic_write(manifest_path, json.dumps({"sha256": hashlib.sha256(document_bytes).hexdigest(), "paths": paths}).encode("utf-8"))
+
+        # Artifacts of the previous manifest are kept for requests that read it just before the swap
+        keep = {entry["sha256"] for entry in paths.values()} | previous_hashes
+        for artifact_path in glob.glob(os.path.join(directory, "*")):
+            name = os.path.basename(artifact_path)
+            if name != "manifest.json" and not name.endswith(".tmp") and name.split(".")[0] not in keep:
+                os.remove(artifact_path)
+        stat = os.stat(self.path(hashed_strava_id))
+        return stat.st_mtime_ns, stat.st_size
+
+    async def write(self, hashed_strava_id: str, document: Dict[str, Any]) -> None:
+        """Writes the athlete's dashboard JSON and its leaf artifacts, and caches the document in this process straight away"""
+        # One write per athlete at a time in this process, so a write's cleanup never removes the artifacts of a newer manifest
+        async with self._write_locks.setdefault(hashed_strava_id, asyncio.Lock()):
+            version = await asyncio.to_thread(self._write, hashed_strava_id, document)
+        self._remember(hashed_strava_id, version, document)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.counters, "entries": len(self._documents), "max_entries": self.max_entries, "brotli": brotli is not None}
+
+
+# aggregations sections with their own pre-serialized column in main.strava_analytics (CSV, heatmap_json is JSON)
+SECTION_COLUMNS = ("weekly_stats", "monthly_stats", "weekday_stats", "distance_distribution", "yearly_stats",
+                   "workout_composition_count", "workout_composition_percentage", "heatmap_json")
+
+UPSERT_ANALYTICS_QUERY = f"""
+INSERT INTO main.strava_analytics (strava_hashed_id, document, content_hash, {", ".join(SECTION_COLUMNS)}, version, updated_at)
+VALUES ($1, $2, $3, {", ".join(f"${i}" for i in range(4, 4 + len(SECTION_COLUMNS)))}, 1, CURRENT_TIMESTAMP)
+ON CONFLICT (strava_hashed_id) DO UPDATE SET
+    document = EXCLUDED.document, content_hash = EXCLUDED.content_hash,
+    {", ".join(f"{column} = EXCLUDED.{column}" for column in SECTION_COLUMNS)},
+    version = main.strava_analytics.version + 1, updated_at = EXCLUDED.updated_at
+RETURNING version, content_hash, updated_at
+"""
+
+
+class PostgresAnalyticsStore:
+    """
+    One main.strava_analytics row per athlete: the dashboard JSON as JSONB, each aggregations section pre-serialized in its own text
+    column (what the Datawrapper charts fetch, read without decoding the document) and a version bumped on every write.
+    Rows are cached per worker and trusted for revalidate_seconds, after that a version lookup (no document) tells whether another
+    worker or node wrote a newer one, so a dashboard hit costs at most one small query per athlete and interval.
+    Leaves are serialized and compressed on first use, then kept with the cached row.
+    """
+
+    def __init__(self, db, max_entries: int = 256, revalidate_seconds: float = 2.0):
+        self.db = db
+        self.max_entries = max_entries
+        self.revalidate_seconds = revalidate_seconds
+        # hashed id -> {"version", "content_hash", "updated_at", "checked_at", "document" (None until read), "leaves": {path: (sha256, variants)}}
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.counters = {"hits": 0, "misses": 0, "stale": 0, "revalidations": 0, "evictions": 0, "artifacts_served": 0, "artifacts_missing": 0}
+
+    def path(self, hashed_strava_id: str) -> str:
+        return f"main.strava_analytics/{hashed_strava_id}"
+
+    def _remember(self, hashed_strava_id: str, row: Dict[str, Any], document: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        entry = {"version": row["version"], "content_hash": row["content_hash"], "updated_at": row["updated_at"], "checked_at": time.monotonic(),
+                 "document": document, "leaves": {}}
+        self._entries[hashed_strava_id] = entry
+        self._entries.move_to_end(hashed_strava_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.counters["evictions"] += 1
+        return entry
+
+    async def _entry(self, hashed_strava_id: str) -> Optional[Dict[str, Any]]:
+        """The cached row, revalidated against the table's version once revalidate_seconds have passed"""
+        entry = self._entries.get(hashed_strava_id)
+        if entry is not None and time.monotonic() - entry["checked_at"] < self.revalidate_seconds:
+            self.counters["hits"] += 1
+            self._entries.move_to_end(hashed_strava_id)
+            return entry
+
+        row = await self.db.fetch_one(
+            "SELECT version, content_hash, updated_at FROM main.strava_analytics WHERE strava_hashed_id = $1", hashed_strava_id
+        )
+        if row is None:
+            self._entries.pop(hashed_strava_id, None)
+            return None
+        if entry is not None and entry["version"] == row["version"]:
+            self.counters["revalidations"] += 1
+            entry["checked_at"] = time.monotonic()
+            self._entries.move_to_end(hashed_strava_id)
+            return entry
+        self.counters["stale" if entry is not None else "misses"] += 1
+        return self._remember(hashed_strava_id, row)
+
+    async def get(self, hashed_strava_id: str) -> Optional[Dict[str, Any]]:
+        """The athlete's dashboard JSON, None when it has not been computed"""
+        if not hashed_strava_id.isalnum():
+            return None
+        entry = await self._entry(hashed_strava_id)
+        if entry is None:
+            return None
+        if entry["document"] is None:
+            row = await self.db.fetch_one(
+                "SELECT version, content_hash, updated_at, document FROM main.strava_analytics WHERE strava_hashed_id = $1", hashed_strava_id
+            )
+            if row is None:
+                self._entries.pop(hashed_strava_id, None)
+                return None
+            entry = self._remember(hashed_strava_id, row, row["document"])
+        return entry["document"]
+
+    async def get_validators(self, hashed_strava_id: str) -> Optional[Validators]:
+        """Content hash and time of the athlete's last recompute, without reading the document"""
+        if not hashed_strava_id.isalnum():
+            return None
+        entry = await self._entry(hashed_strava_id)
+        if entry is None:
+            return None
+        return Validators(content_hash=entry["content_hash"], last_modified=entry["updated_at"].timestamp())
+
+    async def _leaf(self, hashed_strava_id: str, entry: Dict[str, Any], path: str) -> Optional[str]:
+        section = path.removeprefix("aggregations-")
+        if entry["document"] is None and section in SECTION_COLUMNS:
+            # Only the section's text, the JSONB document is not decoded
+            row = await self.db.fetch_one(
+                f"SELECT version, {section} AS value FROM main.strava_analytics WHERE strava_hashed_id = $1", hashed_strava_id
+            )
+            if row is not None and row["version"] == entry["version"]:
+                return row["value"]
+        document = await self.get(hashed_strava_id)
+        return leaf_value(document, path) if document is not None else None
+
+    async def get_artifact(self, hashed_strava_id: str, path: str, accept_encoding: str = "") -> Optional[Artifact]:
+        """The leaf at path (e.g. aggregations-monthly_stats) in memory, in the best encoding the client accepts, None when it is not a leaf"""
+        if not hashed_strava_id.isalnum():
+            return None
+        entry = await self._entry(hashed_strava_id)
+        if entry is None:
+            return None
+        if path not in entry["leaves"]:
+            value = await self._leaf(hashed_strava_id, entry, path)
+            if value is None:
+                self.counters["artifacts_missing"] += 1
+                return None
+            data = value.encode("utf-8")
+            variants = await asyncio.to_thread(encode_variants, data) if len(data) >= MIN_COMPRESS_SIZE else {None: data}
+            entry["leaves"][path] = (hashlib.sha256(data).hexdigest(), variants)
+
+        content_hash, variants = entry["leaves"][path]
+        encoding = choose_encoding(variants, accept_encoding)
+        self.counters["artifacts_served"] += 1
+        return Artifact(path=None, encoding=encoding, content_hash=content_hash, last_modified=entry["updated_at"].timestamp(),
+                        body=variants[encoding])
+
+    async def write(self, hashed_strava_id: str, document: Dict[str, Any]) -> None:
+        """Upserts the athlete's row (bumping its version), and caches the document in this process straight away"""
+        sections = document.get("aggregations") or {}
+        content_hash = hashlib.sha256(json.dumps(document).encode("utf-8")).hexdigest()
+        row = await self.db.fetch_one(
+            UPSERT_ANALYTICS_QUERY, hashed_strava_id, document, content_hash, *[sections.get(column) for column in SECTION_COLUMNS]
+        )
+        self._remember(hashed_strava_id, row, document)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.counters, "entries": len(self._entries), "max_entries": self.max_entries, "brotli": brotli is not None}
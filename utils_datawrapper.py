@@ -1,192 +1,159 @@
-import requests
-import json
-from typing import Tuple, Optional, Dict, Any
+import asyncio
+from typing import Tuple, Optional
+import httpx
 from loguru import logger
+from utils_resilience import CircuitOpenError, Upstream
 
-class DataWrapper:
-    def __init__(self, api_token: str):
+
+class AsyncDataWrapper:
+    """
+    Async Datawrapper client on a pooled httpx.AsyncClient, so chart provisioning never blocks the event loop and several charts
+    can be provisioned at once (at most `max_concurrency` calls in flight).
+    Each chart takes three calls: create, one PUT with the data source and the whole configuration, publish (the last two
+    again when an existing chart's configuration changes). Calls go through an Upstream: transient failures are retried with
+    backoff, and while Datawrapper is down calls fail fast (as a failed request) instead of waiting for their timeouts.
+
+    dw = AsyncDataWrapper(api_token=dash_api)
+    asyncio.run(dw.create_and_publish_chart(title="Weekly Mileage", chart_type="column-chart", web_link=web_link))
+    asyncio.run(dw.get_chart_metadata("q6gP0"))
+    """
+
+    def __init__(self, api_token: str, base_url: str = "https://api.datawrapper.de/v3", timeout: float = 30.0, max_concurrency: int = 5,
+                 upstream: Optional[Upstream] = None):
         self.api_token = api_token
-        self.base_url = "https://api.datawrapper.de/v3"
+        self.base_url = base_url.rstrip("/")
         self.headers = {"Authorization": f"Bearer {self.api_token}"}
-
-    def _make_request(self, method: str, endpoint: str, data: Any = None) -> Tuple[bool, dict]:
+        self.timeout = httpx.Timeout(timeout, connect=5.0)
+        self.limits = httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+        self.max_concurrency = max_concurrency
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.upstream = upstream or Upstream("datawrapper")
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """Create the pooled client lazily so it binds to the running event loop (one per uvicorn worker)"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(base_url=self.base_url, headers=self.headers, timeout=self.timeout, limits=self.limits)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    async def _make_request(self, method: str, endpoint: str, payload: Optional[dict] = None) -> Tuple[bool, dict]:
         """
         Make HTTP request to Datawrapper API
         Returns: (success, response_data)
         """
         try:
-            url = f"{self.base_url}/{endpoint}"
-            if method.lower() == "get":
-                response = requests.get(url, headers=self.headers)
-            elif method.lower() == "post":
-                response = requests.post(url, headers=self.headers)
-            elif method.lower() == "put":
-                response = requests.put(url, headers=self.headers, data=data)
-            
-            response.raise_for_status()  # Raise exception for bad status codes
-            return True, response.json()
-        except requests.exceptions.RequestException as e:
+            response = await self._send(method, f"/{endpoint}", payload)
+            response.raise_for_status()
+            return True, response.json() if response.content else {}
+        except (httpx.HTTPError, CircuitOpenError, ValueError) as e:
             logger.error(f"Datawrapper API request failed: {str(e)}")
             return False, {}
-        
-    def create_chart(self) -> Tuple[bool, str, str]:
+
+    async def _send(self, method: str, path: str, payload: Optional[dict] = None) -> httpx.Response:
+        client = self._get_client()
+
+        async def send(timeout: Optional[float]) -> httpx.Response:
+            async with self._semaphore:
+                return await client.request(method.upper(), path, json=payload,
+                                            **({"timeout": httpx.Timeout(timeout, connect=self.timeout.connect)} if timeout else {}))
+
+        return await self.upstream.call(send, path, method.upper())
+
+    async def create_chart(self) -> Tuple[bool, str, str]:
         """Create empty chart and return (success, chart_id, status)"""
-        success, data = self._make_request("post", "charts")
-        if success and data:
-            try:
-                chart_id = data.get('id')
-                if chart_id:
-                    return True, chart_id, "Chart created successfully"
-            except (KeyError, AttributeError) as e:
-                logger.error(f"Failed to parse chart creation response: {e}")
-        
+        success, data = await self._make_request("post", "charts")
+        if success and data.get('id'):
+            return True, data['id'], "Chart created successfully"
         return False, '', "Failed to create chart"
 
-    def upload_data(self, chart_id: str, web_link: str) -> Tuple[bool, bool]:
-        """Upload data to chart from web link or CSV string"""
-        try:
-            payload = {
-                'metadata': {'data': {'transpose': False, 'external-data': web_link}},
-                'externalData': web_link
-            }
-            success, response = self._make_request("put", f"charts/{chart_id}", data=json.dumps(payload))
-        
-            if success:
-                return True, "Data uploaded successfully"
-            logger.error(f"Failed to upload data: {response}")
-            return False, "Failed to upload data"
-            
-        except Exception as e:
-            logger.error(f"Error uploading data: {str(e)}")
-            return False, f"Error: {str(e)}"
-
-    def configure_chart(self, chart_id: str, title: str, chart_type: str, metadata: dict) -> Tuple[bool, str]:
-        """Configure chart properties"""
-        try:
-            current_config = {}
-            current_config['title'] = title
-            current_config['type'] = chart_type
-
-            # Update metadata 
-            if 'metadata' not in current_config:
-                current_config['metadata'] = {}
-
-            # Handle external data logic (configurations within metadata[data])
-            if 'external-data' in metadata:
-                if 'data' not in current_config['metadata']:
-                    current_config['metadata']['data'] = {}
-                current_config['metadata']['data']['external-data'] = metadata['external-data']
-                current_config['metadata']['data']['upload-method'] = 'external-data'
-                current_config['metadata']['data']['use-datawrapper-cdn'] = False
-
-            # Handle all configurations from visualization and describe
-            if 'visualize' in metadata:
-                current_config['metadata']['visualize'] = metadata['visualize']
-            if 'describe' in metadata:
-                current_config['metadata']['describe'] = metadata['describe']
-            if 'publish' in metadata:
-                current_config['metadata']['publish'] = metadata['publish']
-
-            # Update chart
-            #logger.info(f"Current config: {current_config}")
-            success, response = self._make_request("put", f"charts/{chart_id}", data=json.dumps(current_config))
-            
-            if success:
-                return True, "Chart configured successfully"
-            return False, "Failed to update chart configuration"
-
-        except Exception as e:
-            logger.error(f"Error configuring chart: {str(e)}")
-            return False, f"Error: {str(e)}"
-
-    def publish_chart(self, chart_id: str, metadata: dict = None) -> Tuple[bool, str]:
-        """Publish chart and return (success, embed_code)"""
-        current_config = {}
-        if 'publish' in metadata:
-            current_config = metadata['publish']
-        success, response = self._make_request("post", f"charts/{chart_id}/publish", data=json.dumps(current_config))
-        
-        if success:
-            embed_code_responsive = response['data']['metadata']['publish']['embed-codes']['embed-method-responsive']
-            embed_code_web_component = response['data']['metadata']['publish']['embed-codes']['embed-method-web-component']
-            return True, embed_code_responsive, embed_code_web_component
-        return False, ''
-
-    def create_and_publish_chart(self, title: str, chart_type: str, web_link: str,
-                                 describe_settings: dict = None,
-                                 visualization_settings: dict = None,
-                                 publish_settings: dict = None) -> Tuple[bool, str, str]:
+    async def configure_chart(self, chart_id: str, title: str, chart_type: str, web_link: str, metadata: dict) -> Tuple[bool, str]:
         """
-        Create, configure, and publish a chart in one go
-        
-        Args:
-            title: Chart title
-            chart_type: Type of chart (e.g., 'd3-bars-split')
-            web_link: URL for external data
-            visualization_settings: Dictionary of visualization settings
-            
-        Returns:
-            Tuple[bool, str, str]: (success, chart_id, embed_code/error_message)
+        Point the chart at its external data and configure it in a single PUT of the chart resource.
+        metadata takes the 'visualize', 'describe' and 'publish' settings.
         """
+        payload = {
+            'title': title,
+            'type': chart_type,
+            'externalData': web_link,
+            'metadata': {
+                'data': {'transpose': False, 'external-data': web_link, 'upload-method': 'external-data', 'use-datawrapper-cdn': False},
+                **{key: metadata[key] for key in ('visualize', 'describe', 'publish') if key in metadata},
+            },
+        }
+        success, _ = await self._make_request("put", f"charts/{chart_id}", payload=payload)
+        if success:
+            return True, "Chart configured successfully"
+        return False, "Failed to update chart configuration"
+
+    async def publish_chart(self, chart_id: str) -> Tuple[bool, str, str]:
+        """Publish chart and return (success, embed_code_responsive, embed_code_web_component)"""
+        success, response = await self._make_request("post", f"charts/{chart_id}/publish")
         try:
-            # Create empty chart
-            success, chart_id, message = self.create_chart()
-            if not success:
-                return False, "", f"Failed to create chart: {message}"
-
-            # Upload data
-            success, message = self.upload_data(chart_id=chart_id, web_link=web_link)
-            if not success:
-                return False, chart_id, f"Failed to upload data: {message}"
-
-            # Configure chart
-            metadata = {'external-data': web_link}
-            if describe_settings:
-                metadata['describe'] = describe_settings
-            # Add visualization settings if provided
-            if visualization_settings:
-                metadata['visualize'] = visualization_settings
-            if publish_settings:
-                metadata['publish'] = publish_settings
-
-            success, message = self.configure_chart(
-                chart_id=chart_id,
-                title=title,
-                chart_type=chart_type,
-                metadata=metadata
-            )
-            if not success:
-                return False, chart_id, f"Failed to configure chart: {message}"
-
-            # Publish chart
-            success, embed_code_responsive, embed_code_web_component = self.publish_chart(chart_id=chart_id, metadata= metadata)
-            if not success:
-                return False, chart_id, "Failed to publish chart"
-
-            return True, chart_id, embed_code_responsive, embed_code_web_component
-
-        except Exception as e:
-            logger.error(f"Error creating chart: {str(e)}")
-            return False, "", str(e)
-
-
-    def get_chart_metadata(self, chart_id: str) -> Tuple[bool, dict]:
+            embed_codes = response['data']['metadata']['publish']['embed-codes']
+            return success, embed_codes['embed-method-responsive'], embed_codes['embed-method-web-component']
+        except (KeyError, TypeError):
+            logger.error(f"Unexpected publish response for chart {chart_id}: {response}")
+            return False, '', ''
+
+    async def create_and_publish_chart(self, title: str, chart_type: str, web_link: str,
+                                       describe_settings: dict = None,
+                                       visualization_settings: dict = None,
+                                       publish_settings: dict = None) -> Tuple[bool, str, str, str]:
         """
-        Retrieve complete chart metadata
-        Args:
-            chart_id: The chart ID
+        Create, configure, and publish a chart in one go
+
         Returns:
-            Tuple[bool, dict]: (success, response_data)
+            Tuple[bool, str, str, str]: (success, chart_id, embed_code_responsive, embed_code_web_component), empty embed codes on failure
         """
+        success, chart_id, message = await self.create_chart()
+        if not success:
+            logger.error(f"Failed to create chart {title}: {message}")
+            return False, "", "", ""
+        return await self.configure_and_publish_chart(chart_id, title, chart_type, web_link, describe_settings=describe_settings,
+                                                      visualization_settings=visualization_settings, publish_settings=publish_settings)
+
+    async def configure_and_publish_chart(self, chart_id: str, title: str, chart_type: str, web_link: str,
+                                          describe_settings: dict = None,
+                                          visualization_settings: dict = None,
+                                          publish_settings: dict = None) -> Tuple[bool, str, str, str]:
+        """Configure and (re)publish an existing chart, returns what create_and_publish_chart returns"""
+        metadata = {}
+        if describe_settings:
+            metadata['describe'] = describe_settings
+        if visualization_settings:
+            metadata['visualize'] = visualization_settings
+        if publish_settings:
+            metadata['publish'] = publish_settings
+        success, message = await self.configure_chart(chart_id=chart_id, title=title, chart_type=chart_type, web_link=web_link, metadata=metadata)
+        if not success:
+            logger.error(f"Failed to configure chart {chart_id}: {message}")
+            return False, chart_id, "", ""
+
+        success, embed_code_responsive, embed_code_web_component = await self.publish_chart(chart_id=chart_id)
+        if not success:
+            logger.error(f"Failed to publish chart {chart_id}")
+            return False, chart_id, "", ""
+        return True, chart_id, embed_code_responsive, embed_code_web_component
+
+    async def chart_exists(self, chart_id: str) -> bool:
+        """False only when Datawrapper answers 404 (the chart was deleted), errors count as existing so a chart is never duplicated"""
         try:
-            success, response = self._make_request("get", f"charts/{chart_id}")
-            if success:
-                #logger.info(f"Successfully retrieved metadata for chart {chart_id}")
-                return True, response
-            
+            response = await self._send("get", f"/charts/{chart_id}")
+            return response.status_code != 404
+        except (httpx.HTTPError, CircuitOpenError) as e:
+            logger.error(f"Datawrapper API request failed: {str(e)}")
+            return True
+
+    async def get_chart_metadata(self, chart_id: str) -> Tuple[bool, dict]:
+        """Retrieve complete chart metadata, (success, response_data)"""
+        success, response = await self._make_request("get", f"charts/{chart_id}")
+        if not success:
             logger.error(f"Failed to retrieve metadata for chart {chart_id}")
-            return False, {}
-            
-        except Exception as e:
-            logger.error(f"Error retrieving chart metadata: {str(e)}")
-            return False, {}
+        return success, response
+
+    async def aclose(self) -> None:
+        """Close all pooled connections"""
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+            logger.info("Datawrapper client pool closed")
@@ -1,9 +1,15 @@
 """
 Charts are created in Datawrapper and we directly export (copied) the settings from Datawrapper.
 
-chart_data = dw.get_chart_metadata("q6gP0")
+chart_data = asyncio.run(dw.get_chart_metadata("q6gP0"))
 visualization_chart_3_settings = chart_data[1]['metadata']['visualize']
+
+CHART_SPECS is the registry of the dashboard charts, built once at import.
 """
+import hashlib
+import json
+from datetime import datetime
+from typing import Any, Dict, List, NamedTuple, Optional
 
 hex_colour_lst = ['#c71e1d', '#18a1cd', '#09bb9f', '#ff9f1c', '#8338ec', '#2ec4b6', '#ff006e', '#3a86ff', '#38b000', '#ffbe0b',
                    '#fb5607', '#4cc9f0', '#7209b7', '#f72585', '#4361ee', '#b5179e', '#480ca8', '#3f37c9', '#ef233c', '#72efdd',
@@ -716,3 +722,118 @@ visualization_chart_3_settings = {
 				},
 			},
 		} 
+
+
+class ChartSpec(NamedTuple):
+    """
+    One dashboard chart, provisioned per athlete by datawrapper_initiate_charts with its external data at /stravajson/{data_path}.
+    content_hash covers everything but the athlete's data link, it is computed once when the registry is built.
+    """
+    chart_identifier_id: str  # key in main.strava_charts and in the /strava-charts response
+    title: str
+    chart_type: str
+    data_path: str
+    describe_settings: Optional[Dict[str, Any]] = None
+    visualization_settings: Optional[Dict[str, Any]] = None
+    publish_settings: Optional[Dict[str, Any]] = None
+    content_hash: str = ""
+
+    def settings(self) -> Dict[str, Any]:
+        """The keyword arguments of AsyncDataWrapper.create_and_publish_chart / configure_and_publish_chart"""
+        return {"describe_settings": self.describe_settings, "visualization_settings": self.visualization_settings,
+                "publish_settings": self.publish_settings}
+
+    def spec_hash(self, web_link: str) -> str:
+        """main.strava_charts.spec_hash of this chart for one athlete's data link"""
+        return hashlib.sha256(f"{self.content_hash}:{web_link}".encode()).hexdigest()
+
+
+def build_chart_specs(specs: List[ChartSpec]) -> Dict[str, ChartSpec]:
+    """Registry by chart_identifier_id, with each spec's content hash filled in"""
+    registry = {}
+    for spec in specs:
+        if spec.chart_identifier_id in registry:
+            raise ValueError(f"Duplicate chart spec {spec.chart_identifier_id}")
+        content = json.dumps(spec._replace(content_hash="")._asdict(), sort_keys=True, default=str)
+        registry[spec.chart_identifier_id] = spec._replace(content_hash=hashlib.sha256(content.encode()).hexdigest())
+    return registry
+
+
+# Years with a colour in the monthly chart, up to next year at startup (a restart in a new year updates the charts on their next reload)
+chart_year_lst = [str(year) for year in range(2018, datetime.now().year + 2)]
+
+# Adding a chart to the dashboard is one entry here (and its element on the frontend)
+CHART_SPECS = build_chart_specs(
+    [
+        # Chart 1 - Month + Year Running Data
+        ChartSpec(
+            "chart1",
+            title="Monthly Running Stats",
+            chart_type="d3-bars-split",
+            data_path="aggregations-monthly_stats",
+            visualization_settings={
+                "color-category": {"map": {year: hex_colour_lst[i % len(hex_colour_lst)] for i, year in enumerate(chart_year_lst)},
+                                   "categoryOrder": chart_year_lst, "categoryLabels": {}},
+                "show-color-key": True,
+                "color-by-column": True,
+                "date-label-format": "MMMM",
+            },
+            publish_settings={"embed-width": 700, "embed-height": 400},
+        ),
+        # Chart 2 - Weekly Running Data (Line)
+        ChartSpec(
+            "chart2",
+            title="Weekly Mileage (past 20 weeks from latest activity)",
+            chart_type="column-chart",
+            data_path="aggregations-weekly_stats",
+            visualization_settings={
+                "base-color": "#ea503f",
+                "valueLabels": {"show": "always"},
+                "disable-tabs": False,
+                "chart-type-set": True,
+                "plotHeightFixed": 200,
+                "plotHeightRatio": 0.5,
+            },
+            describe_settings={"intro": "Distance and Time Spent on Running by Week"},
+            publish_settings={"embed-width": 700, "embed-height": 500, "blocks": {"get-the-data": True}},
+        ),
+        # Chart 3 - Yearly Comparison data
+        ChartSpec(
+            "chart3",
+            title="Year-on-year Comparison Data",
+            chart_type="tables",
+            data_path="aggregations-yearly_stats",
+            visualization_settings=visualization_chart_3_settings,
+            publish_settings={"embed-width": 900, "embed-height": 500},
+        ),
+        # Chart 4 - Running composition using stacked bars https://workout.kennyvectors.com/stacktableexport
+        ChartSpec(
+            "chart4",
+            title="Running Composition",
+            chart_type="d3-bars-stacked",
+            data_path="aggregations-workout_composition_percentage",
+            visualization_settings={
+                "color-category": {"map": {activity_type: hex_colour_lst[i % len(hex_colour_lst)] for i, activity_type in enumerate(strava_activity_type_lst)},
+                                   "categoryLabels": {}},
+                "show-color-key": True,
+                "color-by-column": True,
+            },
+            publish_settings={"embed-width": 800, "embed-height": 400},
+        ),
+        # Chart 5 - Running Distance Distribution
+        ChartSpec(
+            "chart5",
+            title="Running Distance Distribution",
+            chart_type="d3-bars-split",
+            data_path="aggregations-distance_distribution",
+            visualization_settings={
+                "color-category": {"map": {category: hex_colour_lst[i % len(hex_colour_lst)] for i, category in enumerate(distance_category_lst)},
+                                   "categoryOrder": distance_category_lst, "categoryLabels": {}},
+                "show-color-key": True,
+                "color-by-column": True,
+            },
+            publish_settings={"embed-width": 700, "embed-height": 400},
+        ),
+        # TODO Other charts to consider - look at 1) heart rate data, 2) ten percent (weekly rule) - but this rule does not really apply for low mileage runners - think about this.
+    ]
+)
@@ -0,0 +1,64 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+from loguru import logger
+
+
+class KeyedDebouncer:
+    """
+    Merges every trigger for the same key within `window` seconds into a single `func(key)` call, and makes sure at most one call
+    per key is in flight. A trigger arriving while a call is running schedules one follow-up call after it, so no update is lost.
+
+    Used to coalesce analytics recomputes per athlete (webhook bursts, double taps on /reload-full-data).
+
+    analytics_debouncer = KeyedDebouncer(lambda strava_id: baseline_analytics(strava_id), window=10)
+    analytics_debouncer.trigger("28923822")              # fire and forget
+    await analytics_debouncer.run("28923822")            # wait for the (merged) call to finish
+    """
+
+    def __init__(self, func: Callable[[Any], Awaitable[Any]], window: float = 10.0, name: str = "debouncer"):
+        self.func = func
+        self.window = window
+        self.name = name
+        self._scheduled: Dict[Any, asyncio.Future] = {}  # key -> result of the call that has not started yet
+        self._running: Dict[Any, asyncio.Future] = {}  # key -> result of the call in flight
+        self._tasks = set()
+        self.counters = {"triggers": 0, "coalesced": 0, "runs": 0, "failures": 0}
+
+    def trigger(self, key) -> asyncio.Future:
+        """Schedule func(key), returns a future resolved with True/False once the (merged) call has finished"""
+        self.counters["triggers"] += 1
+        if key in self._scheduled:
+            self.counters["coalesced"] += 1
+            return self._scheduled[key]
+
+        result = asyncio.get_running_loop().create_future()
+        self._scheduled[key] = result
+        task = asyncio.ensure_future(self._run_after_window(key, result))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return result
+
+    async def run(self, key) -> bool:
+        return await self.trigger(key)
+
+    async def _run_after_window(self, key, result: asyncio.Future) -> None:
+        await asyncio.sleep(self.window)
+        while key in self._running:
+            await asyncio.shield(self._running[key])
+
+        # From here on new triggers schedule a follow-up call instead of merging into this one
+        del self._scheduled[key]
+        self._running[key] = result
+        self.counters["runs"] += 1
+        try:
+            await self.func(key)
+            result.set_result(True)
+        except Exception as e:
+            self.counters["failures"] += 1
+            logger.exception(f"{self.name} call failed for {key}: {str(e)}")
+            result.set_result(False)
+        finally:
+            del self._running[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.counters, "window": self.window, "scheduled": len(self._scheduled), "running": len(self._running)}
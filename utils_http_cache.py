@@ -0,0 +1,98 @@
+"""
+HTTP cache validators for the dashboard endpoints (/stravajson, /stravajson/{path}, /strava-charts): strong ETags from content
+hashes, Last-Modified from the last recompute, 304 answers to If-None-Match / If-Modified-Since, and Cache-Control per path.
+
+cache_control = CacheControlPolicy({"/strava-charts": "public, max-age=3600", "/stravajson/summary-*": "public, max-age=300"})
+headers = validator_headers(strong_etag(content_hash), last_modified, cache_control.for_path("/stravajson/summary-total_activities"))
+if is_not_modified(request.headers, headers["ETag"], last_modified):
+    return Response(status_code=304, headers=headers)
+"""
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from fnmatch import fnmatchcase
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+DEFAULT_CACHE_CONTROL = "no-cache"  # may be stored, but revalidated (a cheap 304) before every use
+
+
+def strong_etag(content_hash: str, encoding: Optional[str] = None) -> str:
+    """Each encoding of the same content is its own representation, so it gets its own strong ETag"""
+    return f'"{content_hash[:32]}-{encoding}"' if encoding else f'"{content_hash[:32]}"'
+
+
+def is_not_modified(headers: Mapping[str, str], etag: str, last_modified: Optional[float]) -> bool:
+    """
+    True when the client's copy is current (RFC 9110 13.1): If-None-Match is compared weakly against etag, If-Modified-Since is only
+    looked at when there is no If-None-Match, at one second resolution against last_modified (a Unix timestamp).
+    """
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        opaque_tag = etag.removeprefix("W/")
+        return any(tag.strip().removeprefix("W/") == opaque_tag for tag in if_none_match.split(","))
+
+    if_modified_since = headers.get("if-modified-since")
+    if if_modified_since is None or last_modified is None:
+        return False
+    try:
+        return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False  # invalid dates are ignored
+
+
+def validator_headers(etag: str, last_modified: Optional[float], cache_control: str, vary: Optional[str] = None) -> Dict[str, str]:
+    """Headers shared by the 200 and the 304 of a representation"""
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if last_modified is not None:
+        headers["Last-Modified"] = formatdate(last_modified, usegmt=True)
+    if vary:
+        headers["Vary"] = vary
+    return headers
+
+
+class CacheControlPolicy:
+    """
+    Cache-Control value per request path, from glob patterns (first match wins, in the order given), e.g. from CACHE_CONTROL_POLICIES
+    {"/stravajson/summary-*": "public, max-age=300", "/strava-charts": "public, max-age=3600"}
+    """
+
+    def __init__(self, policies: Optional[Dict[str, str]] = None, default: str = DEFAULT_CACHE_CONTROL):
+        self.policies = list((policies or {}).items())
+        self.default = default
+
+    def for_path(self, path: str) -> str:
+        return next((value for pattern, value in self.policies if fnmatchcase(path, pattern)), self.default)
+
+
+class ExpiringCache:
+    """
+    Small in-memory cache with a time to live, for responses backed by Postgres (the chart embeds) so that revalidations are answered
+    without a query. Writers in this process invalidate their keys, writes from other workers are picked up after the ttl.
+    """
+
+    def __init__(self, ttl: float, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: Dict[str, Tuple[float, Any]] = {}  # key -> (expires at, value)
+        self.counters = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.counters["misses"] += 1
+            return None
+        self.counters["hits"] += 1
+        return entry[1]
+
+    def set(self, key: str, value: Any) -> None:
+        if len(self._entries) >= self.max_entries:
+            now = time.monotonic()
+            self._entries = {k: entry for k, entry in self._entries.items() if entry[0] >= now}
+            if len(self._entries) >= self.max_entries:
+                self._entries.pop(next(iter(self._entries)))
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+
+    def invalidate(self, key: str) -> None:
+        self.counters["invalidations"] += 1
+        self._entries.pop(key, None)
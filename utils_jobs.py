@@ -0,0 +1,217 @@
+import asyncio
+import os
+import random
+import socket
+import time
+from decimal import Decimal
+from typing import Any, Awaitable, Callable, Dict, Optional
+import asyncpg
+from loguru import logger
+
+
+class JobQueue:
+    """
+    Durable job queue on main.job_queue (see sql_postgres_strava_init.sql), replacing in-process BackgroundTasks.
+
+    Jobs survive worker restarts and are spread across every uvicorn worker / node running a JobQueue: each worker claims jobs with
+    FOR UPDATE SKIP LOCKED, failed jobs are retried with exponential backoff, and jobs left 'running' by a dead worker are requeued
+    after `visibility_timeout` seconds. Jobs with a dedupe_key are merged while queued, and never run concurrently with each other.
+
+    job_queue.register("strava_webhook", handle_strava_webhook)
+    await job_queue.enqueue("strava_webhook", webhook_json)
+    await job_queue.start()
+    """
+
+    def __init__(
+        self,
+        db,
+        concurrency: int = 2,
+        poll_interval: float = 1.0,
+        max_attempts: int = 5,
+        backoff_base: float = 5.0,
+        backoff_max: float = 600.0,
+        visibility_timeout: float = 1800.0,
+        retention_days: int = 7,
+    ):
+        self.db = db
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.visibility_timeout = visibility_timeout
+        self.retention_days = retention_days
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._handlers: Dict[str, Callable[[Dict[str, Any]], Awaitable[Any]]] = {}
+        self._workers = []
+        self._stopping = asyncio.Event()
+        self.counters = {"enqueued": 0, "deduplicated": 0, "succeeded": 0, "retried": 0, "failed": 0}
+
+    def register(self, job_type: str, handler: Callable[[Dict[str, Any]], Awaitable[Any]]) -> None:
+        """Register the coroutine that runs jobs of `job_type`, it receives the job payload"""
+        self._handlers[job_type] = handler
+
+    async def enqueue(
+        self, job_type: str, payload: Dict[str, Any], priority: int = 0, delay: float = 0, dedupe_key: Optional[str] = None, max_attempts: Optional[int] = None
+    ) -> bool:
+        """
+        Add a job, lower priority runs first. Returns False if a queued job with the same dedupe_key already exists (the two are merged).
+        """
+        status = await self.db.execute(
+            """
+            INSERT INTO main.job_queue (job_type, payload, priority, run_at, dedupe_key, max_attempts)
+            VALUES ($1, $2, $3, CURRENT_TIMESTAMP + make_interval(secs => $4), $5, $6)
+            ON CONFLICT (dedupe_key) WHERE status = 'queued' DO NOTHING
+            """,
+            job_type,
+            payload,
+            priority,
+            float(delay),
+            dedupe_key,
+            max_attempts or self.max_attempts,
+        )
+        inserted = status.endswith(" 1")
+        self.counters["enqueued" if inserted else "deduplicated"] += 1
+        return inserted
+
+    async def _claim(self) -> Optional[Dict[str, Any]]:
+        return await self.db.fetch_one(
+            """
+            UPDATE main.job_queue SET status = 'running', started_at = CURRENT_TIMESTAMP, attempts = attempts + 1, locked_by = $1
+            WHERE id = (
+                SELECT q.id FROM main.job_queue q
+                WHERE q.status = 'queued' AND q.run_at <= CURRENT_TIMESTAMP
+                  AND (q.dedupe_key IS NULL OR NOT EXISTS (
+                      SELECT 1 FROM main.job_queue r WHERE r.status = 'running' AND r.dedupe_key = q.dedupe_key))
+                ORDER BY q.priority, q.run_at
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, job_type, payload, attempts, max_attempts, run_at
+            """,
+            self.worker_id,
+        )
+
+    def _backoff(self, attempts: int) -> float:
+        """Exponential backoff with full jitter"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1)))
+
+    async def _run_job(self, job: Dict[str, Any]) -> None:
+        handler = self._handlers.get(job["job_type"])
+        started = time.perf_counter()
+        try:
+            if handler is None:
+                raise ValueError(f"No handler registered for job type {job['job_type']}")
+            await handler(job["payload"])
+        except Exception as e:
+            if job["attempts"] >= job["max_attempts"]:
+                self.counters["failed"] += 1
+                logger.exception(f"Job {job['id']} ({job['job_type']}) failed permanently after {job['attempts']} attempts: {str(e)}")
+                await self.db.execute(
+                    "UPDATE main.job_queue SET status = 'failed', finished_at = CURRENT_TIMESTAMP, last_error = $2 WHERE id = $1", job["id"], str(e)
+                )
+            else:
+                self.counters["retried"] += 1
+                delay = self._backoff(job["attempts"])
+                logger.warning(f"Job {job['id']} ({job['job_type']}) attempt {job['attempts']} failed, retrying in {delay:.0f}s: {str(e)}")
+                # Back to queued, unless an identical job was queued meanwhile (then this one is merged into it)
+                try:
+                    await self.db.execute(
+                        """
+                        UPDATE main.job_queue q SET status = CASE WHEN EXISTS (
+                                SELECT 1 FROM main.job_queue d WHERE d.status = 'queued' AND d.dedupe_key = q.dedupe_key) THEN 'done' ELSE 'queued' END,
+                            run_at = CURRENT_TIMESTAMP + make_interval(secs => $2), finished_at = CURRENT_TIMESTAMP, last_error = $3
+                        WHERE id = $1
+                        """,
+                        job["id"],
+                        delay,
+                        str(e),
+                    )
+                except asyncpg.UniqueViolationError:
+                    # The identical job was enqueued after the EXISTS check above, it runs instead of this one
+                    await self.db.execute(
+                        "UPDATE main.job_queue SET status = 'done', finished_at = CURRENT_TIMESTAMP, last_error = $2 WHERE id = $1",
+                        job["id"],
+                        f"superseded by a queued duplicate after: {str(e)}",
+                    )
+        else:
+            # Outside the try, a failure to record success is not a failure of the job (see _worker)
+            await self.db.execute("UPDATE main.job_queue SET status = 'done', finished_at = CURRENT_TIMESTAMP WHERE id = $1", job["id"])
+            self.counters["succeeded"] += 1
+            logger.info(f"Job {job['id']} ({job['job_type']}) done in {time.perf_counter() - started:.2f}s")
+
+    async def _worker(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                job = await self._claim()
+            except Exception as e:
+                logger.error(f"Failed to claim job: {str(e)}")
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._run_job(job)
+            except Exception as e:
+                # Only the bookkeeping UPDATEs get here (e.g. the database is unreachable), the job stays 'running' until the
+                # reaper requeues it, and this worker carries on
+                logger.exception(f"Failed to record the outcome of job {job['id']} ({job['job_type']}): {str(e)}")
+
+    async def _reaper(self) -> None:
+        """Requeues jobs whose worker died mid-run and trims finished jobs past the retention period"""
+        while not self._stopping.is_set():
+            try:
+                await self.db.execute(
+                    """
+                    UPDATE main.job_queue q SET status = CASE WHEN EXISTS (
+                            SELECT 1 FROM main.job_queue d WHERE d.status = 'queued' AND d.dedupe_key = q.dedupe_key) THEN 'done' ELSE 'queued' END,
+                        run_at = CURRENT_TIMESTAMP, finished_at = CURRENT_TIMESTAMP, last_error = 'worker timed out'
+                    WHERE status = 'running' AND started_at < CURRENT_TIMESTAMP - make_interval(secs => $1)
+                    """,
+                    self.visibility_timeout,
+                )
+                await self.db.execute(
+                    "DELETE FROM main.job_queue WHERE status IN ('done', 'failed') AND finished_at < CURRENT_TIMESTAMP - make_interval(days => $1)",
+                    self.retention_days,
+                )
+            except Exception as e:
+                logger.error(f"Job queue reaper failed: {str(e)}")
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=60)
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self) -> None:
+        self._stopping.clear()
+        self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self.concurrency)]
+        self._workers.append(asyncio.ensure_future(self._reaper()))
+        logger.info(f"Job queue started with {self.concurrency} workers ({self.worker_id})")
+
+    async def stop(self) -> None:
+        """Stop claiming new jobs and wait for running ones to finish"""
+        self._stopping.set()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        logger.info("Job queue stopped")
+
+    async def stats(self) -> Dict[str, Any]:
+        """Queue depth and latency per status and job type, plus this worker's counters"""
+        rows = await self.db.fetch_all(
+            """
+            SELECT job_type, status, COUNT(*) AS jobs,
+                   EXTRACT(EPOCH FROM MAX(CURRENT_TIMESTAMP - run_at) FILTER (WHERE status = 'queued' AND run_at <= CURRENT_TIMESTAMP)) AS oldest_wait_s,
+                   EXTRACT(EPOCH FROM AVG(started_at - run_at) FILTER (WHERE status = 'done')) AS avg_queue_latency_s,
+                   EXTRACT(EPOCH FROM AVG(finished_at - started_at) FILTER (WHERE status = 'done')) AS avg_run_s
+            FROM main.job_queue
+            GROUP BY job_type, status
+            """
+        )
+        queue = {}
+        for row in rows:
+            queue.setdefault(row["job_type"], {})[row["status"]] = {
+                key: (float(value) if isinstance(value, Decimal) else value) for key, value in row.items() if key not in ("job_type", "status")
+            }
+        return {"worker_id": self.worker_id, "counters": self.counters, "queue": queue}
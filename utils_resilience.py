@@ -0,0 +1,173 @@
+"""
+Retries, backoff and circuit breaking for the external APIs (Strava, Datawrapper), one Upstream per API and worker.
+
+A call is retried on transport errors, 429 and 5xx with jittered exponential backoff, waiting for Retry-After when the upstream sends
+one. Calls that are not idempotent (POST) are only retried when the request never reached the upstream (connect errors, 429, 503).
+After `failure_threshold` consecutive failures (transport errors, 5xx) the circuit opens: calls fail fast with CircuitOpenError for
+`reset_timeout` seconds, then a single probe call decides whether it closes again.
+
+datawrapper_upstream = Upstream("datawrapper", timeouts={"/charts/*/publish": 60})
+response = asyncio.run(datawrapper_upstream.call(lambda timeout: client.request("GET", "/charts/q6gP0", timeout=timeout), "/charts/q6gP0"))
+"""
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+from fnmatch import fnmatchcase
+from typing import Any, Awaitable, Callable, Dict, Optional
+import httpx
+from loguru import logger
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Statuses that mean the request was not processed, safe to retry for any method
+UNPROCESSED_STATUSES = {429, 503}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+
+
+class CircuitOpenError(Exception):
+    """The upstream's circuit is open, the call was not attempted"""
+
+    def __init__(self, upstream: str, retry_in: float):
+        super().__init__(f"{upstream} circuit open, retry in {retry_in:.0f}s")
+        self.upstream = upstream
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """closed (calls go through) -> open after failure_threshold consecutive failures -> half_open after reset_timeout (one probe)"""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    def retry_in(self) -> float:
+        return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        if self.state == "open" and self.retry_in() == 0:
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+        return self.state == "closed"
+
+    def release_probe(self) -> None:
+        """The probe call ended without an answer either way (e.g. cancelled), the next call probes instead"""
+        self._probe_in_flight = False
+
+    def record_success(self) -> None:
+        self.state, self.consecutive_failures, self._probe_in_flight = "closed", 0, False
+
+    def record_failure(self) -> bool:
+        """True when this failure opened the circuit"""
+        self.consecutive_failures += 1
+        was_probe, self._probe_in_flight = self._probe_in_flight, False
+        if self.state != "open" and (was_probe or self.consecutive_failures >= self.failure_threshold):
+            self.state, self._opened_at = "open", time.monotonic()
+            return True
+        return False
+
+
+def retry_after_seconds(response: httpx.Response) -> Optional[float]:
+    """Retry-After as seconds (delta-seconds or an HTTP date), None when absent or invalid"""
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class Upstream:
+    """
+    Resilience policy of one external API: per-endpoint timeouts (glob patterns on the request path, first match wins),
+    retries with backoff and a circuit breaker, with success / retry / failure / open-circuit counters.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_attempts: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30.0,
+        max_retry_after: float = 120.0,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        timeouts: Optional[Dict[str, float]] = None,
+    ):
+        self.name = name
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_retry_after = max_retry_after
+        self.timeouts = list((timeouts or {}).items())
+        self.breaker = CircuitBreaker(failure_threshold=failure_threshold, reset_timeout=reset_timeout)
+        self.counters = {"successes": 0, "client_errors": 0, "retries": 0, "failures": 0, "circuit_rejections": 0, "circuit_opened": 0}
+
+    def timeout_for(self, path: str) -> Optional[float]:
+        """The endpoint's timeout in seconds, None for the client's default"""
+        return next((timeout for pattern, timeout in self.timeouts if fnmatchcase(path, pattern)), None)
+
+    def backoff(self, attempt: int) -> float:
+        """Full jitter: uniform between 0 and base * 2^(attempt - 1), capped at backoff_max"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    def _record_failure(self) -> None:
+        if self.breaker.record_failure():
+            self.counters["circuit_opened"] += 1
+            logger.warning(f"{self.name} circuit opened after {self.breaker.consecutive_failures} consecutive failures")
+
+    async def call(self, send: Callable[[Optional[float]], Awaitable[httpx.Response]], path: str, method: str = "GET") -> httpx.Response:
+        """
+        Run send(timeout) until it gives a response that is not worth retrying, or attempts run out (the last response is returned,
+        the last transport error is raised). Raises CircuitOpenError without calling send while the circuit is open.
+        """
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        timeout = self.timeout_for(path)
+        for attempt in range(1, self.max_attempts + 1):
+            if not self.breaker.allow():
+                self.counters["circuit_rejections"] += 1
+                raise CircuitOpenError(self.name, self.breaker.retry_in())
+            try:
+                response = await send(timeout)
+            except httpx.TransportError as e:
+                self._record_failure()
+                # A POST that may have reached the upstream is not sent twice
+                retryable = idempotent or isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+                if not retryable or attempt == self.max_attempts or self.breaker.state == "open":
+                    self.counters["failures"] += 1
+                    raise
+                delay, reason = self.backoff(attempt), f"{e.__class__.__name__}: {e}"
+            except BaseException:
+                self.breaker.release_probe()
+                raise
+            else:
+                if response.status_code >= 500:
+                    self._record_failure()
+                else:
+                    # 4xx included, the upstream is up and answering
+                    self.breaker.record_success()
+                retryable = response.status_code in (RETRY_STATUSES if idempotent else UNPROCESSED_STATUSES)
+                retry_after = retry_after_seconds(response) if retryable else None
+                if not retryable or attempt == self.max_attempts or self.breaker.state == "open" or (retry_after or 0) > self.max_retry_after:
+                    self.counters["successes" if response.status_code < 400 else "client_errors" if response.status_code < 500 else "failures"] += 1
+                    return response
+                delay, reason = retry_after if retry_after is not None else self.backoff(attempt), f"HTTP {response.status_code}"
+
+            self.counters["retries"] += 1
+            logger.warning(f"{self.name} {method} {path} failed ({reason}), retry {attempt}/{self.max_attempts - 1} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.counters, "circuit_state": self.breaker.state, "consecutive_failures": self.breaker.consecutive_failures}
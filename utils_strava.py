@@ -1,12 +1,22 @@
-from app_instance import strava_client_id, strava_client_secret, weekday_mapping_dic, month_mapping_dic, dw
-import requests
+from app_instance import strava_client_id, dw, strava, strava_tokens
 from loguru import logger
 from datetime import datetime, timezone
-from app_instance import db, sg_timezone
+from app_instance import db, sg_timezone, strava_backfill_window, strava_sync_overlap_hours, analytics_debounce_seconds, analytics_mode
+from app_instance import analytics_executor, activity_cache, analytics_store, chart_cache
+from app_instance import bot_app, logger_bot_app, kenny_chat_id, job_queue
+import asyncio
 import json
-import pandas as pd
-from utils import custom_hash, format_week_year_to_readable_dates
-from utils_datawrapper_config import hex_colour_lst, distance_category_lst, strava_activity_type_lst
+from contextlib import asynccontextmanager
+import os
+import time
+from utils import custom_hash
+from utils_analytics import compute_analytics_and_aggregates, render_analytics, apply_activity_delta, AnalyticsRebuildRequired
+from utils_analytics_sql import ANALYTICS_COLUMNS, fetch_analytics_rows, fetch_analytics_aggregates, fetch_first_name
+from utils_activity_cache import compute_cached_analytics
+from utils_strava_mapper import map_activities
+from utils_debounce import KeyedDebouncer
+from utils_strava_client import strava_priority, BULK
+from utils_datawrapper_config import CHART_SPECS
 
 
 def strava_onboarding(user_chat_id, weblink):
@@ -28,200 +38,179 @@ def strava_onboarding(user_chat_id, weblink):
     return welcome_text
 
 
-def retrieve_refresh_token(code):
-    http_link = "https://www.strava.com/oauth/token"
-    data = {"client_id": strava_client_id, "client_secret": strava_client_secret, "grant_type": "authorization_code", "code": code}
-    response = requests.post(http_link, data)
-    credentials_dic = response.json()
+async def retrieve_refresh_token(code):
+    credentials_dic = await strava.exchange_code(code)
     return credentials_dic
 
 
-def retrieve_access_token(special_refresh_token):
-    http_link = "https://www.strava.com/oauth/token"
-    data = {
-        "client_id": strava_client_id,
-        "grant_type": "refresh_token",
-        "refresh_token": special_refresh_token,
-        "client_secret": strava_client_secret,
-    }
-    response = requests.post(http_link, data)
-    credentials_dic = response.json()
-    special_access_token = credentials_dic["access_token"]
+async def retrieve_access_token(strava_id):
+    """
+    Access tokens are cached per athlete and only refreshed close to expiry (see StravaTokenCache).
+    Returns None if the athlete is not in main.botdata_v2.
+    """
+    special_access_token = await strava_tokens.get_access_token(strava_id)
     return special_access_token
 
 
-async def retrieve_full_data_from_strava(special_refresh_token):
+async def fetch_activity_pages(access_token, per_page=200, max_window=None, **params):
+    """
+    Async generator over /athlete/activities pages (latest activity first), yielded in page order.
+
+    Pages are prefetched concurrently with a window that starts at 1 and doubles up to `max_window` after every full page,
+    so the common single-page athlete costs one request while heavy athletes get `max_window` requests in flight.
+    Iteration stops at the first page shorter than `per_page`, prefetched pages beyond it are cancelled.
+
+    async for activities in fetch_activity_pages(access_token): ...
+    """
+    max_window = max_window or strava_backfill_window
+    in_flight, next_page, window = {}, 1, 1
+    try:
+        while True:
+            while len(in_flight) < window:
+                in_flight[next_page] = asyncio.ensure_future(strava.get_athlete_activities(access_token, page=next_page, per_page=per_page, **params))
+                next_page += 1
+
+            activities = await in_flight.pop(min(in_flight))
+            yield activities
+
+            if len(activities) < per_page:  # Last page
+                break
+            window = min(window * 2, max_window)
+    finally:
+        for task in in_flight.values():
+            task.cancel()
+
+
+async def retrieve_full_data_from_strava(strava_id, per_page=200, max_window=None, after=None, seen_activity_ids=None):
     """
     Collects data from strava in chronlogical order, with the latest run on TOP (page 1).
     Usually every athlete will only have one page, more active runners will have more than 1 page (I will have 2 for example).
+    Each page is converted and upserted as soon as it arrives, so the full history is never held in memory.
+
+    after: only fetch activities that started after this epoch timestamp (see sync_recent_data_from_strava)
+    seen_activity_ids: optional set, filled with every activity_id returned by Strava (see reconcile_data_from_strava)
 
     Should not be called often, only during the onboarding process.
-    asyncio.run(retrieve_full_data_from_strava(special_refresh_token))
+    asyncio.run(retrieve_full_data_from_strava(strava_id))
     """
-    access_token = retrieve_access_token(special_refresh_token)
-    http_link = f"https://www.strava.com/api/v3/athlete/activities?access_token={access_token}&per_page=200&page=1"
-    headers = {"Authorization": f"Bearer {access_token}"}
-    all_activities, page = [], 1
+    access_token = await retrieve_access_token(strava_id)
+    if access_token is None:
+        logger.info(f"Skipping full data retrieval, {strava_id} not found in DB")
+        return {"status": "error", "message": f"strava_id {strava_id} not found in DB"}
+    activities_count, pages_count = 0, 0
+    params = {"after": after} if after is not None else {}
 
     # Paginate through all activities
     try:
-        while True:
-            params = {"per_page": 200, "page": page}
-            response = requests.get(http_link, headers=headers, params=params)
-            activities = response.json()
-
-            if not activities:  # No more activities
-                break
-
-            all_activities.extend(activities)
-            page += 1
+        async for activities in fetch_activity_pages(access_token, per_page=per_page, max_window=max_window, **params):
+            # Convert the page to database format
+            db_activities = map_activities(activities, updated_at=datetime.now(timezone.utc).astimezone(sg_timezone))
+
+            # Bulk upsert activities into database
+            # asyncio.run(db.connect())
+            # asyncio.run(db.bulk_upsert(table='main.strava_activities', data=db_activities, constraint_columns=['strava_id', 'activity_id']))
+            await db.bulk_upsert(table="main.strava_activities", data=db_activities, constraint_columns=["strava_id", "activity_id"])
+            activities_count += len(db_activities)
+            pages_count += 1
+            if seen_activity_ids is not None:
+                seen_activity_ids.update(db_activity.activity_id for db_activity in db_activities)
 
     except Exception as e:
         logger.error(f"Error while fetching Strava data: {str(e)}")
-        return {"status": "error", "message": f"Unexpected error: {str(e)}"}
-
-    # Prepare activities for database storage
-    db_activities = []
-    for activity in all_activities:
-        # Convert activity to database format
-        db_activity = {
-            "strava_id": str(activity["athlete"]["id"]),
-            "hashed_strava_id": custom_hash(str(activity["athlete"]["id"])),
-            "activity_id": str(activity["id"]),
-            "name": activity["name"],
-            "distance": activity["distance"],
-            "moving_time": activity["moving_time"],
-            "elapsed_time": activity["elapsed_time"],
-            "total_elevation_gain": activity["total_elevation_gain"],
-            "type": activity["type"],
-            "sport_type": activity.get("sport_type"),
-            "workout_type": activity.get("workout_type"),
-            "start_date": datetime.strptime(activity["start_date"], "%Y-%m-%dT%H:%M:%SZ"),
-            "start_date_local": datetime.strptime(activity["start_date_local"], "%Y-%m-%dT%H:%M:%SZ"),
-            "timezone": activity.get("timezone"),
-            "utc_offset": activity.get("utc_offset"),
-            "start_latlng": json.dumps(activity.get("start_latlng")),
-            "end_latlng": json.dumps(activity.get("end_latlng")),
-            "location_country": activity.get("location_country"),
-            "achievement_count": activity.get("achievement_count", 0),
-            "kudos_count": activity.get("kudos_count", 0),
-            "comment_count": activity.get("comment_count", 0),
-            "athlete_count": activity.get("athlete_count", 0),
-            "photo_count": activity.get("photo_count", 0),
-            "trainer": activity.get("trainer", False),
-            "commute": activity.get("commute", False),
-            "manual": activity.get("manual", False),
-            "private": activity.get("private", False),
-            "flagged": activity.get("flagged", False),
-            "gear_id": activity.get("gear_id"),
-            "average_speed": activity.get("average_speed"),
-            "max_speed": activity.get("max_speed"),
-            "average_cadence": activity.get("average_cadence"),
-            "average_watts": activity.get("average_watts"),
-            "weighted_average_watts": activity.get("weighted_average_watts"),
-            "kilojoules": activity.get("kilojoules"),
-            "device_watts": activity.get("device_watts", False),
-            "has_heartrate": activity.get("has_heartrate", False),
-            "average_heartrate": activity.get("average_heartrate"),
-            "max_heartrate": activity.get("max_heartrate"),
-            "max_watts": activity.get("max_watts"),
-            "pr_count": activity.get("pr_count", 0),
-            "total_photo_count": activity.get("total_photo_count", 0),
-            "has_kudoed": activity.get("has_kudoed", False),
-            "updated_at": datetime.now(timezone.utc).astimezone(sg_timezone),
-        }
-        db_activities.append(db_activity)
-
-    # Bulk upsert activities into database
-    # asyncio.run(db.connect())
-    # asyncio.run(db.bulk_upsert(table='main.strava_activities', data=db_activities, constraint_columns=['strava_id', 'activity_id'], batch_size=100))
-    await db.bulk_upsert(table="main.strava_activities", data=db_activities, constraint_columns=["strava_id", "activity_id"], batch_size=100)
+        return {"status": "error", "message": f"Unexpected error: {str(e)}", "activities_count": activities_count}
 
+    if activity_cache is not None and activities_count:
+        activity_cache.invalidate(strava_id)
     logger.info(
-        f"Successfully upserted (updated) FULL {len(db_activities)} activities for user {activity['athlete']['id']} "
-        f"at {datetime.now(timezone.utc).astimezone(sg_timezone)}"
+        f"Successfully upserted (updated) {'FULL' if after is None else f'AFTER {after}'} {activities_count} activities ({pages_count} pages) "
+        f"for user {strava_id} at {datetime.now(timezone.utc).astimezone(sg_timezone)}"
     )
 
-    return {"status": "success", "activities_count": len(db_activities), "data": all_activities}
+    return {"status": "success", "activities_count": activities_count}
 
 
-async def create_update_data_from_strava(webhook_json):
+async def sync_recent_data_from_strava(strava_id, overlap_hours=None):
     """
-    This function will be called from webhook (Create/Update)
+    Incremental sync - only asks Strava for activities that started after the athlete's latest stored start_date,
+    minus a small overlap window for late uploads. Falls back to a full retrieval for athletes with no stored activities.
+    Edits and deletions of older activities are picked up by webhooks, or by reconcile_data_from_strava.
 
-    webhook_json = {"aspect_type": "update", "event_time": 1734080686, "object_id": 13105339270, "object_type": "activity", "owner_id": 28923822, "subscription_id": 143570, "updates": {"title": "spontaneous run with oliver"}}
-    webhook_json = {"aspect_type": "create", "event_time": 1734361442, "object_id": 13127941701, "object_type": "activity", "owner_id": 28923822, "subscription_id": 143570, "updates": {}}
+    asyncio.run(sync_recent_data_from_strava(28923822))
     """
-    owner_id, activity_id = webhook_json["owner_id"], webhook_json["object_id"]
-    # asyncio.run(db.connect())
-    # special_refresh_token_output = asyncio.run(db.fetch_one(f"SELECT refresh_token FROM main.botdata_v2 WHERE strava_id = $1", str(owner_id)))
-    special_refresh_token_output = await db.fetch_one("SELECT refresh_token FROM main.botdata_v2 WHERE strava_id = $1", str(owner_id))
-    if special_refresh_token_output is None:
-        logger.info(f"STRAVA WEBHOOK SKIP (strava webhook subscribed but didn't record data into DB). for webhook {webhook_json}")
-        return False
+    overlap_hours = strava_sync_overlap_hours if overlap_hours is None else overlap_hours
+    latest = await db.fetch_one("SELECT MAX(start_date) AS latest_start_date FROM main.strava_activities WHERE strava_id = $1", str(strava_id))
+    if latest is None or latest["latest_start_date"] is None:
+        logger.info(f"No stored activities for {strava_id}, running full retrieval")
+        return await retrieve_full_data_from_strava(strava_id)
+
+    # start_date is stored as UTC without a timezone
+    after = int(latest["latest_start_date"].replace(tzinfo=timezone.utc).timestamp() - overlap_hours * 3600)
+    return await retrieve_full_data_from_strava(strava_id, after=after)
+
+
+async def reconcile_data_from_strava(strava_id):
+    """
+    Slow path - re-downloads the full history to pick up edits, then soft deletes stored activities that Strava no longer returns
+    (and restores soft deleted ones that it does). Only meant for the occasional repair, webhooks and the incremental sync cover the rest.
+
+    asyncio.run(reconcile_data_from_strava(28923822))
+    """
+    seen_activity_ids = set()
+    result = await retrieve_full_data_from_strava(strava_id, seen_activity_ids=seen_activity_ids)
+    if result["status"] != "success":
+        logger.warning(f"Skipping reconcile deletions for {strava_id}, retrieval did not complete: {result}")
+        return result
+
+    seen_activity_ids = list(seen_activity_ids)
+    deleted = await db.update(
+        "UPDATE main.strava_activities SET is_deleted = TRUE WHERE strava_id = $1 AND is_deleted = FALSE AND NOT (activity_id = ANY($2::text[]))",
+        str(strava_id),
+        seen_activity_ids,
+    )
+    restored = await db.update(
+        "UPDATE main.strava_activities SET is_deleted = FALSE WHERE strava_id = $1 AND is_deleted = TRUE AND activity_id = ANY($2::text[])",
+        str(strava_id),
+        seen_activity_ids,
+    )
+    # db.update returns the command status, e.g. "UPDATE 5"
+    deleted, restored = int(deleted.split()[-1]), int(restored.split()[-1])
+    if activity_cache is not None:
+        activity_cache.invalidate(strava_id)
+    logger.info(f"Reconciled activities for {strava_id}: {deleted} soft deleted, {restored} restored")
+    return {**result, "deleted": deleted, "restored": restored}
 
-    special_refresh_token = special_refresh_token_output["refresh_token"]
-    access_token = retrieve_access_token(special_refresh_token)
 
-    # Get activity details from Strava
-    headers = {"Authorization": f"Bearer {access_token}"}
-    activity_url = f"https://www.strava.com/api/v3/activities/{activity_id}"
+async def fetch_activity_from_strava(access_token, webhook_json):
+    """
+    Strava's current version of the webhook's activity, mapped to a main.strava_activities record, None when it could not be fetched.
+    Called before create_update_data_from_strava takes the athlete's analytics lock, so the Strava round
+    trip (and its rate limit waits and retries) never holds it.
 
+    webhook_json = {"aspect_type": "update", "event_time": 1734080686, "object_id": 13105339270, "object_type": "activity", "owner_id": 28923822, "subscription_id": 143570, "updates": {"title": "spontaneous run with oliver"}}
+    webhook_json = {"aspect_type": "create", "event_time": 1734361442, "object_id": 13127941701, "object_type": "activity", "owner_id": 28923822, "subscription_id": 143570, "updates": {}}
+    """
+    activity_id = webhook_json["object_id"]
     try:
-        response = requests.get(activity_url, headers=headers)
-        activity = response.json()
+        # Get activity details from Strava
+        activity = await strava.get_activity(access_token, activity_id)
 
         # Convert activity to database format
-        db_activity = {
-            "strava_id": str(activity["athlete"]["id"]),
-            "hashed_strava_id": custom_hash(str(activity["athlete"]["id"])),
-            "activity_id": str(activity["id"]),
-            "name": activity["name"],
-            "distance": activity["distance"],
-            "moving_time": activity["moving_time"],
-            "elapsed_time": activity["elapsed_time"],
-            "total_elevation_gain": activity["total_elevation_gain"],
-            "type": activity["type"],
-            "sport_type": activity.get("sport_type"),
-            "workout_type": activity.get("workout_type"),
-            "start_date": datetime.strptime(activity["start_date"], "%Y-%m-%dT%H:%M:%SZ"),
-            "start_date_local": datetime.strptime(activity["start_date_local"], "%Y-%m-%dT%H:%M:%SZ"),
-            "timezone": activity.get("timezone"),
-            "utc_offset": activity.get("utc_offset"),
-            "start_latlng": json.dumps(activity.get("start_latlng")),
-            "end_latlng": json.dumps(activity.get("end_latlng")),
-            "location_country": activity.get("location_country"),
-            "achievement_count": activity.get("achievement_count", 0),
-            "kudos_count": activity.get("kudos_count", 0),
-            "comment_count": activity.get("comment_count", 0),
-            "athlete_count": activity.get("athlete_count", 0),
-            "photo_count": activity.get("photo_count", 0),
-            "trainer": activity.get("trainer", False),
-            "commute": activity.get("commute", False),
-            "manual": activity.get("manual", False),
-            "private": activity.get("private", False),
-            "flagged": activity.get("flagged", False),
-            "gear_id": activity.get("gear_id"),
-            "average_speed": activity.get("average_speed"),
-            "max_speed": activity.get("max_speed"),
-            "average_cadence": activity.get("average_cadence"),
-            "average_watts": activity.get("average_watts"),
-            "weighted_average_watts": activity.get("weighted_average_watts"),
-            "kilojoules": activity.get("kilojoules"),
-            "device_watts": activity.get("device_watts", False),
-            "has_heartrate": activity.get("has_heartrate", False),
-            "average_heartrate": activity.get("average_heartrate"),
-            "max_heartrate": activity.get("max_heartrate"),
-            "max_watts": activity.get("max_watts"),
-            "pr_count": activity.get("pr_count", 0),
-            "total_photo_count": activity.get("total_photo_count", 0),
-            "has_kudoed": activity.get("has_kudoed", False),
-            "updated_at": datetime.now(timezone.utc).astimezone(sg_timezone),
-        }
+        return map_activities([activity], updated_at=datetime.now(timezone.utc).astimezone(sg_timezone))[0]
+    except Exception as e:
+        logger.error(f"Error fetching webhook activity {activity_id}: {str(e)}. webhook id {webhook_json}")
+        return None
+
 
+async def create_update_data_from_strava(conn, webhook_json, db_activity):
+    """
+    This function will be called from webhook (Create/Update), with the record of fetch_activity_from_strava. Written on conn, so it
+    commits together with the analytics delta of the event.
+    """
+    owner_id, activity_id = webhook_json["owner_id"], webhook_json["object_id"]
+    try:
         # Upsert activity into database
         # asyncio.run(db.bulk_upsert(table='main.strava_activities', data=[db_activity], constraint_columns=['strava_id', 'activity_id']))
-        await db.bulk_upsert(table="main.strava_activities", data=[db_activity], constraint_columns=["strava_id", "activity_id"])
+        await db.bulk_upsert(table="main.strava_activities", data=[db_activity], constraint_columns=["strava_id", "activity_id"], conn=conn)
 
         logger.info(f"Successfully upserted activity {activity_id} for user {owner_id}")
         return True
@@ -230,9 +219,10 @@ async def create_update_data_from_strava(webhook_json):
         return False
 
 
-async def delete_activity_from_strava(webhook_json):
+async def delete_activity_from_strava(conn, webhook_json):
     """
-    skipping the verification step (to strava), will just shift the is_deleted column to true
+    skipping the verification step (to strava), will just shift the is_deleted column to true. Written on conn, like
+    create_update_data_from_strava.
     webhook_json = {"aspect_type": "delete", "event_time": 1732594651, "object_id": 12984504969, "object_type": "activity", "owner_id": 28923822, "subscription_id": 143570, "updates": {}}
     webhook_json = {"aspect_type": "create", "event_time": 1733143575, "object_id": 13029871322, "object_type": "activity", "owner_id": 28923822, "subscription_id": 143570, "updates": {}}
     webhook_json = {"aspect_type": "delete", "event_time": 1734361628, "object_id": 13127941701, "object_type": "activity", "owner_id": 28923822, "subscription_id": 143570, "updates": {}}
@@ -241,7 +231,7 @@ async def delete_activity_from_strava(webhook_json):
     try:
         # asyncio.run(db.connect())
         # asyncio.run(db.update(f"UPDATE main.strava_activities SET is_deleted = TRUE WHERE strava_id = $1 AND activity_id = $2", str(owner_id), str(activity_id)))
-        await db.update(
+        await conn.execute(
             "UPDATE main.strava_activities SET is_deleted = TRUE WHERE strava_id = $1 AND activity_id = $2", str(owner_id), str(activity_id)
         )
         logger.info(f"Successfully deleted activity {activity_id} for user {owner_id}")
@@ -251,9 +241,15 @@ async def delete_activity_from_strava(webhook_json):
         return False
 
 
-async def baseline_analytics(strava_id, upload_to_file=True):
+# Recomputes before giving up when webhook deltas keep landing while baseline_analytics computes its snapshot
+BASELINE_SNAPSHOT_ATTEMPTS = 3
+
+
+async def baseline_analytics(strava_id, upload_to_file=True, executor=None):
     """
-    Data Wrangling into an API
+    Data Wrangling into an API, the computation itself is compute_baseline_analytics (utils_analytics.py), or Postgres when
+    ANALYTICS_MODE=sql (utils_analytics_sql.py)
+    executor: concurrent.futures executor to run the pandas computation in, defaults to the ANALYTICS_PROCESSES process pool
     strava_id = 28923822
     asyncio.run(db.connect())
     activities = asyncio.run(db.fetch_all(f"SELECT * FROM main.strava_activities "
@@ -267,357 +263,377 @@ async def baseline_analytics(strava_id, upload_to_file=True):
     'gear_id', 'average_speed', 'max_speed', 'average_cadence', 'average_watts', 'weighted_average_watts', 'kilojoules', 'device_watts',
     'has_heartrate', 'average_heartrate', 'max_heartrate', 'max_watts', 'pr_count', 'total_photo_count', 'has_kudoed', 'updated_at', 'is_deleted']
     """
-    logger.info(f"Fetching baseline analytics for {strava_id}")
-    activities = await db.fetch_all(
-        "SELECT * FROM main.strava_activities "
-        "LEFT JOIN main.botdata_v2 ON main.strava_activities.strava_id = main.botdata_v2.strava_id "
-        "WHERE main.strava_activities.strava_id = $1 and main.strava_activities.is_deleted = false",
-        str(strava_id),
-    )
-    full_df = pd.DataFrame(activities)
-
-    # temp
-    full_df = full_df.sort_values(by="start_date_local", ascending=False)
-
-    # Basic Transformation
-    full_df = (
-        full_df.assign(
-            start_date_local=pd.to_datetime(full_df["start_date_local"]),
-            Weekday=lambda df: df["start_date_local"].dt.dayofweek.map(weekday_mapping_dic),
-            Year=lambda df: df["start_date_local"].dt.year,
-            IsoYear=lambda df: df["start_date_local"].dt.isocalendar().year,
-            Month=lambda df: df["start_date_local"].dt.month,
-            Day=lambda df: df["start_date_local"].dt.day,
-            Week=lambda df: df["start_date_local"].dt.isocalendar().week,
-            Hour=lambda df: df["start_date_local"].dt.hour,
-            distance_km=lambda df: df["distance"] / 1000,
-            moving_time_hours=lambda df: df["moving_time"] / 3600,
-            DayofYear=lambda df: df["start_date_local"].dt.dayofyear,
-        )
-        .query("Year >= 2000")
-        .assign(DayofYearBase=lambda df: (df["start_date_local"] - pd.Timestamp(f"{df['Year'].min()}-01-01")).dt.days)
-    )
+    logger.info(f"Fetching baseline analytics for {strava_id} ({analytics_mode} mode)")
+    first_name = await fetch_first_name(db, strava_id)
+    for attempt in range(1, BASELINE_SNAPSHOT_ATTEMPTS + 1):
+        # Read before the activities, a delta applied while computing makes the snapshot stale (it may or may not include the activity)
+        version = await db.fetch_one("SELECT version FROM main.strava_analytics_state WHERE strava_id = $1", str(strava_id))
+        version = version["version"] if version else None
+        if analytics_mode == "sql":
+            # Postgres does the grouping, only the aggregates come back
+            aggregates = await fetch_analytics_aggregates(db, strava_id)
+            analytics_results = await run_analytics(render_analytics, aggregates, first_name, sg_timezone, executor=executor)
+        else:
+            analytics_results, aggregates = await compute_pandas_analytics(strava_id, first_name, executor=executor)
+
+        async with analytics_lock(strava_id) as conn:
+            if await conn.fetchval("SELECT version FROM main.strava_analytics_state WHERE strava_id = $1", str(strava_id)) != version:
+                logger.info(f"Activity change applied while computing the analytics of {strava_id}, recomputing (attempt {attempt})")
+                continue
+            # Starting point for the incremental updates of update_analytics_for_activity
+            await conn.execute(
+                "INSERT INTO main.strava_analytics_state (strava_id, aggregates, updated_at) VALUES ($1, $2, CURRENT_TIMESTAMP) "
+                "ON CONFLICT (strava_id) DO UPDATE SET aggregates = EXCLUDED.aggregates, updated_at = EXCLUDED.updated_at, "
+                "version = main.strava_analytics_state.version + 1",
+                str(strava_id),
+                aggregates,
+            )
+            if upload_to_file:
+                await write_analytics_file(strava_id, analytics_results)
+        return analytics_results
+    raise RuntimeError(f"Analytics of {strava_id} kept changing while computing them ({BASELINE_SNAPSHOT_ATTEMPTS} attempts)")
+
+
+async def compute_pandas_analytics(strava_id, first_name, executor=None):
+    """compute_analytics_and_aggregates over the athlete's activity cache file (see utils_activity_cache.py), or over rows from the DB"""
+    if activity_cache is not None:
+        path = await activity_cache.ensure(db, strava_id)
+        try:
+            return await run_analytics(compute_cached_analytics, path, first_name, sg_timezone, executor=executor)
+        except FileNotFoundError:
+            logger.info(f"Activity cache of {strava_id} replaced while reading it, using the database")
+    activities = await fetch_analytics_rows(db, strava_id)
+    return await run_analytics(compute_analytics_and_aggregates, activities, first_name, sg_timezone, executor=executor)
+
+
+async def run_analytics(func, *args, executor=None):
+    """
+    Runs a pure utils_analytics function in the analytics process pool, so a heavy athlete does not stall the event loop
+    (webhooks, /stravajson, /text2sql). Runs inline when there is no pool (ANALYTICS_PROCESSES=0).
+    """
+    executor = executor or analytics_executor
+    if executor is None:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
 
-    # Workout Type Breakdown
-    # workout_breakdown = full_df['type'].value_counts().reset_index().rename(columns={'type': 'Workout Type', 'count': 'Count'})
-    workout_breakdown = pd.pivot_table(full_df, index="Year", columns="type", values="distance_km", aggfunc="count").fillna(0)
-    workout_percentages = (workout_breakdown.div(workout_breakdown.sum(axis=1), axis=0) * 100).round(1)
-    workout_activity_lst = workout_breakdown.columns.tolist()
-
-    # Running-specific analytics
-    running_df = full_df[full_df["type"].isin(["Run", "VirtualRun"])].copy()
-
-    # Heatmap json
-    current_year = datetime.now().year
-    current_year_running_df = running_df[running_df["Year"] == current_year].copy()
-    current_year_running_df["epoch_time"] = current_year_running_df["start_date"].apply(lambda x: str(int(x.timestamp())))
-    current_year_running_df.index = current_year_running_df["epoch_time"]
-    current_year_running_df["distance_km_round"] = current_year_running_df["distance_km"].apply(lambda x: int(x))
-
-    # Calculate running streaks
-    dates = running_df["start_date_local"].dt.date.sort_values().drop_duplicates()
-    dates_df = pd.DataFrame({"date": dates})
-    dates_df["diff"] = dates_df["date"].diff().dt.days
-    dates_df["streak_group"] = (dates_df["diff"] != 1).cumsum()
-    streak_lengths = dates_df.groupby("streak_group").size()
-
-    # Distance categorization
-    distance_bins = [0, 2.5, 5, 8, 10, 15, 21.0975, 25, 30, 42.195, 50, float("inf")]
-    distance_labels = ["Under 2.5km", "2.5km", "5km", "8km", "10km", "15km", "Half Marathon", "25km", "30km", "Marathon", "50km+"]
-
-    running_df["distance_type"] = pd.cut(running_df["distance_km"], bins=distance_bins, labels=distance_labels, right=False)
-    distance_distribution = (
-        pd.pivot_table(running_df, index="Year", columns="distance_type", values="distance_km", aggfunc="count", observed=False).fillna(0).transpose()
-    )
 
-    # Weekly and monthly aggregations
-    # Get the latest date and create a range of the last 20 weeks
-    max_year = running_df["IsoYear"].max()
-    max_week = running_df[running_df["IsoYear"] == max_year]["Week"].max()
-    latest_date = pd.to_datetime(f"{max_year}-{max_week:02d}-0", format="%Y-%U-%w")
-    date_range = pd.date_range(end=latest_date, periods=20, freq="W-SUN")
-    complete_weeks = pd.DataFrame({"IsoYear": date_range.year, "Week": date_range.isocalendar().week})
-
-    weekly_stats = (
-        running_df.groupby(["IsoYear", "Week"])
-        .agg({"distance_km": "sum", "moving_time_hours": "sum"})
-        .round(2)
-        .rename(columns={"distance_km": "Distance (km)", "moving_time_hours": "Time (h)"})
-        .reset_index()
-        .merge(complete_weeks, on=["IsoYear", "Week"], how="right")
-        .fillna(0)
-        .sort_values(["IsoYear", "Week"])
-    )
-    weekly_stats["WeekFormat"] = weekly_stats.apply(format_week_year_to_readable_dates, axis=1)
-
-    # Monthly Stats
-    monthly_stats = running_df.groupby(["Year", "Month"]).agg({"distance_km": "sum"}).rename(columns={"distance_km": "Distance (km)"}).reset_index()
-    pivoted_monthly_stats = (
-        monthly_stats.pivot(index="Month", columns="Year", values="Distance (km)")
-        .reindex(range(1, 13))  # ensure all months are present
-        .fillna(0.0)  # Fill NaN with 0
-        .round(1)
-    )  # Round to 1 decimal place
-    pivoted_monthly_stats.index = pivoted_monthly_stats.index.map(month_mapping_dic)
-
-    # Time of day analysis
-    time_of_day = running_df["Hour"].agg({"most_common_hour": lambda x: x.mode().iloc[0], "is_night_runner": lambda x: (x.mode().iloc[0] > 12)})
-
-    # Pace calculations
-    running_df = running_df.assign(
-        pace=lambda df: (df["moving_time"] / 60) / df["distance_km"],
-        pace_category=lambda df: pd.qcut(df["moving_time"] / df["distance_km"], q=5, labels=["Very Fast", "Fast", "Medium", "Slow", "Very Slow"]),
-    )
+async def write_analytics_file(strava_id, analytics_results):
+    await analytics_store.write(custom_hash(strava_id), analytics_results)
+    logger.info(f"Analytics results written to the analytics store for {strava_id}")
 
-    # Weekday analysis
-    weekday_stats = (
-        running_df.groupby("Weekday").agg({"distance_km": ["count", "mean", "sum"], "moving_time": "sum", "total_elevation_gain": "sum"}).round(2)
+
+@asynccontextmanager
+async def analytics_lock(strava_id):
+    """
+    Transaction holding the athlete's analytics lock (any worker process). Webhook events hold it from reading the activity's previous
+    row to applying the delta, baseline_analytics while it checks and writes its snapshot, so every change is applied exactly once.
+    """
+    async with db.transaction() as conn:
+        await conn.execute("SELECT pg_advisory_xact_lock(hashtext($1))", f"analytics_state:{strava_id}")
+        yield conn
+
+
+async def fetch_activity_for_analytics(conn, strava_id, activity_id):
+    """The columns of one activity the analytics aggregates depend on, None if it was never stored"""
+    row = await conn.fetchrow(
+        f"SELECT {ANALYTICS_COLUMNS} FROM main.strava_activities WHERE strava_id = $1 AND activity_id = $2",
+        str(strava_id),
+        str(activity_id),
     )
+    return dict(row) if row else None
+
+
+async def update_analytics_for_activity(conn, strava_id, activity_id, old_row, new_row):
+    """
+    Applies one activity change (old_row / new_row are fetch_activity_for_analytics before and after it) to the athlete's stored aggregates and rewrites
+    the dashboard JSON, in milliseconds instead of a full baseline_analytics over every activity.
+    Returns False when baseline_analytics is needed instead: no stored aggregates yet, or AnalyticsRebuildRequired (e.g. a record was removed).
 
-    # Year-over-year comparisons
-    monthly_stats_pivot = pd.pivot_table(monthly_stats, values="Distance (km)", columns="Month", index="Year", aggfunc="sum").fillna(0)
-    yoy_comparison = (
-        running_df.groupby("Year")
-        .agg({"distance_km": "sum", "moving_time_hours": "sum", "kudos_count": "sum", "total_elevation_gain": "sum"})
-        .rename(
-            columns={
-                "distance_km": "RunningDistance (km)",
-                "moving_time_hours": "Time (h) spent running",
-                "kudos_count": "Kudos",
-                "total_elevation_gain": "Elevation (m)",
-            }
+    conn holds the analytics_lock taken before old_row was read, its changes are rolled back on their own when this raises.
+    """
+    async with conn.transaction():
+        state = await conn.fetchrow(
+            "SELECT aggregates, (SELECT strava_firstname FROM main.botdata_v2 b WHERE b.strava_id = s.strava_id LIMIT 1) AS first_name "
+            "FROM main.strava_analytics_state s WHERE strava_id = $1 FOR UPDATE",
+            str(strava_id),
         )
-        .merge(monthly_stats_pivot, on=["Year"], how="left")
-        .round(2)
-    )
+        if state is None:
+            return False
+        aggregates = state["aggregates"]
+        try:
+            changed = apply_activity_delta(aggregates, old_row, new_row)
+        except AnalyticsRebuildRequired as e:
+            logger.info(f"Incremental analytics not possible for {strava_id} ({str(e)}), recomputing")
+            return False
+        if changed:
+            await conn.execute(
+                "UPDATE main.strava_analytics_state SET aggregates = $2, version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE strava_id = $1",
+                str(strava_id),
+                aggregates,
+            )
+            # Written under the lock so that concurrent events land in order
+            analytics_results = await run_analytics(render_analytics, aggregates, state["first_name"], sg_timezone)
+            await write_analytics_file(strava_id, analytics_results)
+    logger.info(f"Incremental analytics applied for activity {activity_id} of {strava_id} ({'changed' if changed else 'unchanged'})")
+    return True
+
+
+async def refresh_fleet(concurrency=4, executor=None, checkpoint_path=None, sync=True, progress_every=25):
+    """
+    Incremental sync then baseline_analytics for every approved athlete, so a change to the analytics reaches everyone (see fleet_refresh.py).
+    concurrency: athletes processed at once, executor: runs the pandas work (defaults to the ANALYTICS_PROCESSES process pool)
+    checkpoint_path: JSON file of finished athletes, an interrupted run resumes from it (failed athletes are retried)
 
-    # Compile results
-    analytics_results = {
-        "last_updated": datetime.now(timezone.utc).astimezone(sg_timezone).strftime("%d %B %Y, at %H:%M"),
-        "first_name": full_df["strava_firstname"].iloc[0],
-        "summary": {
-            "total_activities": str(int(len(full_df))),
-            "total_distance": f"{float(running_df['distance_km'].sum()):.2f}",
-            "total_elevation": f"{float(running_df['total_elevation_gain'].sum()):.2f}",
-            "total_time": str(int(running_df["moving_time"].sum())),
-            "total_kudos": str(int(running_df["kudos_count"].sum())),
-            "total_distance_current_year": f"{float(current_year_running_df['distance_km'].sum()):.2f}",
-        },
-        "streaks": {
-            "running_max": int(streak_lengths.max()),
-            "notrunning_max": int((dates_df["diff"] - 1).max()),
-            "current_streak": int(streak_lengths.iloc[-1]),
-        },
-        "latest_activity": {
-            "date": running_df["start_date_local"].iloc[0].strftime("%d %B %Y, at %H:%M"),  # "13 December 2024, at 16:06"
-            "distance": f"{float(running_df['distance_km'].iloc[0]):.2f}",
-            "type": running_df["type"].iloc[0],
-        },
-        "patterns": {
-            "most_common_hour": str(int(time_of_day["most_common_hour"])),
-            "favorite_day": running_df["Weekday"].mode().iloc[0],
-            "workout_types": workout_activity_lst,
-        },
-        "records": {
-            "longest_run": f"{float(running_df['distance_km'].max()):.2f}",
-            "fastest_pace": f"{float(running_df['pace'].min()):.2f}",
-            "highest_elevation": f"{float(running_df['total_elevation_gain'].max()):.2f}",
-        },
-        "aggregations": {
-            "weekly_stats": weekly_stats[["WeekFormat", "Distance (km)", "Time (h)"]].to_csv(index=False),  # DONE
-            "monthly_stats": pivoted_monthly_stats.to_csv(),  # DONE
-            "weekday_stats": weekday_stats.to_csv(index=False),  # havent decided on visualization
-            "distance_distribution": distance_distribution.to_csv(),
-            "yearly_stats": yoy_comparison.to_csv(),  # DONE
-            "workout_composition_count": workout_breakdown.to_csv(index=False),  # NOT USED
-            "workout_composition_percentage": workout_percentages.to_csv(),  # DONE,
-            "heatmap_json": current_year_running_df["distance_km_round"].to_json(orient="index"),
-        },
+    asyncio.run(refresh_fleet(concurrency=8, checkpoint_path="data/fleet_refresh_checkpoint.json"))
+    """
+    athletes = await db.fetch_all(
+        "SELECT strava_id FROM main.botdata_v2 WHERE strava_approval = TRUE AND strava_id IS NOT NULL ORDER BY last_active_at DESC NULLS LAST"
+    )
+    checkpoint = {"done": [], "failed": {}}
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        with open(checkpoint_path, "r") as f:
+            checkpoint = json.load(f)
+    done = set(checkpoint["done"])
+    pending = [athlete["strava_id"] for athlete in athletes if athlete["strava_id"] not in done]
+    logger.info(f"Fleet refresh: {len(pending)} athletes to refresh, {len(athletes) - len(pending)} already done")
+
+    semaphore = asyncio.Semaphore(concurrency)
+    started = time.perf_counter()
+    progress = {"refreshed": 0, "failed": 0}
+
+    def save_checkpoint():
+        if checkpoint_path:
+            with open(f"{checkpoint_path}.tmp", "w") as f:
+                json.dump(checkpoint, f)
+            os.replace(f"{checkpoint_path}.tmp", checkpoint_path)
+
+    async def refresh(strava_id):
+        async with semaphore:
+            try:
+                if sync:
+                    with strava_priority(BULK):
+                        result = await sync_recent_data_from_strava(strava_id)
+                    if result["status"] != "success":
+                        raise RuntimeError(result.get("message"))
+                await baseline_analytics(strava_id, upload_to_file=True, executor=executor)
+                checkpoint["done"].append(strava_id)
+                checkpoint["failed"].pop(strava_id, None)
+                progress["refreshed"] += 1
+            except Exception as e:
+                logger.error(f"Fleet refresh failed for {strava_id}: {str(e)}")
+                checkpoint["failed"][strava_id] = str(e)
+                progress["failed"] += 1
+            save_checkpoint()
+            if (progress["refreshed"] + progress["failed"]) % progress_every == 0:
+                log_progress()
+
+    def log_progress():
+        processed = progress["refreshed"] + progress["failed"]
+        logger.info(f"Fleet refresh: {processed}/{len(pending)} athletes, {processed / (time.perf_counter() - started) * 60:.1f} athletes/min")
+
+    await asyncio.gather(*(refresh(strava_id) for strava_id in pending))
+    # The final count, unless it was just logged
+    if (progress["refreshed"] + progress["failed"]) % progress_every:
+        log_progress()
+    elapsed = time.perf_counter() - started
+    summary = {
+        "athletes": len(athletes),
+        "skipped": len(athletes) - len(pending),
+        **progress,
+        "elapsed_s": round(elapsed, 1),
+        "athletes_per_minute": round(len(pending) / elapsed * 60, 1) if elapsed else None,
     }
+    logger.info(f"Fleet refresh finished: {summary}")
+    return summary
 
-    hashed_strava_id = custom_hash(strava_id)
-    if upload_to_file:
-        with open(f"data/activity_data/{hashed_strava_id}.json", "w") as outfile:
-            json.dump(analytics_results, outfile)
-        logger.info(f"Analytics results uploaded to file for {strava_id}")
 
-    return analytics_results
+# Coalesces the analytics recomputes of the sync jobs running in this process, webhooks enqueue recompute_analytics jobs instead
+analytics_debouncer = KeyedDebouncer(lambda strava_id: baseline_analytics(strava_id, upload_to_file=True), window=analytics_debounce_seconds,
+                                     name="analytics_debouncer")
 
 
 async def datawrapper_initiate_charts(weblink, strava_id):
     """
-    Initiate Datawrapper charts for a given Strava ID, meant to be called just once as we are getting data from a dynamic API.
+    Initiate Datawrapper charts for a given Strava ID, one per entry of CHART_SPECS (utils_datawrapper_config.py). Idempotent: charts
+    already in main.strava_charts with the same spec_hash are reused without any Datawrapper call, changed specs reconfigure the
+    existing chart, only missing charts are created. Every chart is provisioned concurrently, the changed rows are written in one upsert.
     https://www.datawrapper.de/_/QWieq/
 
     Step 1 - Prepare the data from baseline_analytics
     Step 2 - Create the charts with the /stravajson API in the datawrapper interface (probably the easiest way)
     Step 3 - Export the configurations with the chart IDs with the get_chart_metadata function
-    Step 4 - Create the charts with the create_and_publish_chart function in this function
+    Step 4 - Add a ChartSpec for the chart to CHART_SPECS
 
-    chart_data = dw.get_chart_metadata("nbA7s")
+    chart_data = asyncio.run(dw.get_chart_metadata("nbA7s"))
     strava_id = 28923822
     weblink = "https://stravav2.kennyvectors.com"
 
     asyncio.run(db.connect())
-    asyncio.run(db.upsert(table='main.strava_charts', data={'strava_id': str(strava_id), 'strava_hashed_id': hashed_strava_id, 'chart_id': chart1_id,
-            'chart_title': "Monthly Running Stats", 'web_link': f"{weblink}/stravajson/aggregations-monthly_stats?id={hashed_strava_id}",
-            'embed_code_responsive': embed_code_responsive, 'embed_code_web_component': embed_code_web_component,
-            'updated_at': datetime.now(timezone.utc).astimezone(sg_timezone)}, constraint_columns=['strava_id', 'chart_id']))
+    chart_ids = asyncio.run(datawrapper_initiate_charts(weblink, strava_id))  # {"chart1": "q6gP0", ...}
     """
     hashed_strava_id = custom_hash(strava_id)
-    # Chart 1 - Month + Year Running Data (Table) TODO, make it dynamic
-    year_lst = [str(year) for year in range(2018, 2031)]
-    year_color_map = {year: hex_colour_lst[i % len(hex_colour_lst)] for i, year in enumerate(year_lst)}
-    success, chart1_id, embed_code_responsive, embed_code_web_component = dw.create_and_publish_chart(
-        title="Monthly Running Stats",
-        chart_type="d3-bars-split",
-        web_link=f"{weblink}/stravajson/aggregations-monthly_stats?id={hashed_strava_id}",
-        visualization_settings={
-            "color-category": {"map": year_color_map, "categoryOrder": year_lst, "categoryLabels": {}},
-            "show-color-key": True,
-            "color-by-column": True,
-            "date-label-format": "MMMM",
-        },
-        publish_settings={"embed-width": 700, "embed-height": 400},
-    )
-
-    if success:
-        await db.upsert(
-            table="main.strava_charts",
-            data={
-                "strava_id": str(strava_id),
-                "strava_hashed_id": hashed_strava_id,
-                "chart_identifier_id": "chart1",
-                "chart_id": chart1_id,
-                "web_link": f"{weblink}/stravajson/aggregations-monthly_stats?id={hashed_strava_id}",
-                "chart_title": "Monthly Running Stats",
-                "embed_code_responsive": embed_code_responsive,
-                "embed_code_web_component": embed_code_web_component,
-                "updated_at": datetime.now(timezone.utc).astimezone(sg_timezone),
-            },
-            constraint_columns=["strava_id", "chart_identifier_id"],
-        )
-
-    # Chart 2 - Weekly Running Data (Line)
-    success, chart2_id, embed_code_responsive, embed_code_web_component = dw.create_and_publish_chart(
-        title="Weekly Mileage (past 20 weeks from latest activity)",
-        chart_type="column-chart",
-        web_link=f"{weblink}/stravajson/aggregations-weekly_stats?id={hashed_strava_id}",
-        visualization_settings={
-            "base-color": "#ea503f",
-            "valueLabels": {"show": "always"},
-            "disable-tabs": False,
-            "chart-type-set": True,
-            "plotHeightFixed": 200,
-            "plotHeightRatio": 0.5,
-        },
-        describe_settings={"intro": "Distance and Time Spent on Running by Week"},
-        publish_settings={"embed-width": 700, "embed-height": 500, "blocks": {"get-the-data": True}},
-    )
-    if success:
-        await db.upsert(
-            table="main.strava_charts",
-            data={
-                "strava_id": str(strava_id),
-                "strava_hashed_id": hashed_strava_id,
-                "chart_identifier_id": "chart2",
-                "chart_id": chart2_id,
-                "web_link": f"{weblink}/stravajson/aggregations-weekly_stats?id={hashed_strava_id}",
-                "chart_title": "Weekly Mileage (past 20 weeks from latest activity)",
-                "embed_code_responsive": embed_code_responsive,
-                "embed_code_web_component": embed_code_web_component,
-                "updated_at": datetime.now(timezone.utc).astimezone(sg_timezone),
-            },
-            constraint_columns=["strava_id", "chart_identifier_id"],
-        )
-
-    # Chart 3 - Yearly Comparison data
-    from utils_datawrapper_config import visualization_chart_3_settings
-
-    success, chart3_id, embed_code_responsive, embed_code_web_component = dw.create_and_publish_chart(
-        title="Year-on-year Comparison Data",
-        chart_type="tables",
-        web_link=f"{weblink}/stravajson/aggregations-yearly_stats?id={hashed_strava_id}",
-        visualization_settings=visualization_chart_3_settings,
-        publish_settings={"embed-width": 900, "embed-height": 500},
-    )
-    if success:
-        await db.upsert(
-            table="main.strava_charts",
-            data={
-                "strava_id": str(strava_id),
-                "strava_hashed_id": hashed_strava_id,
-                "chart_identifier_id": "chart3",
-                "chart_id": chart3_id,
-                "chart_title": "Year-on-year Comparison Data",
-                "web_link": f"{weblink}/stravajson/aggregations-yearly_stats?id={hashed_strava_id}",
-                "embed_code_responsive": embed_code_responsive,
-                "embed_code_web_component": embed_code_web_component,
-                "updated_at": datetime.now(timezone.utc).astimezone(sg_timezone),
-            },
-            constraint_columns=["strava_id", "chart_identifier_id"],
-        )
-
-    # Chart 4 - Running composition using stacked bars https://workout.kennyvectors.com/stacktableexport
-    activity_type_color_map = {activity_type: hex_colour_lst[i % len(hex_colour_lst)] for i, activity_type in enumerate(strava_activity_type_lst)}
-    success, chart4_id, embed_code_responsive, embed_code_web_component = dw.create_and_publish_chart(
-        title="Running Composition",
-        chart_type="d3-bars-stacked",
-        web_link=f"{weblink}/stravajson/aggregations-workout_composition_percentage?id={hashed_strava_id}",
-        visualization_settings={
-            "color-category": {"map": activity_type_color_map, "categoryLabels": {}},
-            "show-color-key": True,
-            "color-by-column": True,
-        },
-        publish_settings={"embed-width": 800, "embed-height": 400},
-    )
-    if success:
-        await db.upsert(
-            table="main.strava_charts",
-            data={
-                "strava_id": str(strava_id),
-                "strava_hashed_id": hashed_strava_id,
-                "chart_identifier_id": "chart4",
-                "chart_id": chart4_id,
-                "chart_title": "Running Composition",
-                "web_link": f"{weblink}/stravajson/aggregations-workout_composition_percentage?id={hashed_strava_id}",
-                "embed_code_responsive": embed_code_responsive,
-                "embed_code_web_component": embed_code_web_component,
-                "updated_at": datetime.now(timezone.utc).astimezone(sg_timezone),
-            },
-            constraint_columns=["strava_id", "chart_identifier_id"],
-        )
+    # Charts read live data through their external data links, so an existing chart is only touched when its spec changed
+    existing_charts = {
+        row["chart_identifier_id"]: row
+        for row in await db.fetch_all("SELECT chart_identifier_id, chart_id, spec_hash FROM main.strava_charts WHERE strava_id = $1", str(strava_id))
+    }
+    outcomes = {"created": 0, "reconfigured": 0, "reused": 0, "failed": 0}
+    rows = []
+
+    async def provision_chart(spec):
+        """Reuse, reconfigure or create one chart, returns its chart id ('' unless it is published) and queues its row when it changed"""
+        web_link = f"{weblink}/stravajson/{spec.data_path}?id={hashed_strava_id}"
+        spec_hash = spec.spec_hash(web_link)
+        existing = existing_charts.get(spec.chart_identifier_id)
+        if existing is not None and existing["spec_hash"] == spec_hash:
+            outcomes["reused"] += 1
+            return existing["chart_id"]
+
+        outcome = "created"
+        if existing is not None:
+            outcome = "reconfigured"
+            success, chart_id, embed_code_responsive, embed_code_web_component = await dw.configure_and_publish_chart(
+                existing["chart_id"], title=spec.title, chart_type=spec.chart_type, web_link=web_link, **spec.settings()
+            )
+            # Only a chart deleted on Datawrapper's side is replaced, any other failure is retried on the next reload
+            if not success and not await dw.chart_exists(existing["chart_id"]):
+                outcome = "created"
+        if existing is None or outcome == "created":
+            success, chart_id, embed_code_responsive, embed_code_web_component = await dw.create_and_publish_chart(
+                title=spec.title, chart_type=spec.chart_type, web_link=web_link, **spec.settings()
+            )
+        outcomes[outcome if success else "failed"] += 1
+        # A chart created but not configured or published is kept too (no spec_hash, no embed codes), so that the next run
+        # reconfigures it instead of creating another one on Datawrapper
+        if success or (outcome == "created" and chart_id):
+            rows.append(
+                {
+                    "strava_id": str(strava_id),
+                    "strava_hashed_id": hashed_strava_id,
+                    "chart_identifier_id": spec.chart_identifier_id,
+                    "chart_id": chart_id,
+                    "web_link": web_link,
+                    "chart_title": spec.title,
+                    "embed_code_responsive": embed_code_responsive,
+                    "embed_code_web_component": embed_code_web_component,
+                    "spec_hash": spec_hash if success else None,
+                    "updated_at": datetime.now(timezone.utc).astimezone(sg_timezone),
+                }
+            )
+        return chart_id if success else ""
+
+    # Provisioned concurrently, the client bounds how many Datawrapper calls are in flight
+    chart_ids = await asyncio.gather(*[provision_chart(spec) for spec in CHART_SPECS.values()])
+    if rows:
+        await db.bulk_upsert(table="main.strava_charts", data=rows, constraint_columns=["strava_id", "chart_identifier_id"], strategy="values")
+        # This worker serves the new embeds straight away, the others once their CHART_CACHE_TTL runs out
+        chart_cache.invalidate(hashed_strava_id)
+    logger.info(f"Datawrapper charts completed for {strava_id} ({outcomes})")
+    return dict(zip(CHART_SPECS, chart_ids))
+
+
+SYNC_FUNCTIONS = {"incremental": sync_recent_data_from_strava, "full": retrieve_full_data_from_strava, "reconcile": reconcile_data_from_strava}
+
+
+async def send_job_notifications(notifications):
+    """notifications = [{"bot": "bot" | "logger", "chat_id": ..., "text": ...}], failures are logged so they never retry the job"""
+    for notification in notifications:
+        app = logger_bot_app if notification["bot"] == "logger" else bot_app
+        try:
+            await app.bot.send_message(chat_id=int(notification["chat_id"]), text=notification["text"])
+        except Exception as e:
+            logger.warning(f"Failed to send job notification {notification}: {str(e)}")
+
+
+async def handle_sync_athlete_job(payload):
+    """
+    Job queue handler for onboarding and /reload-full-data: sync activities, recompute analytics, create charts, notify.
+    payload = {"strava_id": "28923822", "mode": "incremental", "weblink": "https://stravav2.kennyvectors.com", "notifications": []}
+    asyncio.run(job_queue.enqueue("sync_athlete", payload, dedupe_key="sync:incremental:28923822"))
+    """
+    strava_id = str(payload["strava_id"])
+    # Backfills must not eat into the rate limit budget webhooks need
+    with strava_priority(BULK):
+        result = await SYNC_FUNCTIONS[payload.get("mode", "incremental")](strava_id)
+    if result["status"] != "success":
+        raise RuntimeError(f"Strava sync failed for {strava_id}: {result.get('message')}")
+
+    # The debouncer resolves to False instead of raising, the job must retry rather than build charts on a stale document
+    if not await analytics_debouncer.run(strava_id):
+        raise RuntimeError(f"Analytics recompute failed for {strava_id}")
+    chart_ids = await datawrapper_initiate_charts(payload["weblink"], strava_id)
+    # A chart that could not be created (e.g. Datawrapper's circuit is open) retries the job later, charts already there are reused
+    missing_charts = [chart for chart, chart_id in chart_ids.items() if not chart_id]
+    if missing_charts:
+        raise RuntimeError(f"Datawrapper charts {missing_charts} could not be created for {strava_id}")
+    await send_job_notifications(payload.get("notifications", []))
+
+
+async def handle_strava_webhook_job(webhook_json):
+    """
+    Job queue handler for Strava webhook events, enqueued by /strava-response so that it can answer within Strava's 2 second deadline.
+    webhook_json = {"aspect_type": "create", "event_time": 1734361680, "object_id": 13127941701, "object_type": "activity", "owner_id": 28923822, "subscription_id": 143570, "updates": {}}
+    """
+    await send_job_notifications([{"bot": "logger", "chat_id": kenny_chat_id, "text": str(webhook_json)}])
+    owner_id, activity_id = str(webhook_json["owner_id"]), str(webhook_json["object_id"])
+
+    if webhook_json["aspect_type"] in ("create", "update"):
+        access_token = await retrieve_access_token(owner_id)
+        if access_token is None:
+            logger.info(f"STRAVA WEBHOOK SKIP (strava webhook subscribed but didn't record data into DB). for webhook {webhook_json}")
+            return
+        # Fetched before taking the lock, other events of the athlete must not wait on Strava
+        db_activity = await fetch_activity_from_strava(access_token, webhook_json)
+        if db_activity is None:
+            raise RuntimeError(f"Failed to fetch activity {activity_id} for {owner_id} from Strava")
+
+        async def write_activity(conn):
+            return await create_update_data_from_strava(conn, webhook_json, db_activity)
+
+    elif webhook_json["aspect_type"] == "delete":
+
+        async def write_activity(conn):
+            return await delete_activity_from_strava(conn, webhook_json)
+
+    else:
+        logger.warning(f"Unknown aspect type: {webhook_json['aspect_type']}")
+        return
+
+    # Events of the same athlete (and baseline_analytics snapshots) take turns from here, so old_row is the row this event changes.
+    # The write and the delta commit together.
+    async with analytics_lock(owner_id) as conn:
+        cache_fingerprint = await activity_cache.fingerprint(db, owner_id) if activity_cache is not None else None
+        old_row = await fetch_activity_for_analytics(conn, owner_id, activity_id)
+        if not await write_activity(conn):
+            raise RuntimeError(f"Failed to {webhook_json['aspect_type']} activity {activity_id} for {owner_id}")
+        new_row = await fetch_activity_for_analytics(conn, owner_id, activity_id)
+        # The write commits with or without the delta (its own savepoint), so a failure here recomputes instead of retrying the job
+        try:
+            updated = await update_analytics_for_activity(conn, owner_id, activity_id, old_row, new_row)
+        except Exception as e:
+            logger.exception(f"Incremental analytics failed for {owner_id}: {str(e)}")
+            updated = False
+
+    # After the commit, patch_activity names the file after the committed rows. An event committed in between drops the file instead
+    if activity_cache is not None:
+        try:
+            await activity_cache.patch_activity(db, owner_id, new_row, activity_id, cache_fingerprint)
+        except Exception as e:
+            logger.exception(f"Activity cache patch failed for {owner_id}: {str(e)}")
+            activity_cache.invalidate(owner_id)
+    if not updated:
+        # Delayed and merged while queued, so a burst of events of one athlete is a single recompute on whichever worker picks it up
+        await job_queue.enqueue("recompute_analytics", {"strava_id": owner_id}, delay=analytics_debounce_seconds, dedupe_key=f"analytics:{owner_id}")
+
+
+async def handle_recompute_analytics_job(payload):
+    """
+    Job queue handler for the full analytics recomputes of webhook events the incremental update could not apply.
+    payload = {"strava_id": "28923822"}
+    """
+    await baseline_analytics(str(payload["strava_id"]), upload_to_file=True)
 
-    # Chart 5 - Running Distance Distribution
-    year_color_map = {year: hex_colour_lst[i % len(hex_colour_lst)] for i, year in enumerate(distance_category_lst)}
-    success, chart5_id, embed_code_responsive, embed_code_web_component = dw.create_and_publish_chart(
-        title="Running Distance Distribution",
-        chart_type="d3-bars-split",
-        web_link=f"{weblink}/stravajson/aggregations-distance_distribution?id={hashed_strava_id}",
-        visualization_settings={
-            "color-category": {"map": year_color_map, "categoryOrder": distance_category_lst, "categoryLabels": {}},
-            "show-color-key": True,
-            "color-by-column": True,
-        },
-        publish_settings={"embed-width": 700, "embed-height": 400},
-    )
-    if success:
-        await db.upsert(
-            table="main.strava_charts",
-            data={
-                "strava_id": str(strava_id),
-                "strava_hashed_id": hashed_strava_id,
-                "chart_identifier_id": "chart5",
-                "chart_id": chart5_id,
-                "chart_title": "Running Distance Distribution",
-                "web_link": f"{weblink}/stravajson/aggregations-distance_distribution?id={hashed_strava_id}",
-                "embed_code_responsive": embed_code_responsive,
-                "embed_code_web_component": embed_code_web_component,
-                "updated_at": datetime.now(timezone.utc).astimezone(sg_timezone),
-            },
-            constraint_columns=["strava_id", "chart_identifier_id"],
-        )
 
-    # TODO Other charts to consider - look at 1) heart rate data, 2) ten percent (weekly rule) - but this rule does not really apply for low mileage runners - think about this.
-    logger.info(f"Datawrapper charts completed for {strava_id}")
-    return chart1_id, chart2_id, chart3_id, chart4_id, chart5_id
+job_queue.register("sync_athlete", handle_sync_athlete_job)
+job_queue.register("strava_webhook", handle_strava_webhook_job)
+job_queue.register("recompute_analytics", handle_recompute_analytics_job)
@@ -0,0 +1,304 @@
+import asyncio
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+import httpx
+from loguru import logger
+from utils_resilience import Upstream
+
+# Request priorities, interactive (webhooks, token refreshes) goes ahead of bulk (backfills, reloads)
+INTERACTIVE, BULK = 0, 1
+_request_priority: ContextVar[int] = ContextVar("strava_request_priority", default=INTERACTIVE)
+
+
+@contextmanager
+def strava_priority(priority: int) -> Iterator[None]:
+    """
+    Every Strava call made inside the block (including from tasks it spawns) is scheduled with this priority.
+
+    with strava_priority(BULK):
+        await retrieve_full_data_from_strava(strava_id)
+    """
+    token = _request_priority.set(priority)
+    try:
+        yield
+    finally:
+        _request_priority.reset(token)
+
+
+class StravaRateLimiter:
+    """
+    App-wide Strava quota budget, shared by every call of a StravaClient.
+
+    Strava counts requests in 15 minute windows (reset on the quarter hour) and daily windows (reset at midnight UTC), and reports
+    both in the X-RateLimit-Limit / X-RateLimit-Usage headers ("200,2000" / "12,340"). The budget is counted locally and corrected
+    from those headers on every response, so all uvicorn workers converge on the real usage.
+
+    Bulk requests leave `bulk_reserve` of each window to interactive ones and yield to waiting interactive requests. When the budget
+    is spent, requests wait for the window to reset instead of failing.
+    """
+
+    WINDOWS = {"short": 900, "daily": 86400}
+
+    def __init__(self, short_limit: int = 200, daily_limit: int = 2000, bulk_reserve: float = 0.2):
+        self.limits = {"short": short_limit, "daily": daily_limit}
+        self.usage = {"short": 0, "daily": 0}
+        self.bulk_reserve = bulk_reserve
+        self._window_ids = self._current_window_ids()
+        self._condition: Optional[asyncio.Condition] = None
+        self._interactive_waiting = 0
+        self.counters = {"requests": 0, "delayed": 0, "rate_limited": 0}
+
+    def _current_window_ids(self) -> Dict[str, int]:
+        now = time.time()
+        return {window: int(now // seconds) for window, seconds in self.WINDOWS.items()}
+
+    def _roll_windows(self) -> None:
+        window_ids = self._current_window_ids()
+        for window, window_id in window_ids.items():
+            if window_id != self._window_ids[window]:
+                self.usage[window] = 0
+        self._window_ids = window_ids
+
+    def remaining(self) -> Dict[str, int]:
+        self._roll_windows()
+        return {window: max(0, self.limits[window] - self.usage[window]) for window in self.limits}
+
+    def _allowed(self, priority: int) -> bool:
+        remaining = self.remaining()
+        if priority == INTERACTIVE:
+            return all(remaining[window] > 0 for window in remaining)
+        return self._interactive_waiting == 0 and all(remaining[window] > self.limits[window] * self.bulk_reserve for window in remaining)
+
+    def _seconds_until_reset(self) -> float:
+        """Until the next 15 minute boundary, an exhausted daily budget is simply re-checked every window"""
+        return self.WINDOWS["short"] - time.time() % self.WINDOWS["short"] + 1
+
+    async def acquire(self, priority: int = INTERACTIVE) -> None:
+        """Wait until the budget allows one more request of this priority, then count it"""
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            if not self._allowed(priority):
+                self.counters["delayed"] += 1
+                logger.warning(f"Strava rate limit budget low ({self.remaining()}), delaying {'bulk' if priority == BULK else 'interactive'} request")
+                self._interactive_waiting += priority == INTERACTIVE
+                try:
+                    while not self._allowed(priority):
+                        try:
+                            await asyncio.wait_for(self._condition.wait(), timeout=self._seconds_until_reset())
+                        except asyncio.TimeoutError:
+                            pass
+                finally:
+                    if priority == INTERACTIVE:
+                        self._interactive_waiting -= 1
+                        self._condition.notify_all()
+            for window in self.usage:
+                self.usage[window] += 1
+            self.counters["requests"] += 1
+
+    def update_from_response(self, response: httpx.Response) -> None:
+        """Take the authoritative limits and usage from Strava's headers, a 429 marks the current window as spent"""
+        limit, usage = response.headers.get("X-RateLimit-Limit"), response.headers.get("X-RateLimit-Usage")
+        if limit and usage:
+            self._roll_windows()
+            try:
+                self.limits = dict(zip(self.WINDOWS, map(int, limit.split(","))))
+                self.usage = dict(zip(self.WINDOWS, map(int, usage.split(","))))
+            except ValueError:
+                logger.warning(f"Unexpected Strava rate limit headers: {limit} / {usage}")
+        if response.status_code == 429:
+            self.counters["rate_limited"] += 1
+            self.usage["short"] = max(self.usage["short"], self.limits["short"])
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limits": self.limits,
+            "usage": self.usage,
+            "remaining": self.remaining(),
+            "seconds_until_reset": round(self._seconds_until_reset()),
+            **self.counters,
+        }
+
+
+class StravaClient:
+    """
+    Shared async HTTP client for the Strava API.
+
+    Every ingestion path (oauth, backfill, webhooks) goes through a single pooled httpx.AsyncClient so that
+    connections are kept alive between calls and a slow Strava response never blocks the event loop.
+    Every call is also scheduled by a StravaRateLimiter, at the priority set with strava_priority (interactive by default), and goes
+    through an Upstream (retries with backoff, per-endpoint timeouts, a circuit breaker that fails fast while Strava is down).
+
+    strava = StravaClient(client_id=strava_client_id, client_secret=strava_client_secret)
+    asyncio.run(strava.get_activity(access_token, 13127941701))
+    """
+
+    def __init__(
+        self,
+        client_id: int,
+        client_secret: str,
+        base_url: str = "https://www.strava.com",
+        timeout: float = 10.0,
+        connect_timeout: float = 5.0,
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+        max_concurrency_per_host: int = 8,
+        rate_limiter: Optional[StravaRateLimiter] = None,
+        max_rate_limit_retries: int = 2,
+        upstream: Optional[Upstream] = None,
+    ):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.base_url = base_url.rstrip("/")
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections)
+        self.max_concurrency_per_host = max_concurrency_per_host
+        self._client: Optional[httpx.AsyncClient] = None
+        self._host_semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.rate_limiter = rate_limiter or StravaRateLimiter()
+        self.max_rate_limit_retries = max_rate_limit_retries
+        self.upstream = upstream or Upstream("strava", max_attempts=max_rate_limit_retries + 1)
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """Create the pooled client lazily so it binds to the running event loop (one per uvicorn worker)"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=self.limits)
+        return self._client
+
+    def _get_host_semaphore(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc or urlsplit(self.base_url).netloc
+        if host not in self._host_semaphores:
+            self._host_semaphores[host] = asyncio.Semaphore(self.max_concurrency_per_host)
+        return self._host_semaphores[host]
+
+    async def _request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """
+        Send a request through the shared pool, bounded by the rate limit budget and the per-host concurrency limit.
+        Transient failures are retried by the upstream policy (utils_resilience.py), a 429 (rate limited anyway, e.g. by another
+        app instance) also marks the budget as spent so that the retry waits for it instead of failing.
+        """
+
+        async def send(timeout: Optional[float]) -> httpx.Response:
+            await self.rate_limiter.acquire(_request_priority.get())
+            async with self._get_host_semaphore(url):
+                response = await self._get_client().request(method, url, **kwargs, **({"timeout": httpx.Timeout(timeout, connect=self.timeout.connect)} if timeout else {}))
+            self.rate_limiter.update_from_response(response)
+            return response
+
+        response = await self.upstream.call(send, urlsplit(url).path, method)
+        response.raise_for_status()
+        return response
+
+    async def exchange_code(self, code: str) -> Dict[str, Any]:
+        """Exchange an oauth authorization code for the athlete's credentials (refresh token, access token, athlete)"""
+        data = {"client_id": self.client_id, "client_secret": self.client_secret, "grant_type": "authorization_code", "code": code}
+        response = await self._request("POST", "/oauth/token", data=data)
+        return response.json()
+
+    async def refresh_access_token(self, refresh_token: str) -> Dict[str, Any]:
+        """Trade a refresh token for a short-lived access token"""
+        data = {
+            "client_id": self.client_id,
+            "grant_type": "refresh_token",
+            "refresh_token": refresh_token,
+            "client_secret": self.client_secret,
+        }
+        response = await self._request("POST", "/oauth/token", data=data)
+        return response.json()
+
+    async def get_athlete_activities(self, access_token: str, page: int = 1, per_page: int = 200, **params) -> List[Dict[str, Any]]:
+        """List the athlete's activities (latest first), one page at a time"""
+        headers = {"Authorization": f"Bearer {access_token}"}
+        response = await self._request("GET", "/api/v3/athlete/activities", headers=headers, params={"page": page, "per_page": per_page, **params})
+        return response.json()
+
+    async def get_activity(self, access_token: str, activity_id: int) -> Dict[str, Any]:
+        """Retrieve a single detailed activity"""
+        headers = {"Authorization": f"Bearer {access_token}"}
+        response = await self._request("GET", f"/api/v3/activities/{activity_id}", headers=headers)
+        return response.json()
+
+    async def aclose(self) -> None:
+        """Close all pooled connections"""
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+            logger.info("Strava client pool closed")
+
+
+class StravaTokenCache:
+    """
+    Per-athlete access token cache.
+
+    Access tokens are kept in memory and persisted (with expires_at) in main.botdata_v2 so that the other uvicorn workers reuse them too.
+    A token is only refreshed when it is within `refresh_margin` seconds of expiry, concurrent refreshes for the same athlete are coalesced
+    into a single /oauth/token call, and the rotated refresh token Strava sends back is stored.
+
+    strava_tokens = StravaTokenCache(client=strava, db=db)
+    asyncio.run(strava_tokens.get_access_token(28923822))
+    """
+
+    def __init__(self, client: StravaClient, db, refresh_margin: int = 600):
+        self.client = client
+        self.db = db
+        self.refresh_margin = refresh_margin
+        self._tokens: Dict[str, Tuple[str, float]] = {}  # strava_id -> (access_token, expires_at epoch)
+        self._refreshing: Dict[str, asyncio.Future] = {}
+        self.counters = {"hits": 0, "db_hits": 0, "refreshes": 0, "coalesced": 0}
+
+    def _is_fresh(self, expires_at: Optional[float]) -> bool:
+        return expires_at is not None and expires_at - self.refresh_margin > time.time()
+
+    def store(self, strava_id, credentials_dic: Dict[str, Any]) -> None:
+        """Keep an access token in memory, credentials_dic is the /oauth/token response"""
+        self._tokens[str(strava_id)] = (credentials_dic["access_token"], float(credentials_dic["expires_at"]))
+
+    async def persist(self, strava_id, credentials_dic: Dict[str, Any]) -> None:
+        """Store the token in memory and in main.botdata_v2, including the (possibly rotated) refresh token"""
+        self.store(strava_id, credentials_dic)
+        await self.db.update(
+            "UPDATE main.botdata_v2 SET access_token = $2, expires_at = to_timestamp($3), refresh_token = $4 WHERE strava_id = $1",
+            str(strava_id),
+            credentials_dic["access_token"],
+            float(credentials_dic["expires_at"]),
+            credentials_dic["refresh_token"],
+        )
+
+    async def get_access_token(self, strava_id) -> Optional[str]:
+        """Return a valid access token for the athlete, or None if the athlete has not connected to the bot"""
+        strava_id = str(strava_id)
+        cached = self._tokens.get(strava_id)
+        if cached and self._is_fresh(cached[1]):
+            self.counters["hits"] += 1
+            return cached[0]
+
+        if strava_id in self._refreshing:
+            self.counters["coalesced"] += 1
+            return await asyncio.shield(self._refreshing[strava_id])
+
+        refresh = asyncio.ensure_future(self._load_or_refresh(strava_id))
+        self._refreshing[strava_id] = refresh
+        try:
+            return await asyncio.shield(refresh)
+        finally:
+            if self._refreshing.get(strava_id) is refresh:
+                del self._refreshing[strava_id]
+
+    async def _load_or_refresh(self, strava_id: str) -> Optional[str]:
+        row = await self.db.fetch_one("SELECT refresh_token, access_token, expires_at FROM main.botdata_v2 WHERE strava_id = $1", strava_id)
+        if row is None:
+            return None
+
+        # Another worker may have refreshed the token already
+        if row["access_token"] and row["expires_at"] and self._is_fresh(row["expires_at"].timestamp()):
+            self.counters["db_hits"] += 1
+            self._tokens[strava_id] = (row["access_token"], row["expires_at"].timestamp())
+            return row["access_token"]
+
+        credentials_dic = await self.client.refresh_access_token(row["refresh_token"])
+        self.counters["refreshes"] += 1
+        await self.persist(strava_id, credentials_dic)
+        logger.info(f"Refreshed Strava access token for {strava_id}, expires at {credentials_dic['expires_at']}")
+        return credentials_dic["access_token"]
@@ -0,0 +1,136 @@
+"""
+Converts Strava activity payloads (SummaryActivity / DetailedActivity) into main.strava_activities rows.
+
+Shared by the full retrieval, the incremental sync and the webhook, and works on a whole page at a time:
+timestamps are parsed column-wise, the hashed id is computed once per athlete, and lat/lng lists are passed
+as is to the asyncpg JSONB codec (see Database.connect) instead of json.dumps.
+
+records = map_activities(activities, updated_at=datetime.now(timezone.utc))
+"""
+
+from datetime import datetime
+from itertools import starmap
+from typing import Any, Dict, List, NamedTuple, Optional
+from utils import custom_hash
+
+class ActivityRecord(NamedTuple):
+    """One main.strava_activities row, tuple-backed so a page of records carries no per-row dict"""
+
+    strava_id: str
+    hashed_strava_id: str
+    activity_id: str
+    name: Optional[str]
+    distance: Optional[float]
+    moving_time: Optional[int]
+    elapsed_time: Optional[int]
+    total_elevation_gain: Optional[float]
+    type: Optional[str]
+    sport_type: Optional[str]
+    workout_type: Optional[int]
+    start_date: datetime
+    start_date_local: datetime
+    timezone: Optional[str]
+    utc_offset: Optional[int]
+    start_latlng: Optional[list]
+    end_latlng: Optional[list]
+    location_country: Optional[str]
+    achievement_count: int
+    kudos_count: int
+    comment_count: int
+    athlete_count: int
+    photo_count: int
+    trainer: bool
+    commute: bool
+    manual: bool
+    private: bool
+    flagged: bool
+    gear_id: Optional[str]
+    average_speed: Optional[float]
+    max_speed: Optional[float]
+    average_cadence: Optional[float]
+    average_watts: Optional[float]
+    weighted_average_watts: Optional[float]
+    kilojoules: Optional[float]
+    device_watts: bool
+    has_heartrate: bool
+    average_heartrate: Optional[float]
+    max_heartrate: Optional[float]
+    max_watts: Optional[float]
+    pr_count: int
+    total_photo_count: int
+    has_kudoed: bool
+    updated_at: datetime
+
+
+# Optional fields and their default when Strava leaves them out, in ActivityRecord order
+OPTIONAL_FIELD_DEFAULTS = {
+    "sport_type": None,
+    "workout_type": None,
+    "timezone": None,
+    "utc_offset": None,
+    "start_latlng": None,
+    "end_latlng": None,
+    "location_country": None,
+    "achievement_count": 0,
+    "kudos_count": 0,
+    "comment_count": 0,
+    "athlete_count": 0,
+    "photo_count": 0,
+    "trainer": False,
+    "commute": False,
+    "manual": False,
+    "private": False,
+    "flagged": False,
+    "gear_id": None,
+    "average_speed": None,
+    "max_speed": None,
+    "average_cadence": None,
+    "average_watts": None,
+    "weighted_average_watts": None,
+    "kilojoules": None,
+    "device_watts": False,
+    "has_heartrate": False,
+    "average_heartrate": None,
+    "max_heartrate": None,
+    "max_watts": None,
+    "pr_count": 0,
+    "total_photo_count": 0,
+    "has_kudoed": False,
+}
+
+
+def parse_strava_timestamps(values: List[str]) -> List[datetime]:
+    """
+    Parse a column of Strava timestamps ("2024-12-13T08:06:21Z") in one go, returns naive datetimes.
+    Strava always uses this fixed ISO 8601 layout, so datetime.fromisoformat (C) applies without strptime's format matching,
+    which is also ~30x faster than pd.to_datetime on a 200 row page. The trailing Z is dropped for python 3.10.
+    """
+    return list(map(datetime.fromisoformat, [value[:-1] for value in values]))
+
+
+def map_activities(activities: List[Dict[str, Any]], updated_at: datetime) -> List[ActivityRecord]:
+    """Convert a page of Strava activities into ActivityRecords, column by column"""
+    if not activities:
+        return []
+
+    athlete_ids = [str(activity["athlete"]["id"]) for activity in activities]
+    hashed_ids = {athlete_id: custom_hash(athlete_id) for athlete_id in set(athlete_ids)}
+
+    columns = {
+        "strava_id": athlete_ids,
+        "hashed_strava_id": [hashed_ids[athlete_id] for athlete_id in athlete_ids],
+        "activity_id": [str(activity["id"]) for activity in activities],
+        "name": [activity["name"] for activity in activities],
+        "distance": [activity["distance"] for activity in activities],
+        "moving_time": [activity["moving_time"] for activity in activities],
+        "elapsed_time": [activity["elapsed_time"] for activity in activities],
+        "total_elevation_gain": [activity["total_elevation_gain"] for activity in activities],
+        "type": [activity["type"] for activity in activities],
+        "start_date": parse_strava_timestamps([activity["start_date"] for activity in activities]),
+        "start_date_local": parse_strava_timestamps([activity["start_date_local"] for activity in activities]),
+        "updated_at": [updated_at] * len(activities),
+    }
+    for field, default in OPTIONAL_FIELD_DEFAULTS.items():
+        columns[field] = [activity.get(field, default) for activity in activities]
+
+    return list(starmap(ActivityRecord, zip(*(columns[field] for field in ActivityRecord._fields))))